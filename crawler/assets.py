@@ -0,0 +1,154 @@
+"""Content-addressed mirror of the player photos, flags and club logos.
+
+Flags and club logos are shared by thousands of players, so mirror_assets downloads each
+distinct url once, with the downloader's bounded concurrency and retries. Images are
+stored in data/assets/objects/ under the sha256 of their content (e.g.
+objects/3f/3f9a...e1.png), so an image served at several urls is only stored once, and
+data/assets/manifest.json maps each url to its hash, path and HTTP validators.
+
+Repeat runs request the mirrored urls conditionally, and keep the stored image on a 304
+or on a 200 with the same hash. The manifest is saved every CHECKPOINT_EVERY images, so
+an interrupted mirror resumes where it stopped rather than starting over. localize
+replaces the urls in the asset columns of a table with the paths of the mirrored images,
+relative to data/.
+
+The urls in the tables point to sofifa's cdn; set CDN_URL to download the images from
+somewhere else, e.g. a crawler.standin.
+"""
+import hashlib
+import json
+import os
+import posixpath
+import urllib.parse
+
+import crawler.downloader
+import crawler.metrics
+import crawler.utils
+
+ASSET_DIR = crawler.utils.DATA_DIR / 'assets'
+ASSET_COLS = ['photo', 'flag', 'club_logo']
+SOFIFA_CDN_URL = 'https://cdn.sofifa.org'
+CDN_URL = SOFIFA_CDN_URL
+CHECKPOINT_EVERY = 500  # images downloaded between saves of the manifest
+
+
+def _manifest_path():
+    return ASSET_DIR / 'manifest.json'
+
+
+def read_manifest():
+    """{url: {'sha256': ..., 'path': ..., 'validator': ...}} of the mirrored images, path being
+    relative to ASSET_DIR."""
+    try:
+        with open(_manifest_path(), encoding='utf_8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_manifest(manifest):
+    path = _manifest_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf_8') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def _object_path(digest, url):
+    extension = posixpath.splitext(urllib.parse.urlsplit(url).path)[1]
+    return posixpath.join('objects', digest[:2], digest + extension)
+
+
+def _is_mirrored(manifest, url):
+    return url in manifest and (ASSET_DIR / manifest[url]['path']).exists()
+
+
+def _download_url(url):
+    if CDN_URL != SOFIFA_CDN_URL and url.startswith(SOFIFA_CDN_URL):
+        return CDN_URL + url[len(SOFIFA_CDN_URL):]
+    return url
+
+
+def asset_urls(data, cols=ASSET_COLS):
+    """The distinct image urls in the asset columns of data, in order of appearance."""
+    urls = {}
+    for col in cols:
+        if col in data.columns:
+            urls.update(dict.fromkeys(url for url in data[col].dropna().unique() if url.startswith('http')))
+    return list(urls)
+
+
+def mirror_assets(urls, refresh=True, n_workers=None):
+    """Downloads the images at urls into ASSET_DIR and records them in the manifest.
+
+    Urls that are already mirrored are requested again conditionally, or skipped if refresh
+    is False. Returns the {url: exception} dict of the urls that couldn't be downloaded, as
+    crawler.downloader.download does."""
+    manifest = read_manifest()
+    urls = {_download_url(url): url for url in urls if refresh or not _is_mirrored(manifest, url)}
+    validators = {download_url: manifest[url]['validator'] for download_url, url in urls.items()
+                  if _is_mirrored(manifest, url) and manifest[url].get('validator')}
+    n_done = 0
+
+    def on_page(download_url, body):
+        nonlocal n_done
+        url = urls[download_url]
+        if body is crawler.downloader.NOT_MODIFIED:
+            crawler.metrics.increment('assets_not_modified')
+            return
+        digest = hashlib.sha256(body).hexdigest()
+        if _is_mirrored(manifest, url) and manifest[url]['sha256'] == digest:
+            crawler.metrics.increment('assets_unchanged')
+        else:
+            path = _object_path(digest, url)
+            object_path = ASSET_DIR / path
+            if object_path.exists():
+                # the same image at another url
+                crawler.metrics.increment('assets_deduplicated')
+            else:
+                object_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = object_path.with_name(object_path.name + '.tmp')
+                tmp_path.write_bytes(body)
+                os.replace(tmp_path, object_path)
+                crawler.metrics.increment('assets_new')
+                crawler.metrics.increment('asset_bytes_written', len(body))
+        manifest[url] = {'sha256': digest, 'path': _object_path(digest, url),
+                         'validator': validators.get(download_url)}
+        n_done += 1
+        if n_done % CHECKPOINT_EVERY == 0:
+            _write_manifest(manifest)
+
+    try:
+        failures = crawler.downloader.download(list(urls), on_page, validators, n_workers=n_workers, binary=True)
+    finally:
+        _write_manifest(manifest)
+    crawler.metrics.increment('asset_failures', len(failures))
+    return {urls[download_url]: e for download_url, e in failures.items()}
+
+
+def mirror_table(data, cols=ASSET_COLS, refresh=True, n_workers=None):
+    """Mirrors the images in the asset columns of data; see mirror_assets. Returns the manifest
+    and the {url: exception} dict of the images that couldn't be downloaded."""
+    failures = mirror_assets(asset_urls(data, cols), refresh, n_workers)
+    return read_manifest(), failures
+
+
+def localize(data, manifest=None, cols=ASSET_COLS):
+    """data with the urls in its asset columns replaced by the paths of the mirrored images,
+    relative to crawler.utils.DATA_DIR. Urls that aren't mirrored are kept."""
+    manifest = read_manifest() if manifest is None else manifest
+    root = os.path.relpath(ASSET_DIR, crawler.utils.DATA_DIR).replace(os.sep, '/')
+    paths = {url: posixpath.join(root, entry['path']) for url, entry in manifest.items()}
+
+    def local_path(url):
+        return paths.get(url, url)
+
+    localized = {}
+    for col in cols:
+        if col in data.columns:
+            # a categorical column is mapped once per category rather than once per row
+            localized[col] = data[col].map(local_path)
+            if data[col].dtype == 'category':
+                localized[col] = localized[col].astype('category')
+    return data.assign(**localized)
@@ -0,0 +1,224 @@
+"""Offline benchmark of the parsing and export stages, on synthetic pages from crawler.fixtures.
+
+    python -m crawler.benchmark --players 1000 10000 100000 --engine lxml
+
+Every run is appended to data/benchmarks/results.jsonl. Stages that got more than
+REGRESSION_THRESHOLD slower than the last run with the same scale and engine are reported.
+Page generation is not timed; nothing is downloaded and the real exports are not touched.
+
+    python -m crawler.benchmark --players 10000 --codecs
+
+compares the size and decode throughput of the stored fragments in the formats of
+crawler.html_store and in the old gzip JSON files instead.
+"""
+import argparse
+import gzip
+import json
+import random
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import crawler.columnar
+import crawler.executor
+import crawler.extraction
+import crawler.fixtures
+import crawler.html_store
+from crawler.league_data import _league_clubs_to_df
+from crawler.main import get_complete_data, write_files
+from crawler.overview_data import _overview_rows_to_df, clean_overview_data
+from crawler.player_data import _player_arrow_schema, clean_player_detailed_data, pack_player_records
+from crawler.utils import DATA_DIR, DEFAULT_ENGINE, read_constants
+
+RESULTS_PATH = DATA_DIR / 'benchmarks' / 'results.jsonl'
+STAGES = ['filter', 'parse', 'clean_overview_data', 'convert_player_data', 'get_complete_data', 'save_data']
+REGRESSION_THRESHOLD = 0.2
+GENERATE_BATCH_SIZE = 1000
+
+
+class _StageTimer:
+
+    def __init__(self):
+        self.timings = dict.fromkeys(STAGES, 0.0)
+
+    def time(self, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.timings[stage] += time.perf_counter() - start
+        return result
+
+
+def _filter_pages(timer, filter_page, pages):
+    return {url: timer.time('filter', filter_page, html) for url, html in pages}
+
+
+def _player_pages(universe, IDs, constants):
+    for ID in IDs:
+        yield crawler.fixtures.player_url(ID), crawler.fixtures.player_page(universe, ID, constants)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=str(Path(__file__).parent), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _synthetic_fragments(timer, universe, page_functions, constants):
+    overview_fragments = _filter_pages(timer, page_functions['overview'].filter_page,
+                                       ((crawler.fixtures.overview_url(offset),
+                                         crawler.fixtures.overview_page(universe, offset))
+                                        for offset in universe.overview_offsets()))
+    player_fragments = {}
+    for start in range(0, universe.n_players, GENERATE_BATCH_SIZE):
+        batch_IDs = universe.player_IDs[start:start + GENERATE_BATCH_SIZE]
+        player_fragments.update(_filter_pages(timer, page_functions['player'].filter_page,
+                                              _player_pages(universe, batch_IDs, constants)))
+    league_fragments = _filter_pages(timer, page_functions['league'].filter_page,
+                                     ((crawler.fixtures.league_url(league_ID),
+                                       crawler.fixtures.league_page(universe, league_ID))
+                                      for league_ID in universe.league_IDs))
+    league_overview_fragment = timer.time('filter', page_functions['league_overview'].filter_page,
+                                          crawler.fixtures.league_overview_page(universe))
+    return overview_fragments, player_fragments, league_fragments, league_overview_fragment
+
+
+def run_benchmark(n_players, engine=DEFAULT_ENGINE, constants=None):
+    """Times each stage for a synthetic crawl of n_players and returns the result record."""
+    constants = constants or read_constants()
+    universe = crawler.fixtures.Universe(n_players)
+    page_functions = {category_key: crawler.extraction.get_page_functions(category_key, engine)
+                      for category_key in crawler.extraction.ENGINES[engine]}
+    timer = _StageTimer()
+    overview_fragments, player_fragments, league_fragments, league_overview_fragment = _synthetic_fragments(
+        timer, universe, page_functions, constants)
+
+    overview_rows = timer.time('parse', crawler.executor.starmap, page_functions['overview'].parse_fragment,
+                               overview_fragments.items())
+    player_buffers = timer.time('parse', crawler.executor.starmap, page_functions['player'].parse_fragment,
+                                player_fragments.items(), constants, collect_func=pack_player_records)
+    league_IDs = timer.time('parse', page_functions['league_overview'].parse_fragment, None,
+                            league_overview_fragment)
+    league_clubs = dict(zip(league_fragments, timer.time('parse', crawler.executor.starmap,
+                                                         page_functions['league'].parse_fragment,
+                                                         league_fragments.items())))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        # keeps the quarantine files of the real crawl out of reach
+        quarantine_dir = tmp_dir / 'quarantine'
+        overview_data = timer.time('clean_overview_data', lambda: _overview_rows_to_df(overview_rows)
+                                   .pipe(clean_overview_data, quarantine_dir))
+        player_data = timer.time('convert_player_data', lambda: crawler.columnar
+                                 .ipc_to_frame(player_buffers, _player_arrow_schema(constants))
+                                 .pipe(clean_player_detailed_data, constants, quarantine_dir))
+        league_data = timer.time('parse', _league_clubs_to_df, league_clubs, league_IDs, quarantine_dir)
+        complete_data = timer.time('get_complete_data', get_complete_data, overview_data, league_data, player_data)
+        timer.time('save_data', write_files, complete_data, tmp_dir / 'complete.feather', tmp_dir / 'complete.csv',
+                   complete_data, tmp_dir / 'complete.parquet')
+
+    return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': _git_commit(),
+            'n_players': n_players,
+            'engine': engine,
+            'n_processes': crawler.executor.resolve_n_processes(),
+            'n_rows': len(complete_data),
+            'timings': timer.timings}
+
+
+def _time_decode(decode, encoded):
+    start = time.perf_counter()
+    decode(encoded)
+    return time.perf_counter() - start
+
+
+def _codec_results(fragments):
+    """{format: (bytes, decode seconds)} for storing fragments, a {url: fragment} dict."""
+    records = [json.dumps(fragment).encode() for fragment in fragments.values()]
+    results = {}
+    blob = gzip.compress(json.dumps(fragments).encode())
+    results['gzip json'] = (len(blob), _time_decode(lambda blob: json.loads(gzip.decompress(blob)), blob))
+    codecs = {'zlib records': crawler.html_store.ZlibCodec()}
+    dictionary_size = 0
+    if crawler.html_store.zstandard is not None and len(records) >= crawler.html_store.MIN_DICTIONARY_SAMPLES:
+        samples = random.Random(0).sample(records, min(crawler.html_store.DICTIONARY_SAMPLES, len(records)))
+        dictionary = crawler.html_store.train_dictionary_from_samples(samples)
+        dictionary_size = len(dictionary.as_bytes())
+        codecs['zstd dictionary records'] = crawler.html_store.ZstdDictionaryCodec(dictionary)
+    for name, codec in codecs.items():
+        encoded = [codec.encode(record) for record in records]
+        size = sum(map(len, encoded)) + (dictionary_size if name.startswith('zstd') else 0)
+        results[name] = (size, _time_decode(lambda encoded: [crawler.html_store._decode_value(raw)
+                                                            for raw in encoded], encoded))
+    return sum(map(len, records)), results
+
+
+def run_codec_benchmark(n_players, engine=DEFAULT_ENGINE, constants=None):
+    """Compares storage formats for the fragments of a synthetic crawl of n_players.
+    Returns {category: (json bytes, {format: (bytes, decode seconds)})}; zstd sizes include the dictionary."""
+    constants = constants or read_constants()
+    page_functions = {category_key: crawler.extraction.get_page_functions(category_key, engine)
+                      for category_key in crawler.extraction.ENGINES[engine]}
+    overview_fragments, player_fragments, league_fragments, _ = _synthetic_fragments(
+        _StageTimer(), crawler.fixtures.Universe(n_players), page_functions, constants)
+    return {category_key: _codec_results(fragments) for category_key, fragments in
+            [('overview', overview_fragments), ('player', player_fragments), ('league', league_fragments)]}
+
+
+def read_results(path=RESULTS_PATH):
+    try:
+        with open(path, 'r', encoding='utf_8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def record_result(result, path=RESULTS_PATH):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'a', encoding='utf_8') as f:
+        f.write(json.dumps(result) + '\n')
+
+
+def regressions(result, previous_results, threshold=REGRESSION_THRESHOLD):
+    """{stage: (previous seconds, seconds)} for the stages more than threshold slower than
+    the last previous result with the same scale and engine."""
+    comparable = [previous for previous in previous_results
+                  if previous['n_players'] == result['n_players'] and previous['engine'] == result['engine']]
+    if not comparable:
+        return {}
+    baseline = comparable[-1]['timings']
+    return {stage: (baseline[stage], seconds) for stage, seconds in result['timings'].items()
+            if stage in baseline and seconds > baseline[stage] * (1 + threshold)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--players', type=int, nargs='+', default=[1000], help='scales to run, in players')
+    parser.add_argument('--engine', default=DEFAULT_ENGINE, choices=sorted(crawler.extraction.ENGINES))
+    parser.add_argument('--no-record', action='store_true', help="don't append the results to " + str(RESULTS_PATH))
+    parser.add_argument('--codecs', action='store_true', help='compare the storage formats of the fragments instead')
+    args = parser.parse_args(argv)
+    if args.codecs:
+        for n_players in args.players:
+            print('{} players:'.format(n_players))
+            for category_key, (json_size, results) in run_codec_benchmark(n_players, args.engine).items():
+                for name, (size, seconds) in results.items():
+                    print('  {:<10}{:<26}{:10.2f} MB  {:6.1f}x  decode {:8.1f} MB/s'.format(
+                        category_key, name, size / 2 ** 20, json_size / size, json_size / 2 ** 20 / seconds))
+        return
+    previous_results = read_results()
+    for n_players in args.players:
+        result = run_benchmark(n_players, args.engine)
+        print('{} players, {} engine:'.format(n_players, args.engine))
+        for stage, seconds in result['timings'].items():
+            print('  {:<22}{:8.3f}s'.format(stage, seconds))
+        for stage, (before, after) in regressions(result, previous_results).items():
+            print('  regression in {}: {:.3f}s -> {:.3f}s'.format(stage, before, after))
+        if not args.no_record:
+            record_result(result)
+
+
+if __name__ == '__main__':
+    main()
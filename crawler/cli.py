@@ -0,0 +1,342 @@
+"""Command line interface of the crawler.
+
+    python -m crawler crawl --incremental
+    python -m crawler crawl --shard-workers 4
+    python -m crawler worker --shard-dir /shared/fifa/shards
+    python -m crawler editions 16 17 18@180084
+    python -m crawler parse --engine parsel
+    python -m crawler export --partition-by-nationality
+    python -m crawler assets --workers 20
+    python -m crawler constants
+    python -m crawler query --where league='Spanish Primera División' overall=85: --columns ID name overall
+    python -m crawler query --flags 'speedster_speciality AND prefers_st' --count
+    python -m crawler status
+    python -m crawler changes --snapshots
+    python -m crawler bench load --players 5000 --workers 25 50
+
+Importing crawler.main pulls in pandas, numpy, pyarrow, lxml, parsel and aiohttp, which
+takes the best part of a second. This module only imports the standard library, and
+each subcommand imports what it needs when it runs, so status needs nothing else and
+query only numpy and pyarrow.
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+
+# see crawler.utils.DEFAULT_ENGINE and crawler.extraction.ENGINES; not imported, to keep startup fast
+DEFAULT_ENGINE = 'lxml'
+ENGINES = ['lxml', 'parsel']
+
+
+def _add_export_arguments(parser):
+    parser.add_argument('--base-url', help='site to crawl instead of sofifa, e.g. a crawler.standin. '
+                                           'The html store is keyed by url, so parse needs the same one')
+    parser.add_argument('--engine', default=DEFAULT_ENGINE, choices=ENGINES)
+    parser.add_argument('--no-transfer-old-data', dest='transfer_old_data', action='store_false',
+                        help='overwrite data/final/current instead of moving it to data/final/previous first')
+    parser.add_argument('--no-parquet', dest='parquet', action='store_false', help="don't export Parquet datasets")
+    parser.add_argument('--partition-by-nationality', action='store_true',
+                        help='partition the Parquet datasets by nationality within each league')
+    parser.add_argument('--no-archive', dest='archive', action='store_false',
+                        help="don't add the complete table to the snapshot archive")
+    parser.add_argument('--snapshot-version', help='name of the archived version, defaults to the crawl time')
+    parser.add_argument('--profile', action='store_true', help='sample the stacks of the parse workers')
+    parser.add_argument('--processes', type=int, help='parse worker processes, defaults to the number of cpus')
+    parser.add_argument('--assets', action='store_true',
+                        help='mirror the photos, flags and club logos into data/assets and export their paths')
+    _add_cdn_argument(parser)
+
+
+def _add_cdn_argument(parser):
+    parser.add_argument('--cdn-url', help='site to download the images from instead of the sofifa cdn')
+
+
+def _configure(args):
+    import crawler.executor
+    import crawler.utils
+    crawler.executor.N_PROCESSES = args.processes
+    if args.base_url is not None:
+        crawler.utils.BASE_URL = args.base_url.rstrip('/')
+
+
+def _configure_cdn(args):
+    if args.cdn_url is not None:
+        import crawler.assets
+        crawler.assets.CDN_URL = args.cdn_url.rstrip('/')
+
+
+def _export_kwargs(args):
+    return {'transfer_old_data': args.transfer_old_data, 'engine': args.engine, 'parquet': args.parquet,
+            'partition_by_nationality': args.partition_by_nationality, 'archive': args.archive,
+            'snapshot_version': args.snapshot_version, 'profile': args.profile, 'assets': args.assets}
+
+
+def _crawl(args):
+    import crawler.downloader
+    import crawler.main
+    import crawler.sharding
+    _configure(args)
+    _configure_cdn(args)
+    if args.workers is not None:
+        crawler.downloader.N_WORKERS = args.workers
+    if args.shard_dir is not None:
+        crawler.sharding.SHARD_DIR = Path(args.shard_dir)
+    crawler.main.main(update_html_store=args.update_html_store, incremental=args.incremental,
+                      shard_workers=args.shard_workers, **_export_kwargs(args))
+
+
+def _worker(args):
+    import crawler.downloader
+    import crawler.executor
+    import crawler.sharding
+    crawler.executor.N_PROCESSES = args.processes
+    if args.workers is not None:
+        crawler.downloader.N_WORKERS = args.workers
+    crawler.sharding.run_worker(Path(args.shard_dir) if args.shard_dir else crawler.sharding.SHARD_DIR,
+                                lease_seconds=args.lease_seconds or crawler.sharding.LEASE_SECONDS)
+
+
+def _editions(args):
+    import crawler.downloader
+    import crawler.editions
+    _configure(args)
+    if args.workers is not None:
+        crawler.downloader.N_WORKERS = args.workers
+    crawler.editions.crawl_editions([crawler.editions.parse_edition(text) for text in args.editions], args.engine,
+                                    args.archive, args.parallel)
+
+
+def _parse(args):
+    import crawler.main
+    import crawler.parse_cache
+    _configure(args)
+    _configure_cdn(args)
+    crawler.parse_cache.ENABLED = args.parse_cache
+    crawler.main.main(from_file=True, **_export_kwargs(args))
+
+
+def _export(args):
+    import crawler.main
+    import crawler.utils
+    partition_cols = ('league', 'nationality') if args.partition_by_nationality else ('league',)
+    tables = {category_key: crawler.utils.read_data(category_key) for category_key in args.categories}
+    complete = tables['complete'] if 'complete' in tables else crawler.utils.read_data('complete')
+    for category_key, data in tables.items():
+        parquet_data = None
+        if args.parquet and category_key != 'league':
+            parquet_data = crawler.main._with_partition_cols(data, complete, partition_cols)
+        crawler.main.save_data(data, category_key, parquet_data, partition_cols)
+
+
+def _assets(args):
+    import crawler.assets
+    import crawler.utils
+    _configure_cdn(args)
+    failures = crawler.assets.mirror_assets(crawler.assets.asset_urls(crawler.utils.read_data('overview')),
+                                            args.refresh, args.workers)
+    if failures:
+        print('{} image(s) could not be downloaded, e.g. {}'.format(len(failures), next(iter(failures))))
+
+
+def _constants(args):
+    import crawler.create_constants
+    crawler.create_constants.update_constants()
+
+
+def _parse_value(text):
+    for convert in (int, float):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    return text
+
+
+def _parse_condition(text):
+    """col=value or col=low:high, where either bound can be left out."""
+    col, separator, value = text.partition('=')
+    if not separator:
+        raise argparse.ArgumentTypeError('expected col=value or col=low:high, got {!r}'.format(text))
+    if ':' in value:
+        low, high = value.split(':', 1)
+        return col, (_parse_value(low) if low else None, _parse_value(high) if high else None)
+    return col, _parse_value(value)
+
+
+def _query(args):
+    import crawler.query
+    with crawler.query.Dataset(args.category, args.version) as dataset:
+        conditions = dict(args.where)
+        if args.id is not None:
+            conditions['ID'] = args.id
+        try:
+            positions = dataset.where(args.flags, **conditions)
+        except (KeyError, ValueError) as e:
+            # an unknown flag or column, or a malformed flag expression
+            args.parser.error(e.args[0])
+        if args.count:
+            print(len(positions))
+            return
+        if args.limit is not None:
+            positions = positions[:args.limit]
+        for record in dataset.records(positions, args.columns):
+            print(json.dumps(record, ensure_ascii=False, default=str))
+
+
+def _status(args):
+    import crawler.html_store
+    import crawler.utils
+    print('html store:')
+    for category_key in crawler.utils.CATEGORY_KEYS:
+        for version_key in crawler.utils.VERSION_KEYS:
+            if crawler.html_store.store_exists(category_key, version_key):
+                pages_path, index_path = crawler.html_store.store_paths(category_key, version_key)
+                with crawler.html_store.open_store(category_key, version_key) as store:
+                    n_pages = len(store)
+                print('  {:<16}{:<10}{:>8} pages {:10.1f} MB  {}'.format(
+                    category_key, version_key, n_pages, pages_path.stat().st_size / 2 ** 20,
+                    time.strftime('%Y-%m-%d %H:%M', time.localtime(pages_path.stat().st_mtime))))
+        age = crawler.html_store.checkpoint_age(category_key)
+        if age is not None:
+            print('  {:<16}{:<10} written {:.0f}s ago, will be resumed'.format(category_key, 'checkpoint', age))
+    print('exported tables:')
+    for version_key, paths in crawler.utils.filepath_tree('final', '.feather').items():
+        for category_key, path in paths.items():
+            if path.exists():
+                print('  {:<16}{:<10}{:10.1f} MB  {}'.format(
+                    category_key, version_key, path.stat().st_size / 2 ** 20,
+                    time.strftime('%Y-%m-%d %H:%M', time.localtime(path.stat().st_mtime))))
+
+
+def _changes(args):
+    import crawler.diff
+    if args.snapshots:
+        _, summaries = crawler.diff.snapshot_changes(args.category)
+        for version, summary in summaries.items():
+            print(json.dumps({'version': version, **summary}))
+        return
+    import crawler.utils
+    diff = crawler.diff.diff_tables(crawler.utils.read_data(args.category, 'previous'),
+                                    crawler.utils.read_data(args.category))
+    if args.log:
+        for row in diff.changes.itertuples(index=False):
+            print(json.dumps(row._asdict(), ensure_ascii=False, default=str))
+    else:
+        print(json.dumps(crawler.diff.summarize(diff)))
+
+
+def _bench(args):
+    if args.suite == 'load':
+        import crawler.loadtest
+        crawler.loadtest.main(args.arguments)
+    else:
+        import crawler.benchmark
+        crawler.benchmark.main(args.arguments + (['--codecs'] if args.suite == 'codecs' else []))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m crawler', description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+
+    crawl = subparsers.add_parser('crawl', help='download the site and export the dataset')
+    crawl.add_argument('--no-update-html-store', dest='update_html_store', action='store_false',
+                       help="don't save the downloaded pages in the html store")
+    crawl.add_argument('--incremental', action='store_true',
+                       help='only download the player pages of new players and players whose overview changed')
+    crawl.add_argument('--workers', type=int, help='concurrent downloads')
+    crawl.add_argument('--shard-workers', type=int,
+                       help='crawl in shards with this many local worker processes; 0 to only use workers '
+                            'started elsewhere with the worker command')
+    crawl.add_argument('--shard-dir', help='directory of the shard queue and outputs, defaults to data/shards; '
+                                           'put it on a shared file system to run workers on other machines')
+    _add_export_arguments(crawl)
+    crawl.set_defaults(handler=_crawl)
+
+    worker = subparsers.add_parser('worker', help='work on the shards of a crawl started with --shard-workers')
+    worker.add_argument('--shard-dir', help='the shard directory of the crawl, defaults to data/shards')
+    worker.add_argument('--lease-seconds', type=float,
+                        help='defaults to 300, the time after which a shard whose worker stopped renewing '
+                             'it is handed out again')
+    worker.add_argument('--workers', type=int, help='concurrent downloads')
+    worker.add_argument('--processes', type=int, help='parse worker processes, defaults to the number of cpus')
+    worker.set_defaults(handler=_worker)
+
+    editions = subparsers.add_parser('editions', help='crawl past editions of the game into data/editions')
+    editions.add_argument('editions', nargs='+', metavar='edition',
+                          help='version, e.g. 16, or version@roster update, e.g. 16@158000')
+    editions.add_argument('--base-url', help='site to crawl instead of sofifa')
+    editions.add_argument('--engine', default=DEFAULT_ENGINE, choices=ENGINES)
+    editions.add_argument('--no-archive', dest='archive', action='store_false',
+                          help="don't add the complete tables to the editions snapshot archive")
+    editions.add_argument('--parallel', type=int, default=3, help='editions downloaded at once')
+    editions.add_argument('--workers', type=int, help='concurrent downloads per edition')
+    editions.add_argument('--processes', type=int, help='parse worker processes, defaults to the number of cpus')
+    editions.set_defaults(handler=_editions)
+
+    parse = subparsers.add_parser('parse', help='rebuild and export the dataset from the html store')
+    parse.add_argument('--no-parse-cache', dest='parse_cache', action='store_false',
+                       help='parse every page again instead of reusing cached results')
+    _add_export_arguments(parse)
+    parse.set_defaults(handler=_parse)
+
+    export = subparsers.add_parser('export', help='rewrite the exports, query stores and similarity indexes '
+                                                  'of the current tables')
+    export.add_argument('categories', nargs='*', default=['overview', 'player', 'league', 'complete'],
+                        metavar='category')
+    export.add_argument('--no-parquet', dest='parquet', action='store_false', help="don't export Parquet datasets")
+    export.add_argument('--partition-by-nationality', action='store_true',
+                        help='partition the Parquet datasets by nationality within each league')
+    export.set_defaults(handler=_export)
+
+    assets = subparsers.add_parser('assets', help='mirror the photos, flags and club logos of the current '
+                                                  'overview table into data/assets')
+    assets.add_argument('--no-refresh', dest='refresh', action='store_false',
+                        help="don't revalidate the images that are already mirrored")
+    assets.add_argument('--workers', type=int, help='concurrent downloads')
+    _add_cdn_argument(assets)
+    assets.set_defaults(handler=_assets)
+
+    constants = subparsers.add_parser('constants', help='download the constants again')
+    constants.set_defaults(handler=_constants)
+
+    query = subparsers.add_parser('query', help='look up rows of an exported table, as JSON lines')
+    query.add_argument('--where', nargs='+', type=_parse_condition, default=[], metavar='COL=VALUE',
+                       help='conditions on indexed columns, col=value or col=low:high')
+    query.add_argument('--flags', help="traits, specialities and position preferences, e.g. "
+                                       "'finesse_shot_trait AND (prefers_st OR prefers_cf)'")
+    query.add_argument('--id', type=int, help='player ID')
+    query.add_argument('--columns', nargs='+', help='columns to print, defaults to all')
+    query.add_argument('--limit', type=int)
+    query.add_argument('--count', action='store_true', help='only print the number of matching rows')
+    query.add_argument('--category', default='complete')
+    query.add_argument('--version', default='current', choices=['current', 'previous'])
+    query.set_defaults(handler=_query, parser=query)
+
+    status = subparsers.add_parser('status', help='summarise the html store and the exported tables')
+    status.set_defaults(handler=_status)
+
+    changes = subparsers.add_parser('changes', help='summarise what changed between the previous and current '
+                                                    'tables, as JSON')
+    changes.add_argument('--category', default='complete')
+    changes.add_argument('--log', action='store_true', help='print every changed cell instead of the counts')
+    changes.add_argument('--snapshots', action='store_true',
+                         help='summarise each version of the snapshot archive against the one before it')
+    changes.set_defaults(handler=_changes)
+
+    bench = subparsers.add_parser('bench', help='run crawler.benchmark or crawler.loadtest')
+    bench.add_argument('suite', choices=['parse', 'codecs', 'load'],
+                       help='parse and export stages, storage codecs, or the download load test')
+    bench.add_argument('arguments', nargs=argparse.REMAINDER, help='passed on to the benchmark')
+    bench.set_defaults(handler=_bench)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
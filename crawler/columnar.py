@@ -0,0 +1,56 @@
+"""Typed column buffers for sending parsed records from worker processes.
+
+Workers turn a chunk of record dicts into one Arrow record batch, serialised with the
+Arrow IPC stream format. Only these bytes cross the process boundary, instead of one
+pickled dict (with all its repeated keys) per record. The parent concatenates the
+batches without copying and converts to a DataFrame once. Workers that convert their
+records themselves send a typed table instead (see table_to_ipc and crawler.schema.to_arrow).
+"""
+import math
+
+import pyarrow as pa
+
+
+def _string_or_none(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return str(value)
+
+
+def _column_values(records, name, arrow_type):
+    values = [record.get(name) for record in records]
+    if pa.types.is_string(arrow_type):
+        return [_string_or_none(value) for value in values]
+    if pa.types.is_boolean(arrow_type) or pa.types.is_integer(arrow_type):
+        return [None if value is None or value != value else value for value in values]
+    return values
+
+
+def records_to_batch(records, schema):
+    """Builds a record batch with the columns of schema. Keys that are not in schema are dropped."""
+    arrays = [pa.array(_column_values(records, field.name, field.type), type=field.type)
+              for field in schema]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def records_to_ipc(records, schema):
+    return table_to_ipc(pa.Table.from_batches([records_to_batch(records, schema)]))
+
+
+def table_to_ipc(table):
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def ipc_to_table(buffers, schema):
+    tables = [pa.ipc.open_stream(pa.py_buffer(buffer)).read_all() for buffer in buffers]
+    if not tables:
+        return schema.empty_table()
+    return pa.concat_tables(tables)
+
+
+def ipc_to_frame(buffers, schema):
+    """Concatenates IPC buffers from records_to_ipc into a single DataFrame."""
+    return ipc_to_table(buffers, schema).to_pandas()
@@ -4,11 +4,13 @@ import numpy as np
 import requests
 import parsel
 
-from crawler.utils import parse_headline_attributes, CURRENT_PATH, PREVIOUS_PATH
+import crawler.utils
+from crawler.html_download import edition_url
+from crawler.utils import parse_headline_attributes, constants_path, CURRENT_PATH, PREVIOUS_PATH
 
 
-def get_all_traits_and_specialities():
-    url = 'https://sofifa.com/players/top'
+def get_all_traits_and_specialities(edition=None):
+    url = edition_url(crawler.utils.BASE_URL + '/players/top', edition)
     html = requests.get(url).text
     selector = parsel.Selector(html)
     path = './body/section[1]/section[1]/aside[1]/form[1]/div[last()]/div[position() >= last() - 2]/select'
@@ -24,8 +26,8 @@ def get_all_traits_and_specialities():
     all_specialities = [s.strip() + '_speciality' for s in specialities_raw]
     return {'traits': all_traits, 'specialities': all_specialities}
 
-def get_headline_attribute_names():
-    url = 'https://sofifa.com/player/158023'
+def get_headline_attribute_names(edition=None):
+    url = edition_url(crawler.utils.BASE_URL + '/player/158023', edition)
     html = requests.get(url).text
     # below is a hacky way to get a selector that fits the parse_headline_attributes function
     script_html = parsel.Selector(text=html).xpath('/html/body/script[1]').extract_first()
@@ -34,7 +36,9 @@ def get_headline_attribute_names():
 
 
 
-def get_all_constants():
+def get_all_constants(edition=None):
+    """The constants of the current data, or of a crawler.utils.Edition, whose traits and
+    specialities differ from the current ones."""
     positions = ['RS', 'RW', 'RF', 'RAM', 'RCM', 'RM', 'RDM', 'RCB', 'RB',
                  'RWB', 'ST', 'LW', 'CF', 'CAM', 'CM', 'LM', 'CDM', 'CB',
                  'LB', 'LWB', 'LS', 'LF', 'LAM', 'LCM', 'LDM', 'LCB', 'GK']
@@ -48,8 +52,8 @@ def get_all_constants():
                        'Sliding tackle','GK diving','GK handling','GK kicking',
                        'GK positioning','GK reflexes',]
     position_preferences = ['prefers_' + pos for pos in positions]
-    traits_specialities_dict = get_all_traits_and_specialities()
-    headline_attribute_names = get_headline_attribute_names()
+    traits_specialities_dict = get_all_traits_and_specialities(edition)
+    headline_attribute_names = get_headline_attribute_names(edition)
     body_features = ['Height_cm', 'Weight_kg', 'Body type', 'Real face']
     special_attributes = ['International reputation', 'Skill moves',
                           'Weak foot', 'Work rate att', 'Work rate def',
@@ -68,9 +72,10 @@ def get_all_constants():
                       **traits_specialities_dict}
     return constants_dict
 
-def save_constants():
-    path = CURRENT_PATH
-    constants_dict = get_all_constants()
+def save_constants(edition=None):
+    path = constants_path(edition)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    constants_dict = get_all_constants(edition)
     with open(path, 'w') as f:
         json.dump(constants_dict, f)
 
@@ -0,0 +1,220 @@
+"""Change log between two versions of a table: what changed for which player.
+
+    diff = diff_tables(read_data('complete', 'previous'), read_data('complete'))
+    diff.changes  # one (ID, column, old, new) row per changed cell
+    summarize(diff)  # {'added': 12, 'removed': 9, 'changed': 4380, 'transfers': 211, ...}
+
+The tables are aligned on ID once, and each column is compared as a whole with numpy:
+categorical columns by their codes (remapped when the categories differ), numbers and
+dates by value and strings as objects, with missing values equal to each other. Only the
+cells that changed are converted to strings for the log, so the log is small and the
+comparison doesn't depend on how many columns there are.
+
+snapshot_changes does the same along the versions of a crawler.snapshots archive. Only
+the rows the archive stored for a version are compared with their previous rows, and the
+change log of each version is kept next to it, so a longer chain only costs the versions
+that were added since the last call.
+
+A crawl that moves the previous tables aside writes the change log of the complete table
+to data/final/current/changes.feather (and .csv), with the summary in changes.json.
+"""
+import collections
+import json
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import crawler.flags
+import crawler.metrics
+import crawler.snapshots
+from crawler.utils import DATA_DIR, read_data
+
+CHANGE_LOG_COLUMNS = ['ID', 'column', 'old', 'new']
+# summary counts of the players with a change in any of the columns
+EVENT_COLUMNS = {'rating_moves': ['overall', 'potential'],
+                 'transfers': ['club'],
+                 'value_changes': ['eur_value'],
+                 'wage_changes': ['eur_wage']}
+
+Diff = collections.namedtuple('Diff', ['changes', 'added', 'removed'])
+
+
+def _change_log_path(extension, version_key='current'):
+    return (DATA_DIR / 'final' / version_key / 'changes').with_suffix(extension)
+
+
+def _comparable(old, new):
+    """The values of two aligned columns as arrays that can be compared with !=."""
+    if isinstance(old.dtype, pd.CategoricalDtype) and isinstance(new.dtype, pd.CategoricalDtype):
+        old_codes = old.cat.codes.to_numpy()
+        if not old.cat.categories.equals(new.cat.categories):
+            # categories that aren't in new become -2, which no code of new is equal to
+            remapped = new.cat.categories.get_indexer(old.cat.categories)
+            remapped[remapped < 0] = -2
+            old_codes = np.where(old_codes >= 0, remapped[old_codes], -1)
+        return old_codes, new.cat.codes.to_numpy()
+    if pd.api.types.is_datetime64_any_dtype(old) and pd.api.types.is_datetime64_any_dtype(new):
+        return old.to_numpy().view('int64'), new.to_numpy().view('int64')
+    numeric = [pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values) for values in (old, new)]
+    if all(numeric):
+        if any(pd.api.types.is_integer_dtype(values) and values.dtype.itemsize == 8 for values in (old, new)):
+            # bitmasks (see crawler.flags), whose high bits wouldn't survive float64
+            dtype, na_value = 'uint64' if pd.api.types.is_unsigned_integer_dtype(old) else 'int64', 0
+        else:
+            dtype, na_value = 'float64', np.nan
+        return old.to_numpy(dtype=dtype, na_value=na_value), new.to_numpy(dtype=dtype, na_value=na_value)
+    return old.to_numpy(dtype=object), new.to_numpy(dtype=object)
+
+
+def _changed(old, new):
+    """Bool array of the rows whose values differ, missing values being equal to each other."""
+    old_missing, new_missing = old.isna().to_numpy(), new.isna().to_numpy()
+    old_values, new_values = _comparable(old, new)
+    changed = old_values != new_values
+    either_missing = old_missing | new_missing
+    if either_missing.any():
+        changed[either_missing] = old_missing[either_missing] != new_missing[either_missing]
+    return changed
+
+
+def _as_strings(values):
+    """The values as an object array of strings, and None for missing values."""
+    # ratings and categories repeat a lot, so each distinct value is only formatted once
+    codes, uniques = pd.factorize(values)
+    return np.append(np.asarray(uniques.astype(str), dtype=object), None)[codes]
+
+
+def diff_tables(old, new, columns=None):
+    """The Diff of two tables with unique ID columns: the change log of the players in both
+    (see CHANGE_LOG_COLUMNS, with old and new as strings or None when missing), sorted by ID
+    in column order, and the arrays of added and removed IDs.
+    columns defaults to the columns both tables have."""
+    if columns is None:
+        columns = [col for col in new.columns if col in old.columns and col != 'ID']
+    old_IDs, new_IDs = old['ID'].to_numpy(), new['ID'].to_numpy()
+    IDs, old_positions, new_positions = np.intersect1d(old_IDs, new_IDs, assume_unique=True, return_indices=True)
+    # one take per table rather than per column, skipped when the rows are already aligned
+    if not np.array_equal(old_positions, np.arange(len(old))):
+        old = old.iloc[old_positions]
+    if not np.array_equal(new_positions, np.arange(len(new))):
+        new = new.iloc[new_positions]
+    ID_parts, column_parts, old_parts, new_parts = [], [], [], []
+    for code, col in enumerate(columns):
+        positions = np.flatnonzero(_changed(old[col], new[col]))
+        if len(positions):
+            ID_parts.append(IDs[positions])
+            column_parts.append(np.full(len(positions), code, dtype='int16'))
+            old_parts.append(_as_strings(old[col].iloc[positions]))
+            new_parts.append(_as_strings(new[col].iloc[positions]))
+    if ID_parts:
+        changed_IDs, codes = np.concatenate(ID_parts), np.concatenate(column_parts)
+        order = np.lexsort((codes, changed_IDs))
+        changes = pd.DataFrame({'ID': changed_IDs[order],
+                                'column': pd.Categorical.from_codes(codes[order], categories=columns),
+                                'old': np.concatenate(old_parts)[order],
+                                'new': np.concatenate(new_parts)[order]})
+    else:
+        changes = pd.DataFrame({'ID': IDs[:0], 'column': pd.Categorical([], categories=columns),
+                                'old': np.array([], dtype=object), 'new': np.array([], dtype=object)})
+    return Diff(changes,
+                np.setdiff1d(new_IDs, old_IDs, assume_unique=True),
+                np.setdiff1d(old_IDs, new_IDs, assume_unique=True))
+
+
+def summarize(diff):
+    """Counts of the added, removed and changed players, of the changed cells by column and of
+    the players with each kind of change in EVENT_COLUMNS."""
+    changes = diff.changes
+    counts = changes['column'].value_counts(sort=False)
+    summary = {'added': len(diff.added),
+               'removed': len(diff.removed),
+               'changed': int(changes['ID'].nunique()),
+               'columns': {str(col): int(n) for col, n in counts.items() if n}}
+    for event, cols in EVENT_COLUMNS.items():
+        summary[event] = int(changes.loc[changes['column'].isin(cols), 'ID'].nunique())
+    return summary
+
+
+def update_change_log(data, category_key='complete'):
+    """Writes the change log from the previous export of category_key to data, and its summary,
+    next to the current tables; see the module docstring. Returns the summary, or None if there
+    is no previous export."""
+    try:
+        previous = read_data(category_key, 'previous')
+    except FileNotFoundError:
+        return None
+    # exports from before the flags were packed have a bool column per flag
+    diff = diff_tables(crawler.flags.to_packed(previous), data)
+    summary = summarize(diff)
+    diff.changes.to_feather(str(_change_log_path('.feather')))
+    diff.changes.to_csv(str(_change_log_path('.csv')), index=False, encoding='utf_8')
+    with open(_change_log_path('.json'), 'w', encoding='utf_8') as f:
+        json.dump({**summary, 'added_IDs': diff.added.tolist(), 'removed_IDs': diff.removed.tolist()}, f)
+    for key in ['added', 'removed', 'changed', *EVENT_COLUMNS]:
+        crawler.metrics.gauge('changes.' + key, summary[key])
+    return summary
+
+
+def read_change_log(version_key='current'):
+    return pd.read_feather(str(_change_log_path('.feather', version_key)))
+
+
+def _snapshot_change_path(category_key, position):
+    return crawler.snapshots._archive_dir(category_key) / '{:04d}.changes.parquet'.format(position)
+
+
+def _snapshot_diff(category_key, position, versions, index):
+    """The Diff between the versions at position - 1 and position, from the rows stored for position."""
+    old_order = np.load(crawler.snapshots._order_path(category_key, position - 1))
+    new_order = np.load(crawler.snapshots._order_path(category_key, position))
+    stored_IDs = index.loc[index['version'] == position, 'ID'].to_numpy()
+    # the rows of players that were in the previous version and whose row changed
+    IDs = np.intersect1d(stored_IDs, old_order)
+    columns = [col for col in versions[position]['columns']
+               if col in versions[position - 1]['columns'] and col != 'ID']
+    if len(IDs):
+        previous = index[(index['version'] < position) & index['ID'].isin(IDs)].drop_duplicates('ID', keep='last')
+        old = pd.concat([crawler.snapshots._read_rows(category_key, stored_position, stored)
+                         for stored_position, stored in previous.groupby('version')['ID']], ignore_index=True)
+        new = crawler.snapshots._read_rows(category_key, position, IDs)
+        diff = diff_tables(old.sort_values('ID', ignore_index=True), new, columns)
+    else:
+        diff = diff_tables(pd.DataFrame({'ID': IDs}), pd.DataFrame({'ID': IDs}), [])
+    return Diff(diff.changes,
+                np.setdiff1d(new_order, old_order, assume_unique=True),
+                np.setdiff1d(old_order, new_order, assume_unique=True))
+
+
+def snapshot_changes(category_key='complete'):
+    """The change log of every version of the snapshot archive of category_key compared to the
+    one before it, with a version column, and {version: summary}. Each version's change log
+    is computed once and stored in the archive."""
+    versions = crawler.snapshots.read_versions(category_key)
+    index = None
+    frames, summaries = [], {}
+    for position in range(1, len(versions)):
+        path = _snapshot_change_path(category_key, position)
+        if path.exists():
+            table = pq.read_table(path)
+            summary = json.loads(table.schema.metadata[b'summary'])
+            changes = table.to_pandas()
+        else:
+            if index is None:
+                index = crawler.snapshots.read_index(category_key)
+            diff = _snapshot_diff(category_key, position, versions, index)
+            summary = summarize(diff)
+            changes = diff.changes
+            table = pa.Table.from_pandas(changes, preserve_index=False)
+            pq.write_table(table.replace_schema_metadata({**table.schema.metadata,
+                                                          b'summary': json.dumps(summary).encode()}),
+                           path, compression='zstd')
+        name = versions[position]['version']
+        frames.append(changes.assign(version=name))
+        summaries[name] = summary
+    if not frames:
+        return pd.DataFrame(columns=['version', *CHANGE_LOG_COLUMNS]), summaries
+    # the columns of each version are categories of their own
+    changes = pd.concat([frame.astype({'column': str}) for frame in frames], ignore_index=True)
+    return changes[['version', *CHANGE_LOG_COLUMNS]].astype({'version': 'category', 'column': 'category'}), summaries
@@ -0,0 +1,235 @@
+import asyncio
+import collections
+import random
+import threading
+
+import aiohttp
+
+import crawler.metrics
+
+N_WORKERS = 100
+# requests in flight at once across every download of the process, e.g. the concurrent
+# stages of a crawl, each with its own event loop; None means N_WORKERS
+MAX_REQUESTS = None
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0  # seconds
+BACKOFF_CAP = 60.0  # seconds
+REQUEST_TIMEOUT = 60  # seconds
+
+_RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# passed to on_page instead of the html when a conditional request returns 304
+NOT_MODIFIED = object()
+_END = object()  # tells a worker that there are no more urls
+
+
+class RetryableStatus(Exception):
+    def __init__(self, url, status, retry_after=None):
+        super().__init__('{} returned HTTP {}'.format(url, status))
+        self.status = status
+        self.retry_after = retry_after
+
+
+class DownloadError(Exception):
+    """Raised when some urls still fail after all retries.
+
+    failures maps each failed url to the last exception raised for it."""
+
+    def __init__(self, failures):
+        super().__init__('{} url(s) could not be downloaded, e.g. {}'.format(
+            len(failures), next(iter(failures))))
+        self.failures = failures
+
+
+class _RequestBudget:
+    """Semaphore of MAX_REQUESTS slots shared by the event loops of all threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._waiters = collections.deque()
+
+    async def __aenter__(self):
+        with self._lock:
+            if not self._waiters and self._in_use < (MAX_REQUESTS or N_WORKERS):
+                self._in_use += 1
+                return
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    waiter = None
+            if waiter is not None and waiter.done() and not waiter.cancelled():
+                self._release()
+            raise
+
+    async def __aexit__(self, *exc_info):
+        self._release()
+
+    def _release(self):
+        with self._lock:
+            if not self._waiters:
+                self._in_use -= 1
+                return
+            # the slot goes straight to the next waiter, in whichever loop it is waiting
+            waiter = self._waiters.popleft()
+        try:
+            waiter.get_loop().call_soon_threadsafe(self._hand_over, waiter)
+        except RuntimeError:
+            # its loop has been closed
+            self._release()
+
+    def _hand_over(self, waiter):
+        if waiter.done():
+            # cancelled in the meantime
+            self._release()
+        else:
+            waiter.set_result(None)
+
+
+_budget = _RequestBudget()
+
+
+def _backoff_delay(attempt, backoff_base, backoff_cap):
+    # exponential backoff with "full jitter"
+    return random.uniform(0, min(backoff_cap, backoff_base * 2 ** attempt))
+
+
+def _retry_after_seconds(response):
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _conditional_headers(validator):
+    headers = {}
+    if validator.get('etag'):
+        headers['If-None-Match'] = validator['etag']
+    if validator.get('last_modified'):
+        headers['If-Modified-Since'] = validator['last_modified']
+    return headers
+
+
+def _response_validator(response):
+    return {'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified')}
+
+
+async def _fetch(session, url, validators, binary=False):
+    headers = _conditional_headers(validators.get(url, {}))
+    async with _budget, session.get(url, headers=headers) as response:
+        if response.status == 304:
+            crawler.metrics.increment('pages_not_modified')
+            return NOT_MODIFIED
+        if response.status in _RETRYABLE_STATUSES:
+            raise RetryableStatus(url, response.status, _retry_after_seconds(response))
+        response.raise_for_status()
+        body = await response.read()
+        html = body if binary else await response.text()
+        crawler.metrics.increment('pages_fetched')
+        crawler.metrics.increment('bytes_downloaded', len(body))
+        validator = _response_validator(response)
+        if any(validator.values()):
+            validators[url] = validator
+        else:
+            validators.pop(url, None)
+        return html
+
+
+async def _fetch_with_retries(session, url, validators, max_retries, backoff_base, backoff_cap, binary=False):
+    attempt = 0
+    while True:
+        try:
+            return await _fetch(session, url, validators, binary)
+        except (RetryableStatus, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if isinstance(e, aiohttp.ClientResponseError) or attempt >= max_retries:
+                raise
+            delay = _backoff_delay(attempt, backoff_base, backoff_cap)
+            if getattr(e, 'retry_after', None):
+                delay = max(delay, e.retry_after)
+            attempt += 1
+            crawler.metrics.increment('retries')
+            await asyncio.sleep(delay)
+
+
+async def _worker(session, queue, on_page, failures, validators, retry_kwargs):
+    while True:
+        url = await queue.get()
+        if url is _END:
+            return
+        try:
+            html = await _fetch_with_retries(session, url, validators, **retry_kwargs)
+            result = on_page(url, html)
+            if asyncio.iscoroutine(result):
+                # lets on_page apply backpressure to the downloads
+                await result
+        except Exception as e:
+            crawler.metrics.increment('download_failures')
+            failures[url] = e
+
+
+async def download_async(urls, on_page, validators=None, n_workers=None, max_retries=MAX_RETRIES,
+                         backoff_base=BACKOFF_BASE, backoff_cap=BACKOFF_CAP, request_timeout=REQUEST_TIMEOUT,
+                         binary=False, url_batches=None):
+    """Coroutine version of download. on_page may also be a coroutine function, in which
+    case the worker that fetched the page waits for it before fetching the next url.
+    url_batches is an optional async iterable of lists of urls that are downloaded after
+    urls as they arrive, by the same workers and session."""
+    if not urls and url_batches is None:
+        return {}
+    n_workers = n_workers or N_WORKERS
+    if validators is None:
+        validators = {}
+    retry_kwargs = {'max_retries': max_retries,
+                    'backoff_base': backoff_base,
+                    'backoff_cap': backoff_cap,
+                    'binary': binary}
+    queue = asyncio.Queue()
+    for url in urls:
+        queue.put_nowait(url)
+    failures = {}
+    connector = aiohttp.TCPConnector(limit=n_workers)
+    timeout = aiohttp.ClientTimeout(total=request_timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        n_running = n_workers if url_batches is not None else min(n_workers, len(urls))
+        workers = [asyncio.ensure_future(_worker(session, queue, on_page, failures, validators, retry_kwargs))
+                   for _ in range(n_running)]
+        try:
+            if url_batches is not None:
+                async for batch in url_batches:
+                    for url in batch:
+                        queue.put_nowait(url)
+            for _ in workers:
+                queue.put_nowait(_END)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+    return failures
+
+
+def download(urls, on_page, validators=None, **kwargs):
+    """Downloads urls with a fixed pool of workers, calling on_page(url, html) for each page.
+
+    Failed requests are retried with exponential backoff and jitter. 4xx errors other
+    than 429 are not retried. Returns a {url: exception} dict of the urls that still
+    failed after max_retries; on_page is never called for those.
+
+    validators is an optional {url: {'etag': ..., 'last_modified': ...}} dict. Urls with
+    an entry are requested conditionally and on_page receives NOT_MODIFIED on a 304.
+    The dict is updated in place with the validators of every fresh response.
+
+    n_workers workers fetch pages at once, but the requests in flight across all the
+    downloads running in the process are capped at MAX_REQUESTS.
+
+    kwargs are passed to download_async (n_workers, max_retries, backoff_base,
+    backoff_cap, request_timeout, binary). n_workers defaults to N_WORKERS at call time.
+    With binary=True, on_page receives the body as bytes instead of decoded text.
+    """
+    return asyncio.run(download_async(urls, on_page, validators, **kwargs))
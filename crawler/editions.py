@@ -0,0 +1,319 @@
+"""Crawls past editions of the game, back to FIFA 07, and their roster updates.
+
+sofifa serves an edition's data when the urls carry its version and, optionally, the
+roster update (see crawler.html_download.edition_url). Each edition is crawled like the
+current data, with its own constants (the traits and specialities vary by edition),
+after discovering its number of overview pages, and its tables are exported to
+data/editions/<name>/ and, optionally, added to the 'editions' snapshot archive, where
+a player's unchanged rows are only stored once (see crawler.snapshots).
+
+    crawl_editions([Edition('16'), Edition('17'), Edition('18', '180084')])
+
+Most pages don't change between roster updates, and many not between editions either,
+so the fragments of every edition go into one store per category keyed by the hash of
+their content: a fragment that is already there isn't stored again, and the url of every
+page of an edition is mapped to its fragment's hash in data/editions/<name>/pages.json.
+Parse results are cached by the fragment's hash and its url without the edition
+(crawler.parse_cache), in one cache per set of constants, so a page that an earlier
+edition, roster update or run already had is not parsed again.
+
+Up to N_PARALLEL_EDITIONS editions are downloaded at once, sharing one process pool for
+the filtering and one budget of requests in flight (crawler.downloader.MAX_REQUESTS), so
+downloading more editions at once doesn't multiply the load on the site. Parsing is CPU
+bound, so the downloaded editions are parsed one at a time, as they arrive, in a pool for
+each set of constants. Those pools start while the downloads are running, from the
+forkserver of crawler.executor rather than by forking the crawler's threads.
+"""
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import json
+import threading
+
+import crawler.columnar
+import crawler.create_constants
+import crawler.downloader
+import crawler.executor
+import crawler.extraction
+import crawler.html_download
+import crawler.html_store
+import crawler.main
+import crawler.metrics
+import crawler.parse_cache
+import crawler.pipeline
+import crawler.player_data
+import crawler.scheduler
+import crawler.snapshots
+from crawler.html_download import canonical_url
+from crawler.league_data import _league_clubs_to_df
+from crawler.overview_data import _overview_rows_to_df, clean_overview_data
+from crawler.utils import DATA_DIR, DEFAULT_ENGINE, Edition, constants_path, edition_name, read_constants
+
+EDITION_DIR = DATA_DIR / 'editions'
+FRAGMENT_DIR = EDITION_DIR / 'fragments'
+N_PARALLEL_EDITIONS = 3
+ARCHIVE_KEY = 'editions'
+CATEGORY_KEYS = ['overview', 'player', 'league_overview', 'league']
+
+
+def parse_edition(text):
+    """An Edition from '16' or, for a roster update, '16@158000'."""
+    version, _, roster = text.partition('@')
+    return Edition(version, roster or None)
+
+
+def fragment_store_paths(category_key):
+    base_path = FRAGMENT_DIR / category_key
+    return base_path.with_suffix('.pages'), base_path.with_suffix('.index')
+
+
+class FragmentStore:
+    """The fragments of one category for every edition, keyed by the hash of their JSON
+    encoding. Appends to the store on disk; use as a context manager. Thread safe."""
+
+    def __init__(self, category_key):
+        pages_path, index_path = fragment_store_paths(category_key)
+        self._keys = set()
+        if pages_path.exists():
+            with crawler.html_store.PageStore(pages_path, index_path) as store:
+                self._keys.update(store.keys())
+        self._writer = crawler.html_store.PageStoreWriter(pages_path, index_path, append=True,
+                                                          codec=crawler.html_store.codec_for(category_key))
+        self._lock = threading.Lock()
+        self.n_new = self.n_duplicates = 0
+
+    def put(self, fragment):
+        """Stores fragment unless an identical one is already stored, and returns its key."""
+        fragment_bytes = json.dumps(fragment).encode()
+        key = hashlib.blake2b(fragment_bytes, digest_size=16).hexdigest()
+        with self._lock:
+            if key in self._keys:
+                self.n_duplicates += 1
+            else:
+                self._writer.write_raw(key, self._writer.codec.encode(fragment_bytes))
+                self._keys.add(key)
+                self.n_new += 1
+        return key
+
+    def flush(self):
+        with self._lock:
+            self._writer.flush()
+
+    def close(self):
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _pages_path(edition):
+    return EDITION_DIR / edition_name(edition) / 'pages.json'
+
+
+def read_edition_pages(edition, category_key):
+    """{url: fragment} of the pages of an edition that were crawled for category_key."""
+    with open(_pages_path(edition), 'r', encoding='utf_8') as f:
+        keys = json.load(f)[category_key]
+    with crawler.html_store.PageStore(*fragment_store_paths(category_key)) as store:
+        return {url: store.get(key) for url, key in keys.items()}
+
+
+def _download_pages(urls, page_func, store, pool):
+    """Downloads urls and puts their fragments in store. Returns ({url: fragment key},
+    {url: what page_func parsed})."""
+    keys, parsed = {}, {}
+
+    def on_chunk(chunk_urls, fragments, collected):
+        for url, fragment, result in zip(chunk_urls, fragments, collected):
+            keys[url] = store.put(fragment)
+            parsed[url] = result
+
+    failures = crawler.pipeline.run_pipeline(urls, page_func, on_chunk, pool=pool)
+    if failures:
+        raise crawler.downloader.DownloadError(failures)
+    return {url: keys[url] for url in urls}, {url: parsed[url] for url in urls}
+
+
+def _download_edition(edition, engine, stores, pool):
+    """Downloads the pages of an edition. The overview and league overview pages are parsed
+    on the way, for the player and league IDs; the others are only filtered."""
+    page_functions = {category_key: crawler.extraction.get_page_functions(category_key, engine)
+                      for category_key in CATEGORY_KEYS}
+
+    def filter_only(category_key):
+        return functools.partial(crawler.html_download._filter_only, page_functions[category_key].filter_page)
+
+    name = edition_name(edition)
+    with crawler.metrics.span(name + '/discover'):
+        n_pages = crawler.html_download.discover_n_overview_pages(page_functions['overview'], edition)
+    with crawler.metrics.span(name + '/download'):
+        keys = {}
+        keys['overview'], overview_rows = _download_pages(crawler.html_download.get_overview_urls(edition, n_pages),
+                                                          page_functions['overview'].extract_page,
+                                                          stores['overview'], pool)
+        IDs = list(dict.fromkeys(row['ID'] for rows in overview_rows.values() for row in rows))
+        keys['player'], _ = _download_pages(crawler.html_download.get_player_urls(IDs, edition),
+                                            filter_only('player'), stores['player'], pool)
+        league_overview_url = crawler.html_download.get_league_overview_url(edition)
+        keys['league_overview'], league_IDs = _download_pages([league_overview_url],
+                                                              page_functions['league_overview'].extract_page,
+                                                              stores['league_overview'], pool)
+        league_IDs = league_IDs[league_overview_url]
+        keys['league'], _ = _download_pages(crawler.html_download.get_league_urls(league_IDs, edition),
+                                            filter_only('league'), stores['league'], pool)
+    crawler.metrics.gauge('pages.' + name, sum(len(category_keys) for category_keys in keys.values()))
+    # so the parse stage can read the fragments
+    for store in stores.values():
+        store.flush()
+    _pages_path(edition).parent.mkdir(parents=True, exist_ok=True)
+    with open(_pages_path(edition), 'w', encoding='utf_8') as f:
+        json.dump(keys, f)
+    return {'edition': edition, 'keys': keys, 'overview_rows': list(overview_rows.values()),
+            'league_IDs': league_IDs}
+
+
+def _download_editions(editions, engine, downloaded, n_parallel):
+    """Downloads editions, n_parallel at a time, putting each on the downloaded stream as it finishes."""
+    parent_spans = crawler.metrics.stack()
+
+    def download(edition):
+        with crawler.metrics.inherit(parent_spans):
+            return _download_edition(edition, engine, stores, pool)
+
+    with contextlib.ExitStack() as stack:
+        stores = {category_key: stack.enter_context(FragmentStore(category_key)) for category_key in CATEGORY_KEYS}
+        # filtering and parsing the overview pages doesn't read the constants
+        pool = stack.enter_context(crawler.executor.create_pool())
+        executor = stack.enter_context(concurrent.futures.ThreadPoolExecutor(n_parallel))
+        futures = [executor.submit(download, edition) for edition in editions]
+        for future in concurrent.futures.as_completed(futures):
+            downloaded.put([future.result()])
+    for category_key, store in stores.items():
+        crawler.metrics.increment('fragments_new.' + category_key, store.n_new)
+        crawler.metrics.increment('fragments_duplicate.' + category_key, store.n_duplicates)
+
+
+def _constants_key(constants):
+    return hashlib.blake2b(json.dumps(constants, sort_keys=True).encode(), digest_size=8).hexdigest()
+
+
+def _parse_fragments(keys, category_key, page_functions, cache, pool, collect_func=None):
+    """Parses the stored fragments of {url: fragment key}, as if they were at the canonical urls,
+    loading the results that cache already has. Returns {canonical url: parsed page}, or the
+    list of collect_func results if it is given."""
+    results = {}
+    collected_chunks = []
+
+    def on_chunk(chunk_urls, fragments, collected):
+        collected, pickles = collected
+        cache.put_many((cache_keys[url], pickled) for url, pickled in zip(chunk_urls, pickles) if pickled is not None)
+        if collect_func is None:
+            results.update(zip(chunk_urls, collected))
+        else:
+            collected_chunks.append(collected)
+
+    cache_keys = {}
+
+    def pages(store):
+        for url, key in keys.items():
+            url = canonical_url(url)
+            fragment_bytes = store.get_bytes(key)
+            cache_keys[url] = crawler.parse_cache.fragment_hash(url, fragment_bytes)
+            yield url, crawler.parse_cache.cached_page(cache, cache_keys[url], fragment_bytes)
+
+    hits, misses = cache.hits, cache.misses
+    with crawler.html_store.PageStore(*fragment_store_paths(category_key)) as store:
+        crawler.pipeline.run_pipeline(
+            [], page_functions.extract_page, on_chunk, fragments=pages(store),
+            fragment_func=functools.partial(crawler.parse_cache.parse_or_load, page_functions.parse_fragment),
+            collect_func=functools.partial(crawler.parse_cache.collect_with_pickles, collect_func), pool=pool)
+    crawler.metrics.increment('parse_cache_hits.' + category_key, cache.hits - hits)
+    crawler.metrics.increment('parse_cache_misses.' + category_key, cache.misses - misses)
+    return collected_chunks if collect_func is not None else results
+
+
+def _parse_edition(downloaded, engine, stack, pools, caches):
+    """The overview, player, league and complete tables of a downloaded edition. pools and caches
+    hold the process pool and parse caches of each set of constants, entered on stack."""
+    edition = downloaded['edition']
+    constants = read_constants(edition)
+    constants_key = _constants_key(constants)
+    if constants_key not in pools:
+        pools[constants_key] = stack.enter_context(crawler.executor.create_pool(constants))
+    pool = pools[constants_key]
+    page_functions = {category_key: crawler.extraction.get_page_functions(category_key, engine)
+                      for category_key in ['player', 'league']}
+    for category_key in page_functions:
+        if (category_key, constants_key) not in caches:
+            caches[category_key, constants_key] = stack.enter_context(crawler.parse_cache.open_cache(
+                category_key, page_functions[category_key].parse_fragment, constants, 'editions.' + constants_key))
+    buffers = _parse_fragments(downloaded['keys']['player'], 'player', page_functions['player'],
+                               caches['player', constants_key], pool,
+                               collect_func=crawler.player_data.pack_player_records)
+    player = crawler.player_data.clean_player_detailed_data(
+        crawler.columnar.ipc_to_table(buffers, crawler.player_data._player_arrow_schema(constants)).to_pandas(),
+        constants)
+    league_clubs = _parse_fragments(downloaded['keys']['league'], 'league', page_functions['league'],
+                                    caches['league', constants_key], pool)
+    overview = clean_overview_data(_overview_rows_to_df(downloaded['overview_rows']))
+    league = _league_clubs_to_df(league_clubs, downloaded['league_IDs'])
+    player = crawler.main._in_overview_order(player, overview)
+    complete = crawler.main.get_complete_data(overview, league, player, constants)
+    return {'overview': overview, 'player': player, 'league': league, 'complete': complete}
+
+
+def _parse_editions(downloaded, engine):
+    """Parses and exports the editions on the downloaded stream as they arrive. Returns {edition: complete table}."""
+    completes = {}
+    with contextlib.ExitStack() as stack:
+        pools, caches = {}, {}
+        for batch in downloaded.batches():
+            for edition_pages in batch:
+                edition = edition_pages['edition']
+                with crawler.metrics.span(edition_name(edition) + '/parse'):
+                    tables = _parse_edition(edition_pages, engine, stack, pools, caches)
+                for category_key, data in tables.items():
+                    data.to_feather(str(EDITION_DIR / edition_name(edition) / '{}.feather'.format(category_key)))
+                completes[edition] = tables['complete']
+    return completes
+
+
+def read_edition_data(edition, category_key='complete'):
+    """Reads a table exported by crawl_editions."""
+    import pandas as pd
+    return pd.read_feather(str(EDITION_DIR / edition_name(edition) / '{}.feather'.format(category_key)))
+
+
+def crawl_editions(editions, engine=DEFAULT_ENGINE, archive=True, n_parallel=N_PARALLEL_EDITIONS):
+    """Crawls editions (crawler.utils.Edition tuples) and exports their tables; see the module docstring.
+
+    Parameters
+    ----------
+    editions : the editions to crawl. Constants that haven't been saved for an edition are downloaded first.
+    engine : crawler.extraction engine.
+    archive : add the complete tables to the 'editions' snapshot archive, in the order of
+        editions, skipping the editions already in it.
+    n_parallel : number of editions downloaded at once.
+    """
+    crawler.metrics.reset()
+    with crawler.metrics.reporting(EDITION_DIR / 'metrics.json'), crawler.metrics.span('editions'):
+        for edition in editions:
+            if not constants_path(edition).exists():
+                crawler.create_constants.save_constants(edition)
+        stage = crawler.scheduler.stage
+        results = crawler.scheduler.run_stages([
+            stage('download', lambda downloaded: _download_editions(editions, engine, downloaded, n_parallel),
+                  produces=['downloaded']),
+            stage('parse', lambda downloaded: _parse_editions(downloaded, engine), streams=['downloaded'])])
+        if archive:
+            with crawler.metrics.span('archive'):
+                archived = {entry['version'] for entry in crawler.snapshots.read_versions(ARCHIVE_KEY)}
+                for edition in editions:
+                    if edition_name(edition) not in archived:
+                        crawler.snapshots.add_snapshot(results['parse'][edition], ARCHIVE_KEY,
+                                                       version=edition_name(edition))
+    return results['parse']
@@ -0,0 +1,147 @@
+"""Process pool shared by the parsers.
+
+Workers load the constants once, through the pool initializer, instead of receiving
+them with every task. Tasks are sent in chunks sized from the number of tasks and
+processes. Small batches run serially in the calling process, because starting
+workers and pickling the pages would cost more than parsing them.
+
+Pools are often started from the threads of crawler.scheduler stages while other threads
+are downloading, so the workers are started by a forkserver rather than forked from the
+crawler itself, which could copy a lock held by another thread. The server imports
+PRELOAD_MODULES once, so that starting a pool stays cheap.
+"""
+import math
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+
+import crawler.metrics
+
+N_PROCESSES = None  # None means cpu_count()
+SERIAL_THRESHOLD = 32  # batches with fewer tasks run in the calling process
+CHUNKS_PER_PROCESS = 4
+MAX_CHUNK_SIZE = 256
+PRELOAD_MODULES = ['crawler.extraction', 'crawler.parse_cache']
+
+_worker_constants = None
+# serial runs set the constants of the calling process, which other threads may be using
+_serial_lock = threading.Lock()
+
+
+def init_worker(constants, profile_interval=None):
+    global _worker_constants
+    _worker_constants = constants
+    if profile_interval:
+        crawler.metrics.start_sampling(profile_interval)
+
+
+def worker_constants():
+    """The constants passed to the executor, for use by task functions in the workers."""
+    return _worker_constants
+
+
+def resolve_n_processes(n_processes=None):
+    return n_processes or N_PROCESSES or cpu_count()
+
+
+def chunk_size(n_tasks, n_processes):
+    """Aims for CHUNKS_PER_PROCESS chunks per worker, so a slow chunk near the end
+    doesn't leave the other workers idle for long."""
+    return max(1, min(MAX_CHUNK_SIZE, math.ceil(n_tasks / (n_processes * CHUNKS_PER_PROCESS))))
+
+
+def _mp_context():
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(PRELOAD_MODULES)
+    return context
+
+
+def create_pool(constants=None, n_processes=None):
+    """A ProcessPoolExecutor whose workers can read constants through worker_constants().
+    Use as a context manager so the workers are shut down.
+    The workers are profiled if crawler.metrics.PROFILE_INTERVAL is set."""
+    return ProcessPoolExecutor(resolve_n_processes(n_processes), mp_context=_mp_context(), initializer=init_worker,
+                               initargs=(constants, crawler.metrics.PROFILE_INTERVAL))
+
+
+def _run_chunk(func, arg_tuples, collect_func):
+    results, timings = [], []
+    for args in arg_tuples:
+        start = time.perf_counter()
+        results.append(func(*args))
+        timings.append(time.perf_counter() - start)
+    if collect_func is not None:
+        results = collect_func(results)
+    crawler.metrics.flush_samples()
+    return results, timings, crawler.metrics.own_peak_rss()
+
+
+def call_serial(func, args, constants=None):
+    """Calls func(*args) in the calling process, with constants available through worker_constants()."""
+    with _serial_lock:
+        previous_constants = _worker_constants
+        init_worker(constants)
+        try:
+            return func(*args)
+        finally:
+            init_worker(previous_constants)
+
+
+def _run_serial(func, arg_tuples, collect_func, constants):
+    return call_serial(_run_chunk, (func, arg_tuples, collect_func), constants)
+
+
+def starmap(func, arg_tuples, constants=None, collect_func=None, n_processes=None,
+            serial_threshold=SERIAL_THRESHOLD, timings=None):
+    """Returns [func(*args) for args in arg_tuples], computed in worker processes.
+
+    Parameters
+    ----------
+    func : picklable function, run in the workers.
+    arg_tuples : iterable of argument tuples, one per task.
+    constants : made available to func through worker_constants().
+    collect_func : optional picklable function applied in the worker to the list of results
+        of each chunk, e.g. to pack them into columns. If given, the list of its return
+        values is returned instead, one per chunk.
+    n_processes : number of worker processes, defaults to N_PROCESSES.
+    serial_threshold : batches with fewer tasks run in the calling process.
+    timings : optional list, extended with the seconds taken by each task in order.
+    """
+    arg_tuples = list(arg_tuples)
+    n_processes = resolve_n_processes(n_processes)
+    if len(arg_tuples) < serial_threshold or n_processes == 1:
+        chunk_outputs = [_run_serial(func, arg_tuples, collect_func, constants)]
+    else:
+        size = chunk_size(len(arg_tuples), n_processes)
+        chunks = [arg_tuples[i:i + size] for i in range(0, len(arg_tuples), size)]
+        with create_pool(constants, n_processes) as pool:
+            chunk_outputs = list(pool.map(_run_chunk, [func] * len(chunks), chunks,
+                                          [collect_func] * len(chunks)))
+    output = []
+    for results, task_timings, worker_rss in chunk_outputs:
+        crawler.metrics.record_worker_rss(worker_rss)
+        if collect_func is None:
+            output.extend(results)
+        else:
+            output.append(results)
+        if timings is not None:
+            timings.extend(task_timings)
+    return output
+
+
+def map_tasks(func, items, **kwargs):
+    """Like starmap, for a function of one argument."""
+    return starmap(func, ((item,) for item in items), **kwargs)
+
+
+def summarise_timings(timings):
+    """Task count, total, mean and max seconds of a timings list filled in by starmap or
+    crawler.pipeline.run_pipeline."""
+    if not timings:
+        return {'n_tasks': 0, 'total': 0.0, 'mean': 0.0, 'max': 0.0}
+    total = sum(timings)
+    return {'n_tasks': len(timings), 'total': total, 'mean': total / len(timings), 'max': max(timings)}
@@ -0,0 +1,64 @@
+"""Parquet export of the final tables.
+
+Each table is written as a zstd-compressed, hive-partitioned Parquet dataset
+(e.g. data/final/current/complete.parquet/league=Spanish%20Primera%20Divisi%C3%B3n/...).
+Rows are sorted by overall rating within each partition, so the min/max statistics
+of each row group let readers skip most of the data for filters like overall >= 80.
+"""
+import shutil
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import crawler.utils
+
+_PARQUET_PATHS = crawler.utils.filepath_tree('final', '.parquet')
+
+COMPRESSION = 'zstd'
+ROW_GROUP_SIZE = 2048
+SORT_COL = 'overall'
+
+
+def parquet_path(category_key, version_key='current'):
+    return _PARQUET_PATHS[version_key][category_key]
+
+
+def write_parquet(data, category_key, partition_cols=('league',), version_key='current', path=None):
+    """Replaces the Parquet dataset for category_key (or at path) with data, partitioned by partition_cols.
+
+    The dataset is written next to the old one and swapped in once complete, so readers
+    never see a half-written dataset."""
+    path = path or parquet_path(category_key, version_key)
+    tmp_path = path.with_name(path.name + '.tmp')
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    sort_cols = [*partition_cols, *([SORT_COL] if SORT_COL in data.columns else [])]
+    ascending = [True] * len(partition_cols) + [False] * (len(sort_cols) - len(partition_cols))
+    if sort_cols:
+        data = data.sort_values(sort_cols, ascending=ascending)
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    partitioning = None
+    if partition_cols:
+        partitioning = ds.partitioning(table.select(list(partition_cols)).schema, flavor='hive')
+    ds.write_dataset(table, tmp_path, format='parquet', partitioning=partitioning,
+                     file_options=ds.ParquetFileFormat().make_write_options(compression=COMPRESSION),
+                     max_rows_per_group=ROW_GROUP_SIZE, existing_data_behavior='overwrite_or_ignore')
+    if path.exists():
+        shutil.rmtree(path)
+    tmp_path.rename(path)
+
+
+def read_parquet(category_key, columns=None, filters=None, version_key='current'):
+    """Reads an exported Parquet dataset into a DataFrame.
+
+    filters uses the pyarrow.parquet.read_table format, e.g.
+    [('league', '=', 'English Premier League'), ('overall', '>=', 80)].
+    Partitions and row groups that can't match are not read."""
+    # partition values are read as strings: pyarrow can't combine dictionaries with the null partition
+    dataset = ds.dataset(parquet_path(category_key, version_key), format='parquet',
+                         partitioning=ds.HivePartitioning.discover(infer_dictionary=False))
+    filter_expression = None if filters is None else pq.filters_to_expression(filters)
+    data = dataset.to_table(columns=columns, filter=filter_expression).to_pandas()
+    partition_cols = [col for col in dataset.partitioning.schema.names if col in data.columns]
+    return data.astype({col: 'category' for col in partition_cols})
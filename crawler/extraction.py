@@ -0,0 +1,439 @@
+"""Page extraction engines.
+
+For each page category an engine provides three picklable functions (a PageFunctions tuple):
+
+- filter_page(html) -> fragment: trims a downloaded page to the fragment kept in the html store
+- extract_page(url, html) -> (fragment, parsed): filter_page and parse_fragment in one go
+- parse_fragment(url, fragment) -> parsed: parses a fragment from the html store
+
+Parsed values are a record dict for 'player', a list of row dicts for 'overview',
+a list of club names for 'league' and a {league ID: league name} dict for 'league_overview'.
+For an overview, league or league overview page without its table, the lxml engine
+filters to None and extracts (None, an empty parsed value).
+
+'parsel' is the original implementation and serves as the reference engine.
+'lxml' builds each tree once and runs precompiled XPath expressions against it, which are
+compiled on first use and cached per process. compare_engines checks the two agree.
+"""
+import collections
+
+import numpy as np
+from lxml import etree, html as lxml_html
+
+import crawler.html_download
+import crawler.executor
+import crawler.html_store
+import crawler.league_data
+import crawler.overview_data
+import crawler.player_data
+import crawler.utils
+
+PageFunctions = collections.namedtuple('PageFunctions', ['filter_page', 'extract_page', 'parse_fragment'])
+
+DEFAULT_ENGINE = crawler.utils.DEFAULT_ENGINE
+
+_XPATH_CACHE = {}
+
+
+def _xpath(path):
+    try:
+        return _XPATH_CACHE[path]
+    except KeyError:
+        compiled = etree.XPath(path, smart_strings=False)
+        _XPATH_CACHE[path] = compiled
+        return compiled
+
+
+def _first(results):
+    return results[0] if results else None
+
+
+def _to_html(element):
+    # same serialisation as parsel's Selector.extract
+    return etree.tostring(element, method='html', encoding='unicode', with_tail=False)
+
+
+def _parse_tree(text):
+    # mirrors how parsel builds its root node, so that both engines see the same tree
+    body = text.strip().replace('\x00', '').encode('utf8') or b'<html/>'
+    parser = lxml_html.HTMLParser(recover=True, encoding='utf8')
+    root = etree.fromstring(body, parser=parser)
+    if root is None:
+        root = etree.fromstring(b'<html/>', parser=parser)
+    return root
+
+
+def _fragment_root(fragment):
+    """Returns the top element of a stored fragment (scripts get parsed into <head>)."""
+    return _first(_xpath('/html/body/* | /html/head/*')(_parse_tree(fragment)))
+
+
+# ---------------------------------------------------------------------------
+# parsel (reference) engine
+# ---------------------------------------------------------------------------
+
+def _parsel_extract(filter_page, parse_fragment, url, html):
+    fragment = filter_page(html)
+    return fragment, parse_fragment(url, fragment)
+
+
+def _parsel_parse_player(url, html_dict):
+    return crawler.player_data.parse_single_player_page(url, html_dict, crawler.executor.worker_constants())
+
+
+def _parsel_parse_overview(url, html):
+    return crawler.overview_data.parse_single_overview_page(html)
+
+
+def _parsel_parse_league(url, html):
+    return [row['club'] for row in crawler.league_data.parse_single_league_page(html, None)]
+
+
+def _parsel_parse_league_overview(url, html):
+    return crawler.league_data.parse_league_overview(html)
+
+
+def _parsel_filter_player(html):
+    return crawler.html_download._get_relevant_player_html_dict(html)
+
+
+def _parsel_filter_overview(html):
+    return crawler.html_download._get_relevant_overview_html(html)
+
+
+def _parsel_filter_league(html):
+    return crawler.html_download._get_relevant_league_html(html)
+
+
+def _parsel_filter_league_overview(html):
+    return crawler.html_download._get_relevant_league_overview_html(html)
+
+
+def _parsel_extract_player(url, html):
+    return _parsel_extract(_parsel_filter_player, _parsel_parse_player, url, html)
+
+
+def _parsel_extract_overview(url, html):
+    return _parsel_extract(_parsel_filter_overview, _parsel_parse_overview, url, html)
+
+
+def _parsel_extract_league(url, html):
+    return _parsel_extract(_parsel_filter_league, _parsel_parse_league, url, html)
+
+
+def _parsel_extract_league_overview(url, html):
+    return _parsel_extract(_parsel_filter_league_overview, _parsel_parse_league_overview, url, html)
+
+
+# ---------------------------------------------------------------------------
+# lxml engine
+# ---------------------------------------------------------------------------
+
+def _lxml_player_elements(root):
+    body = _first(_xpath('/html/body')(root))
+    section1 = _first(_xpath('section/section[1]')(body))
+    return {'headline_attributes': _first(_xpath('script[1]')(body)),
+            'position_ratings': _first(_xpath('aside/div[2]')(section1)),
+            'main': _xpath('article/div[position() < 4]')(section1)}
+
+
+def _lxml_player_fragment(elements):
+    return {'headline_attributes': None if elements['headline_attributes'] is None
+                                   else _to_html(elements['headline_attributes']),
+            'position_ratings': None if elements['position_ratings'] is None
+                                else _to_html(elements['position_ratings']),
+            'main': [_to_html(div) for div in elements['main']]}
+
+
+def _lxml_main_attributes(rectangles):
+    # the last sub div holds traits and specialities, which we don't want here
+    sub_divs = [sub_div for rectangle in rectangles for sub_div in _xpath('div')(rectangle)][:-1]
+    names, values = [], []
+    for sub_div in sub_divs:
+        names.extend(name.strip() for name in _xpath('div/ul/li/text()')(sub_div) if not name.isspace())
+        values.extend(_xpath('div/ul/li/span/text()')(sub_div))
+    return dict(zip(names, values))
+
+
+def _lxml_player_metadata(metadata):
+    span_strings = [s.strip() for s in _xpath('div[1]/div/span/text()')(metadata)]
+    subspan_strings = [s.strip() for s in _xpath('div[1]/div/span/span/text()')(metadata)]
+    return crawler.player_data._player_metadata_from_strings(span_strings, subspan_strings)
+
+
+def _lxml_traits_and_specialities(rectangle, all_traits, all_specialities):
+    divs = _xpath('div[last()]/div')(rectangle)
+    if not divs:
+        ul_string_lists, first_ul_heading = None, None
+    else:
+        uls = [ul for div in divs for ul in _xpath('ul')(div)]
+        ul_string_lists = [[s.strip() for s in _xpath('li/text()')(ul)] for ul in uls]
+        first_ul_heading = _first(_xpath('../h5/text()')(uls[0])) if uls else None
+    return crawler.player_data._traits_and_specialities_from_strings(
+        ul_string_lists, first_ul_heading, all_traits, all_specialities)
+
+
+def _lxml_miscellaneous_data(metadata):
+    ul = _xpath('div[3]/table/tr/td[1]/ul[1]')(metadata)[0]
+    strings = [x.strip() for x in _xpath('.//text()')(ul) if not x.isspace()]
+    return crawler.player_data._player_miscellaneous_data_from_strings(strings)
+
+
+def _cell_text(cell):
+    return ' '.join(cell.text_content().split())
+
+
+def _table_column(table, header_cells, rows, name):
+    headers = [_cell_text(cell) for cell in header_cells]
+    col_idx = headers.index(name)
+    return [_cell_text(_xpath('td|th')(row)[col_idx]) for row in rows]
+
+
+def _lxml_position_ratings(position_ratings, metadata, all_positions):
+    if _first(_xpath('h5/text()')(position_ratings)) == 'Real overall rating':
+        table = _xpath('table[1]')(position_ratings)[0]
+        header_cells = _xpath('thead/tr[1]/th')(table)
+        rows = _xpath('tbody/tr')(table)
+        if not header_cells:
+            all_rows = _xpath('tr')(table)
+            header_cells, rows = _xpath('th|td')(all_rows[0]), all_rows[1:]
+        positions = _table_column(table, header_cells, rows, 'Position')
+        ratings = _table_column(table, header_cells, rows, 'OVA')
+        # same ordering as the melt in get_position_ratings
+        split_positions = [p.split() for p in positions]
+        n_splits = max((len(p) for p in split_positions), default=0)
+        position_ratings_dict = {}
+        for i in range(n_splits):
+            for row_positions, rating in zip(split_positions, ratings):
+                if i < len(row_positions):
+                    position_ratings_dict[row_positions[i]] = int(rating)
+        position_ratings_dict['GK'] = np.nan
+    else:
+        gk_rating = _first(_xpath('div[2]/table/tr/td[1]/span/text()')(metadata))
+        all_outfield_positions = [pos for pos in all_positions if pos != 'GK']
+        position_ratings_dict = {'GK': gk_rating, **{pos: np.nan for pos in all_outfield_positions}}
+    return position_ratings_dict
+
+
+def _lxml_player_record(url, script_html, position_ratings, main, constants):
+    metadata = main[0]
+    rectangles = main[1:]
+    all_positions = constants['positions']
+    main_attributes = _lxml_main_attributes(rectangles)
+    headline_attributes = crawler.utils.headline_attributes_from_script(script_html)
+    metadata_dict = _lxml_player_metadata(metadata)
+    _preferred_positions = metadata_dict.pop('preferred_positions')
+    traits_and_specialities = _lxml_traits_and_specialities(rectangles[1], constants['traits'],
+                                                            constants['specialities'])
+    miscellaneous_data = _lxml_miscellaneous_data(metadata)
+    position_ratings_dict = _lxml_position_ratings(position_ratings, metadata, all_positions)
+    position_preferences = crawler.player_data.get_full_position_preferences(_preferred_positions, all_positions)
+    return {'ID': crawler.player_data.id_from_url(url), **main_attributes, **headline_attributes,
+            **metadata_dict, **traits_and_specialities, **miscellaneous_data, **position_ratings_dict,
+            **position_preferences}
+
+
+def _lxml_filter_player(html):
+    return _lxml_player_fragment(_lxml_player_elements(_parse_tree(html)))
+
+
+def _lxml_extract_player(url, html):
+    elements = _lxml_player_elements(_parse_tree(html))
+    fragment = _lxml_player_fragment(elements)
+    record = _lxml_player_record(url, fragment['headline_attributes'], elements['position_ratings'],
+                                 elements['main'], crawler.executor.worker_constants())
+    return fragment, record
+
+
+def _lxml_parse_player(url, html_dict):
+    record = _lxml_player_record(url, html_dict['headline_attributes'],
+                                 _fragment_root(html_dict['position_ratings']),
+                                 [_fragment_root(item) for item in html_dict['main']],
+                                 crawler.executor.worker_constants())
+    return record
+
+
+def _lxml_overview_row(row):
+    record_dict = {}
+    tds = _xpath('td')(row)
+    if _xpath('div')(tds[0]):
+        photo = _first(_xpath('div/figure/img/@data-src')(tds[0]))
+        player_id = _first(_xpath('div/figure/img/@id')(tds[0]))
+    else:
+        photo = _first(_xpath('figure/img/@data-src')(tds[0]))
+        player_id = _first(_xpath('figure/img/@id')(tds[0]))
+    record_dict['Photo'] = photo.replace('/48/', '/')
+    record_dict['ID'] = player_id
+    namecol_hyperlinks = _xpath('div/a')(tds[1])
+    record_dict['Nationality'] = _first(_xpath('@title')(namecol_hyperlinks[0]))
+    record_dict['Flag'] = _first(_xpath('img/@data-src')(namecol_hyperlinks[0])).replace('.p', '@3x.p')
+    record_dict['Name'] = _first(_xpath('text()')(namecol_hyperlinks[1]))
+    record_dict['Age'] = _first(_xpath('div/text()')(tds[2])).strip()
+    record_dict['Overall'] = _first(_xpath('div/span/text()')(tds[3])).strip()
+    record_dict['Potential'] = _first(_xpath('div/span/text()')(tds[4])).strip()
+    record_dict['Club'] = _first(_xpath('div/a/text()')(tds[5]))
+    club_logo = _first(_xpath('div/figure/img/@data-src')(tds[5]))
+    if club_logo:
+        record_dict['Club logo'] = club_logo.replace('/24/', '/')
+    else:
+        record_dict['Club logo'] = club_logo
+    record_dict['Value'] = _first(_xpath('div/text()')(tds[7]))
+    record_dict['Wage'] = _first(_xpath('div/text()')(tds[8]))
+    record_dict['Special'] = _first(_xpath('div/mark/text()')(tds[17]))
+    return record_dict
+
+
+def _lxml_overview_rows(table):
+    return [_lxml_overview_row(row) for row in _xpath('tbody/tr')(table)]
+
+
+def _lxml_overview_table(root):
+    return _first(_xpath('/html/body/section/section/article/div/table')(root))
+
+
+def _lxml_filter_overview(html):
+    table = _lxml_overview_table(_parse_tree(html))
+    return None if table is None else _to_html(table)
+
+
+def _lxml_extract_overview(url, html):
+    table = _lxml_overview_table(_parse_tree(html))
+    if table is None:
+        return None, []
+    return _to_html(table), _lxml_overview_rows(table)
+
+
+def _lxml_parse_overview(url, html):
+    return _lxml_overview_rows(_fragment_root(html))
+
+
+def _lxml_league_tbody(root):
+    return _first(_xpath('/html/body/section/section/aside/div[2]/table/tbody')(root))
+
+
+def _lxml_league_clubs(tbody):
+    return _xpath('tr/td/a/text()')(tbody)
+
+
+def _lxml_filter_league(html):
+    tbody = _lxml_league_tbody(_parse_tree(html))
+    return None if tbody is None else _to_html(tbody)
+
+
+def _lxml_extract_league(url, html):
+    tbody = _lxml_league_tbody(_parse_tree(html))
+    if tbody is None:
+        return None, []
+    return _to_html(tbody), _lxml_league_clubs(tbody)
+
+
+def _lxml_parse_league(url, html):
+    return _lxml_league_clubs(_fragment_root(html))
+
+
+def _lxml_league_overview_table(root):
+    return _first(_xpath('/html/body/section/section/article/table')(root))
+
+
+def _lxml_league_IDs(table):
+    league_id_dict = {}
+    for row in _xpath('tbody/tr')(table):
+        league_hyperlink = _xpath('td[2]/a')(row)
+        league_id = _first(_xpath('@href')(league_hyperlink[0])).split('/')[-1]
+        league_name = _first(_xpath('text()')(league_hyperlink[0])).rsplit(' ', maxsplit=1)[0]
+        league_id_dict[league_id] = league_name
+    return league_id_dict
+
+
+def _lxml_filter_league_overview(html):
+    table = _lxml_league_overview_table(_parse_tree(html))
+    return None if table is None else _to_html(table)
+
+
+def _lxml_extract_league_overview(url, html):
+    table = _lxml_league_overview_table(_parse_tree(html))
+    if table is None:
+        return None, {}
+    return _to_html(table), _lxml_league_IDs(table)
+
+
+def _lxml_parse_league_overview(url, html):
+    return _lxml_league_IDs(_fragment_root(html))
+
+
+ENGINES = {
+    'parsel': {
+        'player': PageFunctions(_parsel_filter_player, _parsel_extract_player, _parsel_parse_player),
+        'overview': PageFunctions(_parsel_filter_overview, _parsel_extract_overview, _parsel_parse_overview),
+        'league': PageFunctions(_parsel_filter_league, _parsel_extract_league, _parsel_parse_league),
+        'league_overview': PageFunctions(_parsel_filter_league_overview, _parsel_extract_league_overview,
+                                         _parsel_parse_league_overview),
+    },
+    'lxml': {
+        'player': PageFunctions(_lxml_filter_player, _lxml_extract_player, _lxml_parse_player),
+        'overview': PageFunctions(_lxml_filter_overview, _lxml_extract_overview, _lxml_parse_overview),
+        'league': PageFunctions(_lxml_filter_league, _lxml_extract_league, _lxml_parse_league),
+        'league_overview': PageFunctions(_lxml_filter_league_overview, _lxml_extract_league_overview,
+                                         _lxml_parse_league_overview),
+    },
+}
+
+
+def get_page_functions(category_key, engine=DEFAULT_ENGINE):
+    try:
+        return ENGINES[engine][category_key]
+    except KeyError:
+        raise ValueError('Unknown engine {!r}, expected one of {}'.format(engine, list(ENGINES)))
+
+
+# ---------------------------------------------------------------------------
+# equivalence harness
+# ---------------------------------------------------------------------------
+
+def _values_equal(a, b):
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(_values_equal(a[k], b[k]) for k in a)
+    if isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all(_values_equal(x, y) for x, y in zip(a, b))
+    if a is None or b is None:
+        return a is b
+    try:
+        if np.isnan(a) and np.isnan(b):
+            return True
+    except TypeError:
+        pass
+    return a == b
+
+
+def compare_parsed(category_key, url, fragment, engine='lxml', reference='parsel'):
+    """Returns None if both engines parse fragment identically, otherwise a (reference, engine) pair."""
+    expected = get_page_functions(category_key, reference).parse_fragment(url, fragment)
+    actual = get_page_functions(category_key, engine).parse_fragment(url, fragment)
+    return None if _values_equal(expected, actual) else (expected, actual)
+
+
+def compare_extracted(category_key, url, html, engine='lxml', reference='parsel'):
+    """Like compare_parsed, but for a raw downloaded page: compares fragments and parsed values."""
+    expected = get_page_functions(category_key, reference).extract_page(url, html)
+    actual = get_page_functions(category_key, engine).extract_page(url, html)
+    return None if _values_equal(list(expected), list(actual)) else (expected, actual)
+
+
+def compare_engines(category_key, urls=None, engine='lxml', reference='parsel', constants=None):
+    """Parses the stored fragments for category_key with both engines.
+
+    Returns a {url: (reference result, engine result)} dict of the pages where they differ."""
+    crawler.executor.init_worker(constants or crawler.utils.read_constants())
+    mismatches = {}
+    with crawler.html_store.open_store(category_key) as store:
+        for url in (store.keys() if urls is None else urls):
+            mismatch = compare_parsed(category_key, url, store.get(url), engine, reference)
+            if mismatch is not None:
+                mismatches[url] = mismatch
+    return mismatches
+
+
+if __name__ == '__main__':
+    for category in ['overview', 'player', 'league', 'league_overview']:
+        if crawler.html_store.store_exists(category):
+            print(category, len(compare_engines(category)), 'mismatches')
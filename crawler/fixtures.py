@@ -0,0 +1,208 @@
+"""Synthetic sofifa pages for benchmarks and offline runs.
+
+The pages have the structure read by the filter functions in crawler.html_download and
+by parse_single_row, parse_single_player_page and parse_single_league_page (and the
+lxml engine), with values drawn deterministically from the player, club or league ID.
+Players, clubs, leagues and nations are consistent across the page types, so the
+parsed tables can be merged like real ones. A Universe for a past edition changes the
+pages of one player in CHANGED_PER_EDITION, so crawls of several editions have both
+identical and different pages. image draws the photos, flags and club logos the pages
+link to.
+"""
+import random
+import struct
+import zlib
+
+import crawler.utils
+from crawler.utils import read_constants
+
+OVERVIEW_PAGE_SIZE = 80
+PLAYERS_PER_CLUB = 28
+CLUBS_PER_LEAGUE = 18
+N_NATIONS = 160
+FIRST_PLAYER_ID = 1000
+CHANGED_PER_EDITION = 4
+
+_POSITION_ROWS = [['LS', 'ST', 'RS'], ['LW', 'RW'], ['LF', 'CF', 'RF'], ['CAM'], ['LAM', 'RAM'], ['LM', 'RM'],
+                  ['LCM', 'CM', 'RCM'], ['LWB', 'RWB'], ['LDM', 'CDM', 'RDM'], ['LB', 'RB'], ['LCB', 'CB', 'RCB']]
+_MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+_BODY_TYPES = ['Normal', 'Lean', 'Stocky']
+_WORK_RATES = ['High', 'Medium', 'Low']
+_MAIN_ATTRIBUTE_GROUPS = [5, 5, 5, 5, 6, 3, 5]  # attributes per box, in page order
+
+
+class Universe:
+    """The IDs of the players, clubs and leagues for a synthetic crawl of n_players,
+    optionally in an edition, e.g. '16' or '16.158000' for a roster update."""
+
+    def __init__(self, n_players, edition=None):
+        self.n_players = n_players
+        self.edition = edition
+        self.player_IDs = list(range(FIRST_PLAYER_ID, FIRST_PLAYER_ID + n_players))
+        self.n_clubs = max(1, -(-n_players // PLAYERS_PER_CLUB))
+        self.n_leagues = max(1, -(-self.n_clubs // CLUBS_PER_LEAGUE))
+        self.league_IDs = list(range(1, self.n_leagues + 1))
+
+    def player_seed(self, player_ID):
+        """Seed of the values on the player's pages."""
+        if self.edition is None or zlib.crc32('{}:{}'.format(player_ID, self.edition).encode()) % CHANGED_PER_EDITION:
+            return player_ID
+        return '{}:{}'.format(player_ID, self.edition)
+
+    def club_of(self, player_ID):
+        return (player_ID - FIRST_PLAYER_ID) % self.n_clubs
+
+    def clubs_of_league(self, league_ID):
+        return range(league_ID - 1, self.n_clubs, self.n_leagues)
+
+    def overview_offsets(self):
+        return range(0, self.n_players, OVERVIEW_PAGE_SIZE)
+
+
+def _money(rng, low, high):
+    amount = rng.uniform(low, high)
+    if amount >= 1e6:
+        return '€{:.1f}M'.format(amount / 1e6).replace('.0M', 'M')
+    return '€{}K'.format(int(amount // 1e3))
+
+
+def _overview_row(universe, player_ID):
+    rng = random.Random(universe.player_seed(player_ID))
+    club = universe.club_of(player_ID)
+    nation = player_ID % N_NATIONS
+    overall = rng.randint(46, 94)
+    tds = ['<td><figure class="avatar"><img data-src="https://cdn.sofifa.org/18/players/48/{0}.png" id="{0}">'
+           '</figure></td>'.format(player_ID),
+           '<td><div class="bp3-text-overflow-ellipsis"><a href="/players?na={0}" title="Nation {0}">'
+           '<img data-src="https://cdn.sofifa.org/flags/{0}.png"></a>'
+           '<a href="/player/{1}">Player {1}</a></div></td>'.format(nation, player_ID),
+           '<td><div class="col-digit"> {} </div></td>'.format(rng.randint(16, 40)),
+           '<td><div class="col-digit"><span> {} </span></div></td>'.format(overall),
+           '<td><div class="col-digit"><span> {} </span></div></td>'.format(min(99, overall + rng.randint(0, 20))),
+           '<td><div><figure><img data-src="https://cdn.sofifa.org/18/teams/24/{0}.png"></figure>'
+           '<a href="/team/{0}">Club {0}</a></div></td>'.format(club),
+           '<td></td>',
+           '<td><div class="col-digit">{}</div></td>'.format(_money(rng, 5e4, 1.2e8)),
+           '<td><div class="col-digit">{}</div></td>'.format(_money(rng, 1e3, 5e5)),
+           *['<td></td>'] * 8,
+           '<td><div class="col-digit"><mark>{}</mark></div></td>'.format(rng.randint(700, 2300))]
+    return '<tr>{}</tr>'.format(''.join(tds))
+
+
+def overview_page(universe, offset):
+    rows = ''.join(_overview_row(universe, player_ID)
+                   for player_ID in universe.player_IDs[offset:offset + OVERVIEW_PAGE_SIZE])
+    return ('<html><head><title>Players</title></head><body><header></header><section><section><article>'
+            '<div class="card"><table class="table"><thead><tr><th>Name</th></tr></thead><tbody>{}</tbody>'
+            '</table></div></article></section></section><footer></footer></body></html>'.format(rows))
+
+
+def _attribute_box(rng, names):
+    items = ''.join('\r\n<li><span class="label">{}</span> {}</li>'.format(rng.randint(10, 95), name)
+                    for name in names)
+    return '<div class="column col-4"><div class="card"><h5>Box</h5><ul class="pl">{}</ul></div></div>'.format(items)
+
+
+def _traits_box(rng, constants):
+    traits = rng.sample([trait[:-len('_trait')] for trait in constants['traits']], rng.randint(0, 4))
+    specialities = rng.sample([speciality[:-len('_speciality')] for speciality in constants['specialities']],
+                              rng.randint(0, 3))
+    sections = ''
+    if traits:
+        sections += '<div class="column col-4"><h5>Traits</h5><ul>{}</ul></div>'.format(
+            ''.join('<li>{}</li>'.format(trait) for trait in traits))
+    if specialities:
+        sections += '<div class="column col-4"><h5>Specialities</h5><ul>{}</ul></div>'.format(
+            ''.join('<li>{}</li>'.format(speciality) for speciality in specialities))
+    return '<div>{}</div>'.format(sections)
+
+
+def player_page(universe, player_ID, constants=None):
+    constants = constants or read_constants()
+    rng = random.Random(universe.player_seed(player_ID))
+    is_gk = player_ID % 11 == 0
+    script = '\r\n'.join(['<script>'] +
+                         ['    point.{} = {};'.format(name, rng.randint(20, 95))
+                          for name in constants['headline_attributes']] + ['</script>'])
+    preferred = ['GK'] if is_gk else rng.sample([pos for pos in constants['positions'] if pos != 'GK'],
+                                                rng.randint(1, 3))
+    if player_ID % 7 == 0:
+        height, weight = '{}\'{}"'.format(rng.randint(5, 6), rng.randint(0, 11)), '{}lbs'.format(rng.randint(130, 220))
+    else:
+        height, weight = '{}cm'.format(rng.randint(160, 205)), '{}kg'.format(rng.randint(55, 100))
+    misc = [('Preferred foot', rng.choice(['Right', 'Left'])),
+            ('International reputation', rng.randint(1, 5)),
+            ('Weak foot', rng.randint(1, 5)),
+            ('Skill moves', rng.randint(1, 5)),
+            ('Work rate', '{} / {}'.format(rng.choice(_WORK_RATES), rng.choice(_WORK_RATES))),
+            ('Body type', rng.choice(_BODY_TYPES)),
+            ('Real face', rng.choice(['Yes', 'No']))]
+    if player_ID % 20:
+        misc.append(('Release clause', _money(rng, 1e5, 2e8)))
+    misc_items = ''.join('<li><label>{}</label> {}</li>'.format(name, value) for name, value in misc)
+    metadata = ('<div class="card"><div class="info"><div class="meta"><span>Full Name {id} {positions} '
+                'Age {age} ({month} {day}, {year}) {height} {weight}</span></div></div>'
+                '<div class="stats"><table><tr><td><span class="label">{overall}</span></td></tr></table></div>'
+                '<div class="teams"><table><tr><td><ul>{misc}</ul></td><td></td></tr></table></div></div>').format(
+        id=player_ID, positions=' '.join('<span class="pos">{}</span>'.format(pos) for pos in preferred),
+        age=rng.randint(16, 40), month=rng.choice(_MONTHS), day=rng.randint(1, 28), year=rng.randint(1978, 2001),
+        height=height, weight=weight, overall=rng.randint(46, 94), misc=misc_items)
+    boxes, start = [], 0
+    for size in _MAIN_ATTRIBUTE_GROUPS:
+        boxes.append(_attribute_box(rng, constants['main_attributes'][start:start + size]))
+        start += size
+    rectangle1 = '<div class="columns">{}</div>'.format(''.join(boxes[:4]))
+    rectangle2 = '<div class="columns">{}{}</div>'.format(''.join(boxes[4:]), _traits_box(rng, constants))
+    if is_gk:
+        position_ratings = '<div class="card"><h5>Player specialities</h5></div>'
+    else:
+        rows = ''.join('<tr><td>{}</td><td>{}</td></tr>'.format(' '.join(row), rng.randint(30, 94))
+                       for row in _POSITION_ROWS)
+        position_ratings = ('<div class="card"><h5>Real overall rating</h5><table><thead><tr><th>Position</th>'
+                            '<th>OVA</th></tr></thead><tbody>{}</tbody></table></div>'.format(rows))
+    return ('<html><head><title>Player</title></head><body>{script}<header></header><section><section><aside>'
+            '<div class="card">Club</div>{position_ratings}</aside><article>{metadata}{rectangle1}{rectangle2}'
+            '<div class="card">Comments</div></article></section></section></body></html>').format(
+        script=script, position_ratings=position_ratings, metadata=metadata,
+        rectangle1=rectangle1, rectangle2=rectangle2)
+
+
+def league_page(universe, league_ID):
+    rows = ''.join('<tr><td><a href="/team/{0}">Club {0}</a></td><td>{1}</td></tr>'.format(club, club % 20 + 1)
+                   for club in universe.clubs_of_league(league_ID))
+    return ('<html><head><title>League</title></head><body><section><section><aside><div class="card">Info</div>'
+            '<div class="card"><table><thead><tr><th>Team</th></tr></thead><tbody>{}</tbody></table></div>'
+            '</aside><article></article></section></section></body></html>'.format(rows))
+
+
+def league_overview_page(universe):
+    rows = ''.join('<tr><td><img></td><td><a href="/league/{0}">League {0} ({1})</a></td></tr>'.format(
+        league_ID, league_ID % 4 + 1) for league_ID in universe.league_IDs)
+    return ('<html><head><title>Leagues</title></head><body><section><section><article><table>'
+            '<thead><tr><th>Name</th></tr></thead><tbody>{}</tbody></table></article></section></section>'
+            '</body></html>'.format(rows))
+
+
+def image(path):
+    """A small but valid png for the image at path (e.g. /flags/12@3x.png), drawn from the path."""
+    rng = random.Random(path)
+    width = height = 16
+    pixels = b''.join(b'\x00' + bytes(rng.getrandbits(8) for _ in range(3 * width)) for _ in range(height))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(pixels)) + chunk(b'IEND', b''))
+
+
+def overview_url(offset):
+    return crawler.utils.BASE_URL + '/players?offset={}'.format(offset)
+
+
+def player_url(player_ID):
+    return crawler.utils.BASE_URL + '/player/{}'.format(player_ID)
+
+
+def league_url(league_ID):
+    return crawler.utils.BASE_URL + '/league/{}'.format(league_ID)
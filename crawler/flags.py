@@ -0,0 +1,201 @@
+"""Packed bitmask columns for the trait, speciality and position preference flags.
+
+Each group of flags in FLAG_GROUPS is stored as one uint64 column named
+<group>_bits, where bit i is set if the player has the i-th flag of the group in the
+constants (e.g. constants['traits'][i]). That is three columns instead of ~90 bool
+columns, and a filter on any number of flags is a few bitwise operations per row:
+
+    mask(data, 'finesse_shot_trait AND speedster_speciality AND (prefers_st OR prefers_cf)')
+
+Flags are referred to by their standardised wide column names. to_wide and to_packed
+convert between this layout and the one with a bool column per flag, which the CSV
+exports keep.
+"""
+import re
+
+import numpy as np
+
+from crawler.utils import read_constants, standardise_col_name
+
+FLAG_GROUPS = ['traits', 'specialities', 'position_preferences']
+MAX_FLAGS = 64
+
+_TOKEN_PATTERN = re.compile(r'\s*(\(|\)|[^\s()]+)')
+_OPERATORS = {'AND', 'OR', 'NOT'}
+
+
+def bits_col(group):
+    return group + '_bits'
+
+
+def bitmask(names, all_names):
+    """The bitmask of the names in all_names, bit i standing for all_names[i]. Other names are ignored."""
+    bits = 0
+    for name in names:
+        if name in all_names:
+            bits |= 1 << all_names.index(name)
+    return bits
+
+
+def flag_layout(constants=None):
+    """{bits column: standardised names of its flags, in bit order}."""
+    constants = constants or read_constants()
+    layout = {}
+    for group in FLAG_GROUPS:
+        if len(constants[group]) > MAX_FLAGS:
+            raise ValueError('{} has more than {} flags'.format(group, MAX_FLAGS))
+        layout[bits_col(group)] = [standardise_col_name(name) for name in constants[group]]
+    return layout
+
+
+def _flag_bits(layout):
+    return {name: (col, bit) for col, names in layout.items() for bit, name in enumerate(names)}
+
+
+def pack(values):
+    """Packs a (rows, flags) bool array into a uint64 per row."""
+    values = np.asarray(values, dtype=bool)
+    shifts = np.arange(values.shape[1], dtype='uint64')
+    return np.bitwise_or.reduce(values.astype('uint64') << shifts, axis=1, initial=np.uint64(0))
+
+
+def unpack(bits, n_flags):
+    """The (rows, n_flags) bool array of a uint64 array of bitmasks."""
+    bits = np.asarray(bits, dtype='uint64')
+    return ((bits[:, np.newaxis] >> np.arange(n_flags, dtype='uint64')) & np.uint64(1)).astype(bool)
+
+
+def to_packed(data, constants=None):
+    """Replaces each complete group of wide flag columns of data with its bits column,
+    at the position of the group's first flag. Tables already packed are returned as is."""
+    for col, names in flag_layout(constants).items():
+        if col in data.columns or not all(name in data.columns for name in names):
+            continue
+        position = data.columns.get_loc(names[0])
+        bits = pack(data[names].to_numpy(dtype=bool))
+        data = data.drop(columns=names)
+        data.insert(position, col, bits)
+    return data
+
+
+def to_wide(data, constants=None):
+    """The inverse of to_packed: replaces the bits columns of data with a bool column per flag."""
+    import pandas as pd
+    for col, names in flag_layout(constants).items():
+        if col not in data.columns:
+            continue
+        position = data.columns.get_loc(col)
+        flags = pd.DataFrame(unpack(data[col].to_numpy(dtype='uint64'), len(names)), columns=names,
+                             index=data.index)
+        # one concat instead of an insert per flag, which fragments the frame
+        data = pd.concat([data.iloc[:, :position], flags, data.iloc[:, position + 1:]], axis=1)
+    return data
+
+
+def _parse(tokens):
+    """Parses an expression of flag names, AND, OR, NOT and parentheses into nested
+    ('and' | 'or', [operands]), ('not', operand) and ('flag', name) tuples."""
+
+    def parse_or(position):
+        operands = []
+        while True:
+            operand, position = parse_and(position)
+            operands.append(operand)
+            if position < len(tokens) and tokens[position].upper() == 'OR':
+                position += 1
+            else:
+                return (operands[0] if len(operands) == 1 else ('or', operands)), position
+
+    def parse_and(position):
+        operands = []
+        while True:
+            operand, position = parse_not(position)
+            operands.append(operand)
+            if position < len(tokens) and tokens[position].upper() == 'AND':
+                position += 1
+            else:
+                return (operands[0] if len(operands) == 1 else ('and', operands)), position
+
+    def parse_not(position):
+        if position >= len(tokens):
+            raise ValueError('unexpected end of flag expression')
+        token = tokens[position]
+        if token.upper() == 'NOT':
+            operand, position = parse_not(position + 1)
+            return ('not', operand), position
+        if token == '(':
+            operand, position = parse_or(position + 1)
+            if position >= len(tokens) or tokens[position] != ')':
+                raise ValueError('unbalanced parentheses in flag expression')
+            return operand, position + 1
+        if token == ')' or token.upper() in _OPERATORS:
+            raise ValueError('unexpected {!r} in flag expression'.format(token))
+        return ('flag', token), position + 1
+
+    node, position = parse_or(0)
+    if position != len(tokens):
+        raise ValueError('unexpected {!r} in flag expression'.format(tokens[position]))
+    return node
+
+
+def _evaluate(node, columns, flag_bits):
+    kind, operands = node
+    if kind == 'flag':
+        if operands not in flag_bits:
+            raise KeyError('unknown flag {}'.format(operands))
+        col, bit = flag_bits[operands]
+        return (columns(col) & np.uint64(1 << bit)) != 0
+    if kind == 'not':
+        return ~_evaluate(operands, columns, flag_bits)
+    # the flags and negated flags of an AND or OR are tested together, with one operation per bits column:
+    # flipping the negated bits, an AND needs all of the selected bits set and an OR any of them
+    masks, others = {}, []
+    for operand in operands:
+        negated = operand[0] == 'not' and operand[1][0] == 'flag'
+        name = operand[1][1] if negated else operand[1]
+        if (operand[0] == 'flag' or negated) and name in flag_bits:
+            col, bit = flag_bits[name]
+            plain, flipped = masks.get(col, (0, 0))
+            masks[col] = (plain, flipped | 1 << bit) if negated else (plain | 1 << bit, flipped)
+        else:
+            others.append(operand)
+    result = None
+    for col, (plain, flipped) in masks.items():
+        values = columns(col)
+        if plain & flipped:
+            # x AND NOT x, or x OR NOT x
+            selected = np.full(len(values), kind == 'or')
+        else:
+            if flipped:
+                values = values ^ np.uint64(flipped)
+            selected = values & np.uint64(plain | flipped)
+            selected = selected == np.uint64(plain | flipped) if kind == 'and' else selected != 0
+        result = selected if result is None else _combine(kind, result, selected)
+    for operand in others:
+        selected = _evaluate(operand, columns, flag_bits)
+        result = selected if result is None else _combine(kind, result, selected)
+    return result
+
+
+def _combine(kind, result, selected):
+    if kind == 'and':
+        result &= selected
+    else:
+        result |= selected
+    return result
+
+
+def mask(data, expression, layout=None):
+    """Bool array of the rows of data that match expression, e.g.
+    'finesse_shot_trait AND NOT injury_prone_trait AND (prefers_st OR prefers_cf)'.
+    data is a DataFrame, a pyarrow Table or a dict of arrays with the bits columns.
+    layout defaults to flag_layout() of the current constants."""
+    layout = layout or flag_layout()
+    cache = {}
+
+    def columns(col):
+        if col not in cache:
+            cache[col] = np.asarray(data[col], dtype='uint64')
+        return cache[col]
+
+    return _evaluate(_parse(_TOKEN_PATTERN.findall(expression)), columns, _flag_bits(layout))
@@ -1,48 +1,224 @@
-import aiohttp
-import asyncio
-import requests
 import json
-import shutil
 import gzip
+import functools
+import urllib.parse
 import parsel
 import crawler.utils
+import crawler.html_store
+import crawler.downloader
+import crawler.metrics
+import crawler.parse_cache
+import crawler.pipeline
 
 _JSON_FILEPATHS = crawler.utils.filepath_tree('html_jsons', '.json.gz')
+CHECKPOINT_MAX_AGE = 24 * 60 * 60  # seconds; older checkpoints are from an abandoned crawl
+OVERVIEW_PAGE_SIZE = 80  # players per overview page
+N_OVERVIEW_PAGES = 226  # WARNING: this may not be invariant; see discover_n_overview_pages
+MAX_OVERVIEW_PAGES = 4096
+DISCOVERY_PROBES = 8  # overview pages requested at a time by discover_n_overview_pages
+_EDITION_PARAMS = ['v', 'e', 'set']
 
 
-async def _fetch(session, url):
-    async with session.get(url, timeout=60 * 60) as response:
-        return await response.text()
-
-
-async def _fetch_all(session, urls, loop):
-    results = await asyncio.gather(
-        *[_fetch(session, url) for url in urls],
-        return_exceptions=True  # so we can deal with exceptions later
-    )
+def _get_htmls_from_json(category_key, version_key='current'):
+    with gzip.open(_JSON_FILEPATHS[version_key][category_key], 'rb') as f:
+        htmls = json.load(f)
+    return htmls
 
-    return results
 
+def _get_htmls_from_store(category_key, urls=None):
+    return crawler.html_store.read_store(category_key, keys=urls)
 
-def _get_htmls_from_json(category_key):
-    with gzip.open(_JSON_FILEPATHS['current'][category_key], 'rb') as f:
-        htmls = json.load(f)
-    return htmls
 
+def _parse_htmls_from_store(category_key, urls, page_functions, constants, collect_func=None, on_parsed=None):
+    if crawler.parse_cache.ENABLED:
+        return _parse_htmls_from_store_cached(category_key, urls, page_functions, constants, collect_func, on_parsed)
+    results = {}
+    collected_chunks = []
 
-def _get_htmls(urls, category_key, from_file=False):
-    if from_file:
-        result = _get_htmls_from_json(category_key)
-    else:
-        if len(urls) > 1:
-            loop = asyncio.get_event_loop()
-            connector = aiohttp.TCPConnector(limit=100)
-            with aiohttp.ClientSession(loop=loop, connector=connector) as session:
-                htmls = loop.run_until_complete(_fetch_all(session, urls, loop))
-            raw_result = dict(zip(urls, htmls))
+    def on_chunk(chunk_urls, fragments, collected):
+        if on_parsed is not None:
+            on_parsed(collected)
+        if collect_func is None:
+            results.update(zip(chunk_urls, collected))
+        else:
+            collected_chunks.append(collected)
+
+    with crawler.html_store.open_store(category_key) as store:
+        if urls is None:
+            urls = list(store.keys())
+        fragments = ((url, store.get(url)) for url in urls if url in store)
+        crawler.pipeline.run_pipeline([], page_functions.extract_page, on_chunk, fragments=fragments,
+                                      fragment_func=page_functions.parse_fragment, collect_func=collect_func,
+                                      constants=constants)
+    if collect_func is None:
+        return {url: results[url] for url in urls if url in results}
+    return collected_chunks
+
+
+def _parse_htmls_from_store_cached(category_key, urls, page_functions, constants, collect_func=None,
+                                   on_parsed=None):
+    """Like _parse_htmls_from_store, but only parses the fragments that aren't in the
+    crawler.parse_cache cache, and adds them to it."""
+    results = {}
+    collected_chunks = []
+    keys = {}
+
+    def on_chunk(chunk_urls, fragments, collected):
+        collected, pickles = collected
+        cache.put_many((keys[url], pickled) for url, pickled in zip(chunk_urls, pickles) if pickled is not None)
+        if on_parsed is not None:
+            on_parsed(collected)
+        if collect_func is None:
+            results.update(zip(chunk_urls, collected))
+        else:
+            collected_chunks.append(collected)
+
+    def pages(store):
+        for url, page, key in crawler.parse_cache.cached_fragments(cache, store, urls):
+            keys[url] = key
+            yield url, page
+
+    with crawler.html_store.open_store(category_key) as store, \
+            crawler.parse_cache.open_cache(category_key, page_functions.parse_fragment, constants) as cache:
+        if urls is None:
+            urls = list(store.keys())
+        crawler.pipeline.run_pipeline(
+            [], page_functions.extract_page, on_chunk, fragments=pages(store),
+            fragment_func=functools.partial(crawler.parse_cache.parse_or_load, page_functions.parse_fragment),
+            collect_func=functools.partial(crawler.parse_cache.collect_with_pickles, collect_func),
+            constants=constants)
+        crawler.metrics.increment('parse_cache_hits.' + category_key, cache.hits)
+        crawler.metrics.increment('parse_cache_misses.' + category_key, cache.misses)
+    if collect_func is None:
+        return {url: results[url] for url in urls if url in results}
+    return collected_chunks
+
+
+def _download_htmls(url_batches, category_key, validators, page_functions=None, constants=None, collect_func=None,
+                    on_parsed=None):
+    """Downloads, filters and optionally parses the urls in url_batches, resuming from the checkpoint
+    of an interrupted crawl. url_batches is an iterable of lists of distinct urls, which may block
+    while later batches are still being found; they are all fed to one crawler.pipeline run.
+
+    Each filtered page is appended to the checkpoint as soon as it arrives.
+    Urls that are already in the current html store are requested conditionally using
+    validators, and the stored page is reused if the server says it hasn't changed.
+    Returns {url: filtered html}, or {url: parsed page} if page_functions is given, in order of
+    arrival, or the list of chunks returned by collect_func if that is given too.
+    on_parsed is called with the parsed pages (or collect_func's result) of each chunk as it arrives.
+    Raises crawler.downloader.DownloadError if any url still fails after retrying;
+    the pages that did succeed stay in the checkpoint for the next attempt."""
+    checkpoint_age = crawler.html_store.checkpoint_age(category_key)
+    if checkpoint_age is not None and checkpoint_age > CHECKPOINT_MAX_AGE:
+        crawler.html_store.clear_checkpoint(category_key)
+    checkpoint_paths = crawler.html_store.checkpoint_paths(category_key)
+    checkpoint_writer = crawler.html_store.open_checkpoint_writer(category_key)
+    checkpoint = crawler.html_store.PageStore(*checkpoint_paths)
+    stored_htmls = None
+    request_validators = {}
+    if crawler.html_store.store_exists(category_key):
+        stored_htmls = crawler.html_store.open_store(category_key)
+    urls = []
+    results = {}
+    collected_chunks = []
+
+    def on_chunk(chunk_urls, fragments, collected):
+        for url, fragment in zip(chunk_urls, fragments):
+            if fragment is not None:
+                checkpoint_writer.write(url, fragment)
+        checkpoint_writer.flush()
+        if on_parsed is not None:
+            on_parsed(collected)
+        if page_functions is None:
+            results.update(zip(chunk_urls, fragments))
+        elif collect_func is None:
+            results.update(zip(chunk_urls, collected))
         else:
-            raw_result = requests.get(urls[0]).text
-        result = _filter_htmls(raw_result, category_key)
+            collected_chunks.append(collected)
+
+    def batches():
+        for batch in url_batches:
+            urls.extend(batch)
+            remaining_urls = [url for url in batch if url not in checkpoint]
+            if stored_htmls is not None:
+                request_validators.update((url, validators[url]) for url in remaining_urls
+                                          if url in validators and url in stored_htmls)
+            checkpointed_urls = [url for url in batch if url in checkpoint]
+            if page_functions is None:
+                # nothing to parse, so checkpointed pages don't need to go through the workers
+                results.update(checkpoint.read(checkpointed_urls))
+                checkpointed_urls = []
+            yield remaining_urls, [(url, checkpoint.get(url)) for url in checkpointed_urls]
+
+    if page_functions is None:
+        page_func = functools.partial(_filter_only, _FILTER_FUNCTIONS[category_key])
+        fragment_func = None
+    else:
+        page_func, fragment_func = page_functions.extract_page, page_functions.parse_fragment
+    try:
+        failures = crawler.pipeline.run_pipeline([], page_func, on_chunk, fragment_func=fragment_func,
+                                                 collect_func=collect_func, validators=request_validators,
+                                                 stored_fragments=stored_htmls, constants=constants,
+                                                 batches=batches())
+    finally:
+        checkpoint_writer.close()
+        checkpoint.close()
+        if stored_htmls is not None:
+            stored_htmls.close()
+    validators.update(request_validators)
+    if failures:
+        raise crawler.downloader.DownloadError(failures)
+    if collect_func is not None:
+        return collected_chunks
+    return {url: results[url] for url in urls}
+
+
+def _get_htmls(urls, category_key, from_file=False, update_files=False, carry_over_urls=(),
+               page_functions=None, constants=None, collect_func=None, on_parsed=None):
+    """Returns a {url: filtered html} dict, either from the html store or by downloading urls.
+
+    If page_functions (see crawler.extraction) is given, pages are parsed in worker processes
+    as they become available and {url: parsed page} is returned instead. If collect_func is
+    given as well, it is applied to each chunk of parsed pages in the workers and the list of
+    its results is returned; see crawler.pipeline.run_pipeline. on_parsed is called in the
+    main process with the results for each chunk of pages, as soon as they are parsed.
+    When downloading with update_files set, the current html store is replaced with the new
+    pages plus the pages for carry_over_urls copied over from the old store."""
+    if from_file:
+        with crawler.metrics.span('read_store'):
+            if page_functions is None:
+                return _get_htmls_from_store(category_key, urls)
+            return _parse_htmls_from_store(category_key, urls, page_functions, constants, collect_func, on_parsed)
+    return _get_html_batches([urls], category_key, update_files, carry_over_urls, page_functions, constants,
+                             collect_func, on_parsed)
+
+
+def _get_html_batches(url_batches, category_key, update_files=False, carry_over_urls=(), page_functions=None,
+                      constants=None, collect_func=None, on_parsed=None):
+    """Downloads urls that become known a batch at a time, e.g. while the pages listing them are
+    still being parsed. Each batch joins the running downloads as soon as it is taken from
+    url_batches. Urls seen in an earlier batch are skipped.
+    Returns the same as _get_htmls when downloading, for all the batches together."""
+    validators = crawler.html_store.read_validators(category_key)
+    urls = []
+    seen_urls = set()
+
+    def new_url_batches():
+        for batch in url_batches:
+            batch = [url for url in batch if url not in seen_urls]
+            if batch:
+                seen_urls.update(batch)
+                urls.extend(batch)
+                yield batch
+
+    with crawler.metrics.span('download'):
+        result = _download_htmls(new_url_batches(), category_key, validators, page_functions, constants,
+                                 collect_func, on_parsed)
+    if update_files:
+        with crawler.metrics.span('update_store'):
+            update_html_store_from_checkpoint(urls, category_key, carry_over_urls)
+            crawler.html_store.write_validators(validators, category_key)
+    crawler.html_store.clear_checkpoint(category_key)
     return result
 
 
@@ -69,101 +245,163 @@ def _get_relevant_league_overview_html(league_overview_html):
     table_selector = selector.xpath('/html/body/section/section/article/table')
     return table_selector.extract_first()
 
-def _filter_htmls(raw_htmls, category_key):
-    if category_key == 'league_overview':
-        return _get_relevant_league_overview_html(raw_htmls)
-    dispatch_dict = {'player':_get_relevant_player_html_dict,
+_FILTER_FUNCTIONS = {'player':_get_relevant_player_html_dict,
                      'overview':_get_relevant_overview_html,
-                     'league':_get_relevant_league_html}
-    filtered_html_dict = {}
-    for url, html in raw_htmls.items():
-        relevant_html = dispatch_dict[category_key](html)
-        filtered_html_dict[url] = relevant_html
-    return filtered_html_dict
-
-def save_htmls_to_json(htmls, file_key):
-    with gzip.open(_JSON_FILEPATHS['current'][file_key], 'wb') as f:
-        f.write(json.dumps(htmls).encode())
-
-
-def update_htmls_jsons(new_htmls, category_key):
-    try:
-        shutil.move(_JSON_FILEPATHS['current'][category_key],
-                    _JSON_FILEPATHS['previous'][category_key])
-    except FileNotFoundError:
-        pass
-    save_htmls_to_json(new_htmls, category_key)
-
-
-def update_overview_htmls_jsons(overview_htmls):
-    file_key = 'overview'
-    update_htmls_jsons(overview_htmls, file_key)
+                     'league':_get_relevant_league_html,
+                     'league_overview':_get_relevant_league_overview_html}
+
+
+def _filter_only(filter_func, url, html):
+    return filter_func(html), None
+
+
+def update_html_store_from_checkpoint(urls, category_key, carry_over_urls=()):
+    """Replaces the current html store with the checkpointed pages for urls
+    and the previous store's pages for carry_over_urls."""
+    if crawler.html_store.checkpoint_age(category_key) is None:
+        # nothing was downloaded, e.g. in an incremental crawl where no player changed
+        crawler.html_store.open_checkpoint_writer(category_key).close()
+    crawler.html_store.rotate_store(category_key)
+    with crawler.html_store.PageStore(*crawler.html_store.checkpoint_paths(category_key)) as checkpoint:
+        crawler.html_store.update_dictionary(category_key, checkpoint)
+        with crawler.html_store.open_store_writer(category_key) as writer:
+            if carry_over_urls and crawler.html_store.store_exists(category_key, 'previous'):
+                with crawler.html_store.open_store(category_key, 'previous') as previous_store:
+                    previous_store.copy_to(writer, carry_over_urls)
+            checkpoint.copy_to(writer, urls)
+
+
+def migrate_json_stores():
+    """Converts any old .json.gz html files into the indexed page store."""
+    for version_key, json_paths in _JSON_FILEPATHS.items():
+        for category_key, json_path in json_paths.items():
+            if not json_path.exists():
+                continue
+            htmls = _get_htmls_from_json(category_key, version_key)
+            if category_key == 'league_overview':
+                htmls = {get_league_overview_url(): htmls}
+            crawler.html_store.write_store(htmls, category_key, version_key)
+
+
+def edition_url(url, edition=None):
+    """url for a past crawler.utils.Edition of the game. Urls of the current data are unchanged."""
+    if edition is None:
+        return url
+    params = [('v', edition.version)] + ([] if edition.roster is None else [('e', edition.roster)]) + [('set', 'true')]
+    return url + ('&' if '?' in url else '?') + urllib.parse.urlencode(params)
+
+
+def canonical_url(url):
+    """url without the edition parameters added by edition_url, which the parsers don't read."""
+    split = urllib.parse.urlsplit(url)
+    query = [(key, value) for key, value in urllib.parse.parse_qsl(split.query) if key not in _EDITION_PARAMS]
+    return urllib.parse.urlunsplit(split._replace(query=urllib.parse.urlencode(query)))
+
+
+def get_overview_url(page, edition=None):
+    return edition_url(crawler.utils.BASE_URL + '/players?offset=' + str(page * OVERVIEW_PAGE_SIZE), edition)
+
+
+def get_overview_urls(edition=None, n_pages=N_OVERVIEW_PAGES):
+    return [get_overview_url(page, edition) for page in range(n_pages)]
+
+
+def _overview_pages_have_rows(pages, edition, page_functions):
+    """{page: whether the overview page lists any players}, downloading the pages concurrently."""
+    urls = {get_overview_url(page, edition): page for page in pages}
+    have_rows = {}
+
+    def on_page(url, html):
+        fragment = page_functions.filter_page(html)
+        have_rows[urls[url]] = fragment is not None and bool(page_functions.parse_fragment(url, fragment))
+
+    failures = crawler.downloader.download(list(urls), on_page)
+    if failures:
+        raise crawler.downloader.DownloadError(failures)
+    return have_rows
+
+
+def discover_n_overview_pages(page_functions, edition=None, n_probes=DISCOVERY_PROBES):
+    """The number of overview pages that list players, for editions whose size isn't known.
+    page_functions are the overview crawler.extraction.PageFunctions used to read the pages.
+
+    Requests pages 0, 1, 3, 7, ... up to MAX_OVERVIEW_PAGES at once to bracket the last page,
+    then narrows the bracket with n_probes evenly spaced pages per round, so finding it takes
+    a few round trips instead of a sequential binary search."""
+    pages = [2 ** i - 1 for i in range(MAX_OVERVIEW_PAGES.bit_length()) if 2 ** i - 1 < MAX_OVERVIEW_PAGES]
+    # the highest page known to list players, and the lowest known not to
+    last, empty = -1, MAX_OVERVIEW_PAGES
+    while True:
+        for page, has_rows in _overview_pages_have_rows(pages, edition, page_functions).items():
+            if has_rows:
+                last = max(last, page)
+            else:
+                empty = min(empty, page)
+        if empty - last <= 1:
+            return last + 1
+        step = (empty - last) / (n_probes + 1)
+        pages = sorted({last + max(1, round(step * i)) for i in range(1, n_probes + 1)} - {empty})
+
+
+def get_overview_htmls(from_file=False, update_files=False, page_functions=None, on_parsed=None):
+    urls = get_overview_urls()
+    return _get_htmls(urls, category_key='overview', from_file=from_file, update_files=update_files,
+                      page_functions=page_functions, on_parsed=on_parsed)
 
 
-def update_player_htmls_jsons(player_htmls):
-    file_key = 'player'
-    update_htmls_jsons(player_htmls, file_key)
+def get_player_urls(IDs, edition=None):
+    urls = []
+    base_url = crawler.utils.BASE_URL + '/player/'
+    for ID in IDs:
+        url = edition_url(base_url + str(ID), edition)
+        urls.append(url)
+    return urls
 
 
-def update_league_htmls_jsons(league_htmls):
-    file_key = 'league'
-    update_htmls_jsons(league_htmls, file_key)
+def get_player_htmls(IDs, from_file=False, update_files=False, carry_over_IDs=(), page_functions=None,
+                     constants=None, collect_func=None):
+    """carry_over_IDs are players that are not being fetched but whose stored pages
+    should be kept when the html store is updated.
+    page_functions, constants and collect_func are passed to _get_htmls."""
+    # when reading from file, IDs=None loads every stored player page
+    if from_file and IDs is None:
+        urls = None
+    else:
+        urls = get_player_urls(IDs)
+    return _get_htmls(urls, category_key='player', from_file=from_file,
+                      update_files=update_files, carry_over_urls=get_player_urls(carry_over_IDs),
+                      page_functions=page_functions, constants=constants, collect_func=collect_func)
 
 
-def update_league_overview_html_json(league_overview_html):
-    file_key = 'league_overview'
-    update_htmls_jsons(league_overview_html, file_key)
+def get_player_htmls_in_batches(ID_batches, update_files=False, page_functions=None, constants=None,
+                                collect_func=None):
+    """Like get_player_htmls when downloading, for IDs that arrive in batches, e.g. streamed
+    from the overview crawl; see _get_html_batches."""
+    url_batches = (get_player_urls(IDs) for IDs in ID_batches)
+    return _get_html_batches(url_batches, category_key='player', update_files=update_files,
+                             page_functions=page_functions, constants=constants, collect_func=collect_func)
 
 
-def get_overview_urls():
-    urls = []
-    base_url = "https://sofifa.com/players?offset="
-    offset_increment = 80
-    for i in range(226):  # WARNING: this may not be invariant
-        url = base_url + str(i * offset_increment)
-        urls.append(url)
-    return urls
+def get_league_overview_url(edition=None):
+    return edition_url(crawler.utils.BASE_URL + '/leagues', edition)
 
 
-def get_overview_htmls(from_file=False, update_files=False):
-    urls = get_overview_urls()
-    overview_htmls = _get_htmls(urls, category_key='overview', from_file=from_file)
-    if update_files and not from_file:
-        update_overview_htmls_jsons(overview_htmls)
-    return overview_htmls
+def get_league_overview_html(from_file=False, update_files=False, page_functions=None):
+    url = get_league_overview_url()
+    htmls = _get_htmls([url], category_key='league_overview', from_file=from_file, update_files=update_files,
+                       page_functions=page_functions)
+    return htmls[url]
 
+def get_league_urls(league_IDs, edition=None):
+    base_url = crawler.utils.BASE_URL + '/league/'
+    return [edition_url(base_url + str(ID), edition) for ID in league_IDs]
 
-def get_player_urls(IDs):
-    urls = []
-    base_url = 'https://sofifa.com/player/'
-    for ID in IDs:
-        url = base_url + str(ID)
-        urls.append(url)
-    return urls
+def get_league_htmls(league_IDs, from_file=False, update_files=False, page_functions=None):
+    urls = get_league_urls(league_IDs)
+    return _get_htmls(urls, category_key='league', from_file=from_file, update_files=update_files,
+                      page_functions=page_functions)
 
 
-def get_player_htmls(IDs, from_file=False, update_files=False):
-    if from_file:
-        urls = None
-    else:
-        urls = get_player_urls(IDs)
-    player_htmls = _get_htmls(urls, category_key='player', from_file=from_file)
-    if update_files and not from_file:
-        update_player_htmls_jsons(player_htmls)
-    return player_htmls
-
-
-def get_league_overview_html(from_file=False, update_files=False):
-    url = 'https://sofifa.com/leagues'
-    html = _get_htmls([url], category_key='league_overview', from_file=from_file)
-    if update_files and not from_file:
-        update_league_overview_html_json(html)
-    return html
-
-def get_league_htmls(league_IDs, from_file=False, update_files=False):
-    base_url = 'https://sofifa.com/league/'
-    urls = [base_url + str(ID) for ID in league_IDs]
-    league_htmls = _get_htmls(urls, category_key='league', from_file=from_file)
-    if update_files and not from_file:
-        update_league_htmls_jsons(league_htmls)
-    return league_htmls
+if __name__ == '__main__':
+    migrate_json_stores()
+    crawler.html_store.compress_stores()
@@ -0,0 +1,455 @@
+"""Append-only page archive with an on-disk offset index.
+
+Each category of filtered html is stored as two files:
+
+- ``<category>.pages``: a sequence of records, each made of a fixed-size header
+  (key length, value length), the utf-8 key (usually the page URL) and the
+  compressed JSON encoding of the page value.
+- ``<category>.index``: one JSON line ``[key, offset, length]`` per record,
+  appended alongside the data so that writes can be streamed.
+
+Reading maps the ``.pages`` file into memory and only decodes the requested
+records, so loading a few hundred players does not pay for the other 18k.
+If a key is written more than once, the last record wins.
+
+Values are compressed one by one, so the pages of a category are nearly identical
+boilerplate that a generic compressor can't share between records. Once a category has
+a trained zstd dictionary (see train_dictionary), new records are compressed against it.
+Dictionaries live in data/html_store/dictionaries/ and are never overwritten: each zstd
+record names the ID of its dictionary, so stores, checkpoints and records copied between
+them stay readable after a category gets a new one. Records are zlib-compressed when no
+dictionary has been trained or zstandard isn't installed, and both kinds can be mixed.
+"""
+import json
+import mmap
+import os
+import random
+import shutil
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import crawler.utils
+
+_PAGES_FILEPATHS = crawler.utils.filepath_tree('html_store', '.pages')
+_INDEX_FILEPATHS = crawler.utils.filepath_tree('html_store', '.index')
+_CHECKPOINT_DIR = crawler.utils.DATA_DIR / 'html_store' / 'checkpoints'
+_VALIDATORS_FILEPATHS = crawler.utils.filepath_tree('html_store', '.validators.json')
+DICTIONARY_DIR = crawler.utils.DATA_DIR / 'html_store' / 'dictionaries'
+_ACTIVE_DICTIONARIES_PATH = DICTIONARY_DIR / 'active.json'
+
+_HEADER = struct.Struct('<II')
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+ZSTD_LEVEL = 9
+DICTIONARY_SIZE = 112640  # bytes, zstd's default
+DICTIONARY_SAMPLES = 2000  # records sampled to train a dictionary
+MIN_DICTIONARY_SAMPLES = 20  # fewer records than this aren't worth a dictionary
+RETRAIN_RATIO = 1.5  # retrain once records compress to this many times their size at training time
+
+_dictionaries = {}  # dict ID -> zstandard.ZstdCompressionDict
+_active_lock = threading.Lock()  # the stage threads of a crawl train dictionaries concurrently
+_local = threading.local()  # zstd (de)compressors, which can't be shared between threads
+
+
+class ZlibCodec:
+    """Compresses each record on its own with zlib."""
+
+    def encode(self, data):
+        return zlib.compress(data)
+
+    def owns(self, raw):
+        return not raw.startswith(_ZSTD_MAGIC)
+
+
+class ZstdDictionaryCodec:
+    """Compresses each record with zstd against a dictionary trained on the category."""
+
+    def __init__(self, dictionary):
+        self.dict_id = dictionary.dict_id()
+        _dictionaries[self.dict_id] = dictionary
+
+    def encode(self, data):
+        return _zstd_compressor(self.dict_id).compress(data)
+
+    def owns(self, raw):
+        return raw.startswith(_ZSTD_MAGIC) and zstandard.get_frame_parameters(raw).dict_id == self.dict_id
+
+
+def _thread_cache(name):
+    if not hasattr(_local, name):
+        setattr(_local, name, {})
+    return getattr(_local, name)
+
+
+def _zstd_compressor(dict_id):
+    compressors = _thread_cache('compressors')
+    if dict_id not in compressors:
+        compressors[dict_id] = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=_dictionary(dict_id),
+                                                        write_content_size=True, write_dict_id=True)
+    return compressors[dict_id]
+
+
+def _zstd_decompressor(dict_id):
+    decompressors = _thread_cache('decompressors')
+    if dict_id not in decompressors:
+        decompressors[dict_id] = zstandard.ZstdDecompressor(dict_data=_dictionary(dict_id))
+    return decompressors[dict_id]
+
+
+def _dictionary(dict_id):
+    if dict_id not in _dictionaries:
+        path = DICTIONARY_DIR / '{}.zdict'.format(dict_id)
+        _dictionaries[dict_id] = zstandard.ZstdCompressionDict(path.read_bytes())
+    return _dictionaries[dict_id]
+
+
+def _decode_bytes(raw):
+    if raw.startswith(_ZSTD_MAGIC):
+        if zstandard is None:
+            raise ImportError('zstandard is needed to read zstd-compressed page records')
+        return _zstd_decompressor(zstandard.get_frame_parameters(raw).dict_id).decompress(raw)
+    return zlib.decompress(raw)
+
+
+def _decode_value(raw):
+    return json.loads(_decode_bytes(raw).decode())
+
+
+def _write_atomic(path, data):
+    tmp_path = path.with_name('{}.{}.{}.tmp'.format(path.name, os.getpid(), threading.get_ident()))
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
+def _read_active_dictionaries():
+    try:
+        with open(_ACTIVE_DICTIONARIES_PATH, 'r', encoding='utf_8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def codec_for(category_key):
+    """The codec new records for category_key are written with: its active dictionary, or zlib."""
+    active = _read_active_dictionaries().get(category_key)
+    if active is None or zstandard is None:
+        return ZlibCodec()
+    return ZstdDictionaryCodec(_dictionary(active['dict_id']))
+
+
+def train_dictionary_from_samples(samples, dictionary_size=DICTIONARY_SIZE):
+    """A zstandard.ZstdCompressionDict trained on samples, a list of encoded records (bytes)."""
+    if zstandard is None:
+        raise ImportError('zstandard is needed to train a compression dictionary')
+    return zstandard.train_dictionary(dictionary_size, samples, level=ZSTD_LEVEL)
+
+
+def train_dictionary(category_key, store, n_samples=DICTIONARY_SAMPLES, dictionary_size=DICTIONARY_SIZE):
+    """Trains a dictionary on a random sample of the records in store (a PageStore) and makes
+    it the one new records for category_key are compressed with. Returns its ID, or None if
+    store has fewer than MIN_DICTIONARY_SAMPLES records."""
+    keys = list(store.keys())
+    if len(keys) < MIN_DICTIONARY_SAMPLES:
+        return None
+    samples = [_decode_bytes(store.get_raw(key)) for key in random.sample(keys, min(n_samples, len(keys)))]
+    dictionary = train_dictionary_from_samples(samples, dictionary_size)
+    DICTIONARY_DIR.mkdir(parents=True, exist_ok=True)
+    dict_id = dictionary.dict_id()
+    _write_atomic(DICTIONARY_DIR / '{}.zdict'.format(dict_id), dictionary.as_bytes())
+    codec = ZstdDictionaryCodec(dictionary)
+    record_size = sum(len(codec.encode(sample)) for sample in samples) / len(samples)
+    with _active_lock:
+        active = _read_active_dictionaries()
+        active[category_key] = {'dict_id': dict_id, 'record_size': record_size}
+        # readers in other threads and processes see either the old or the new file
+        _write_atomic(_ACTIVE_DICTIONARIES_PATH, json.dumps(active).encode('utf_8'))
+    return dict_id
+
+
+def update_dictionary(category_key, store):
+    """Trains a dictionary for category_key on store (a PageStore) if zstandard is installed and
+    the category has no dictionary yet, or if the records in store that were compressed with it
+    take RETRAIN_RATIO times the space they did at training time, e.g. because the markup changed."""
+    if zstandard is None:
+        return
+    active = _read_active_dictionaries().get(category_key)
+    if active is not None:
+        codec = ZstdDictionaryCodec(_dictionary(active['dict_id']))
+        keys = random.sample(list(store.keys()), min(DICTIONARY_SAMPLES, len(store)))
+        sizes = [len(raw) for raw in map(store.get_raw, keys) if codec.owns(raw)]
+        if len(sizes) < MIN_DICTIONARY_SAMPLES or sum(sizes) / len(sizes) < RETRAIN_RATIO * active['record_size']:
+            return
+    train_dictionary(category_key, store)
+
+
+class PageStoreWriter:
+    """Streams records into a page store. Use as a context manager.
+    codec defaults to ZlibCodec; see codec_for."""
+
+    def __init__(self, pages_path, index_path, append=False, codec=None):
+        pages_path.parent.mkdir(parents=True, exist_ok=True)
+        mode = 'ab' if append else 'wb'
+        if append:
+            _truncate_torn_line(index_path)
+        self.codec = codec or ZlibCodec()
+        self._pages_file = open(pages_path, mode)
+        self._index_file = open(index_path, mode.replace('b', ''), encoding='utf_8')
+        self._offset = self._pages_file.seek(0, 2)
+
+    def write(self, key, value):
+        self.write_raw(key, self.codec.encode(json.dumps(value).encode()))
+
+    def write_raw(self, key, value_bytes):
+        key_bytes = key.encode()
+        header = _HEADER.pack(len(key_bytes), len(value_bytes))
+        self._pages_file.write(header)
+        self._pages_file.write(key_bytes)
+        self._pages_file.write(value_bytes)
+        value_offset = self._offset + _HEADER.size + len(key_bytes)
+        self._index_file.write(json.dumps([key, value_offset, len(value_bytes)]) + '\n')
+        self._offset = value_offset + len(value_bytes)
+
+    def write_many(self, htmls):
+        for key, value in htmls.items():
+            self.write(key, value)
+
+    def flush(self):
+        self._pages_file.flush()
+        self._index_file.flush()
+
+    def close(self):
+        self._pages_file.close()
+        self._index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _truncate_torn_line(index_path):
+    """Cuts a line left half-written by a crash off the end of an index, so that the next
+    entry appended to it starts on a line of its own."""
+    try:
+        with open(index_path, 'rb+') as f:
+            size = f.seek(0, 2)
+            position = size
+            while position > 0:
+                block_start = max(0, position - 4096)
+                f.seek(block_start)
+                newline = f.read(position - block_start).rfind(b'\n')
+                if newline >= 0:
+                    position = block_start + newline + 1
+                    break
+                position = block_start
+            if position < size:
+                f.truncate(position)
+    except FileNotFoundError:
+        pass
+
+
+def _read_index(index_path):
+    index = {}
+    with open(index_path, 'r', encoding='utf_8') as f:
+        for line in f:
+            try:
+                key, offset, length = json.loads(line)
+            except ValueError:
+                # a crash mid-write can leave a torn line, which later entries may follow
+                continue
+            index[key] = (offset, length)
+    return index
+
+
+def rebuild_index(pages_path, index_path):
+    """Recreates the index by scanning the record headers of a .pages file."""
+    with open(pages_path, 'rb') as f, open(index_path, 'w', encoding='utf_8') as index_file:
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                break
+            key_length, value_length = _HEADER.unpack(header)
+            key = f.read(key_length).decode()
+            value_offset = f.tell()
+            if len(f.read(value_length)) < value_length:
+                break
+            index_file.write(json.dumps([key, value_offset, value_length]) + '\n')
+
+
+class PageStore:
+    """Random-access reader over a page store. Use as a context manager."""
+
+    def __init__(self, pages_path, index_path):
+        if not index_path.exists():
+            rebuild_index(pages_path, index_path)
+        self._index = _read_index(index_path)
+        self._file = open(pages_path, 'rb')
+        if self._file.seek(0, 2):
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._map = b''  # mmap refuses empty files
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def keys(self):
+        return self._index.keys()
+
+    def get(self, key):
+        offset, length = self._index[key]
+        return _decode_value(self._map[offset:offset + length])
+
+    def get_raw(self, key):
+        offset, length = self._index[key]
+        return self._map[offset:offset + length]
+
+    def get_bytes(self, key):
+        """The JSON encoding of the value for key."""
+        return _decode_bytes(self.get_raw(key))
+
+    def copy_to(self, writer, keys):
+        """Copies the records for keys into writer, without decoding the ones that are already
+        compressed with the writer's codec. Missing keys are skipped."""
+        for key in keys:
+            if key in self._index:
+                raw = self.get_raw(key)
+                if writer.codec.owns(raw):
+                    writer.write_raw(key, raw)
+                else:
+                    writer.write_raw(key, writer.codec.encode(_decode_bytes(raw)))
+
+    def read(self, keys=None):
+        """Returns a {key: value} dict for keys, or for every key if keys is None.
+
+        Keys that are not in the store are skipped."""
+        if keys is None:
+            keys = self._index.keys()
+        return {key: self.get(key) for key in keys if key in self._index}
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def store_paths(category_key, version_key='current'):
+    return _PAGES_FILEPATHS[version_key][category_key], _INDEX_FILEPATHS[version_key][category_key]
+
+
+def store_exists(category_key, version_key='current'):
+    return store_paths(category_key, version_key)[0].exists()
+
+
+def open_store(category_key, version_key='current'):
+    return PageStore(*store_paths(category_key, version_key))
+
+
+def open_store_writer(category_key, version_key='current', append=False):
+    return PageStoreWriter(*store_paths(category_key, version_key), append=append, codec=codec_for(category_key))
+
+
+def read_store(category_key, keys=None, version_key='current'):
+    with open_store(category_key, version_key) as store:
+        return store.read(keys)
+
+
+def write_store(htmls, category_key, version_key='current'):
+    with open_store_writer(category_key, version_key) as writer:
+        writer.write_many(htmls)
+
+
+def recompress_store(category_key, version_key='current'):
+    """Rewrites a store with the current codec for category_key, e.g. after training a new dictionary."""
+    pages_path, index_path = store_paths(category_key, version_key)
+    tmp_pages_path, tmp_index_path = pages_path.with_suffix('.pages.tmp'), index_path.with_suffix('.index.tmp')
+    with open_store(category_key, version_key) as store, \
+            PageStoreWriter(tmp_pages_path, tmp_index_path, codec=codec_for(category_key)) as writer:
+        store.copy_to(writer, list(store.keys()))
+    tmp_pages_path.replace(pages_path)
+    tmp_index_path.replace(index_path)
+
+
+def compress_stores():
+    """Trains or retrains the dictionaries (see update_dictionary) on the current stores,
+    and recompresses the current and previous stores with them."""
+    for category_key in crawler.utils.CATEGORY_KEYS:
+        if not store_exists(category_key):
+            continue
+        with open_store(category_key) as store:
+            update_dictionary(category_key, store)
+        for version_key in crawler.utils.VERSION_KEYS:
+            if store_exists(category_key, version_key):
+                recompress_store(category_key, version_key)
+
+
+def read_validators(category_key, version_key='current'):
+    """Returns the {url: {'etag': ..., 'last_modified': ...}} HTTP validators saved with a store."""
+    try:
+        with open(_VALIDATORS_FILEPATHS[version_key][category_key], 'r', encoding='utf_8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_validators(validators, category_key, version_key='current'):
+    path = _VALIDATORS_FILEPATHS[version_key][category_key]
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', encoding='utf_8') as f:
+        json.dump(validators, f)
+
+
+def rotate_store(category_key):
+    """Moves the current store for category_key to the previous slot."""
+    current_paths = [*store_paths(category_key, 'current'), _VALIDATORS_FILEPATHS['current'][category_key]]
+    previous_paths = [*store_paths(category_key, 'previous'), _VALIDATORS_FILEPATHS['previous'][category_key]]
+    for current_path, previous_path in zip(current_paths, previous_paths):
+        if current_path.exists():
+            previous_path.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(current_path), str(previous_path))
+
+
+def checkpoint_paths(category_key):
+    base_path = _CHECKPOINT_DIR / category_key
+    return base_path.with_suffix('.pages'), base_path.with_suffix('.index')
+
+
+def checkpoint_age(category_key):
+    """Seconds since the checkpoint for category_key was last written, or None if there is none."""
+    pages_path = checkpoint_paths(category_key)[0]
+    if not pages_path.exists():
+        return None
+    return time.time() - pages_path.stat().st_mtime
+
+
+def read_checkpoint(category_key, keys=None):
+    if checkpoint_age(category_key) is None:
+        return {}
+    with PageStore(*checkpoint_paths(category_key)) as store:
+        return store.read(keys)
+
+
+def open_checkpoint_writer(category_key):
+    return PageStoreWriter(*checkpoint_paths(category_key), append=True, codec=codec_for(category_key))
+
+
+def clear_checkpoint(category_key):
+    for path in checkpoint_paths(category_key):
+        if path.exists():
+            path.unlink()
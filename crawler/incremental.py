@@ -0,0 +1,38 @@
+import pandas as pd
+import crawler.flags
+from crawler.utils import read_data
+
+# overview columns that, if unchanged, mean the player's detail page is assumed unchanged too
+OVERVIEW_CHANGE_COLS = ['overall', 'potential', 'eur_value', 'eur_wage', 'club', 'special']
+
+
+def changed_IDs(overview_data, previous_overview_data):
+    """Returns the IDs in overview_data that are new or whose OVERVIEW_CHANGE_COLS differ
+    from previous_overview_data."""
+    merged = overview_data[['ID', *OVERVIEW_CHANGE_COLS]].merge(
+        previous_overview_data[['ID', *OVERVIEW_CHANGE_COLS]].drop_duplicates('ID'),
+        on='ID', how='left', suffixes=('', '_previous'), indicator=True)
+    changed = merged['_merge'] == 'left_only'
+    for col in OVERVIEW_CHANGE_COLS:
+        # categorical columns can only be compared if their categories match
+        new, old = merged[col].astype(object), merged[col + '_previous'].astype(object)
+        changed |= ~((new == old) | (new.isnull() & old.isnull()))
+    return merged.loc[changed, 'ID']
+
+
+def get_reusable_player_data(overview_data, version_key='current'):
+    """Returns the rows of the last exported player table that can be reused for overview_data.
+
+    A row is reusable if its player's overview row is unchanged since that export.
+    Returns None if there is no previous export to compare against."""
+    try:
+        previous_overview_data = read_data('overview', version_key)
+        previous_player_data = read_data('player', version_key)
+    except FileNotFoundError:
+        return None
+    # exports from before the flags were packed have a bool column per flag
+    previous_player_data = crawler.flags.to_packed(previous_player_data)
+    changed = changed_IDs(overview_data, previous_overview_data)
+    reusable = (previous_player_data['ID'].isin(overview_data['ID'])
+                & ~previous_player_data['ID'].isin(changed))
+    return previous_player_data[reusable].reset_index(drop=True)
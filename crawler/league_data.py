@@ -1,9 +1,16 @@
 import pandas as pd
 import parsel
 from crawler.html_download import get_league_overview_html, get_league_htmls
+import crawler.extraction
+import crawler.schema
+from crawler.utils import DEFAULT_ENGINE
 
-def get_league_IDs(from_file=False, update_html_store=False):
-    html = get_league_overview_html(from_file, update_html_store)
+def get_league_IDs(from_file=False, update_html_store=False, engine=DEFAULT_ENGINE):
+    page_functions = crawler.extraction.get_page_functions('league_overview', engine)
+    return get_league_overview_html(from_file, update_html_store, page_functions)
+
+
+def parse_league_overview(html):
     selector = parsel.Selector(html)
     league_id_dict = {}
     for row_selector in selector.xpath('./body/table/tbody/tr'):
@@ -22,21 +29,16 @@ def parse_single_league_page(html, league_name):
     club_names = selector.xpath('./body/tbody/tr/td/a/text()').extract()
     return [{'club': club, 'league':league_name} for club in club_names]
 
-def parse_league_data(league_htmls_dict, league_id_dict):
-    league_name_html_dict = {}
-    for url, html in league_htmls_dict.items():
-        ID = url.split('/')[-1]
-        league_name = league_id_dict[ID]
-        league_name_html_dict[league_name] = html
-    page_dict_lists = []
-    for league_name, html in league_name_html_dict.items():
-        page_dicts = parse_single_league_page(html, league_name)
-        page_dict_lists.append(page_dicts)
+def _league_clubs_to_df(league_clubs_dict, league_id_dict, quarantine_dir=crawler.schema.QUARANTINE_DIR):
     data = []
-    for sub_list in page_dict_lists:
-        data.extend(sub_list)
-    return pd.DataFrame(data)
+    for url, clubs in league_clubs_dict.items():
+        league_name = league_id_dict[url.split('/')[-1]]
+        data.extend({'club': club, 'league': league_name} for club in clubs)
+    return crawler.schema.apply_schema(pd.DataFrame(data, columns=['club', 'league']), crawler.schema.league_schema(),
+                                       'league', quarantine_dir)
+
 
-def get_league_data(league_IDs, from_file=False, update_html_store=False):
-    league_htmls_dict = get_league_htmls(league_IDs, from_file, update_html_store)
-    return parse_league_data(league_htmls_dict, league_IDs)
+def get_league_data(league_IDs, from_file=False, update_html_store=False, engine=DEFAULT_ENGINE):
+    page_functions = crawler.extraction.get_page_functions('league', engine)
+    league_clubs_dict = get_league_htmls(league_IDs, from_file, update_html_store, page_functions)
+    return _league_clubs_to_df(league_clubs_dict, league_IDs)
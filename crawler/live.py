@@ -0,0 +1,221 @@
+"""Fetches single players on demand between crawls, for services that need fresh data.
+
+    async with PlayerFetcher() as fetcher:
+        record = await fetcher.fetch_player(158023)
+
+or, with a fetcher shared by the whole event loop, await fetch_player(158023).
+
+The pages are downloaded over one keep-alive aiohttp session, with the downloader's
+retries, and parsed by the engine's extract_page (the same parser as the crawl, see
+crawler.extraction) in a process pool, so parsing never blocks the event loop. The
+record is what parse_single_player_page returns; player_frame turns records into rows
+of the player table.
+
+Records are kept in an LRU cache of at most max_size players for ttl seconds, so hot
+players are answered without touching the network. Concurrent requests for a player
+that isn't cached share a single fetch. Once a record expires, its page is requested
+conditionally, and a 304 renews the record without parsing it again. Requests to the
+site are capped at max_concurrency at a time and, with a token bucket, at rate per
+second on average, however bursty the load.
+"""
+import asyncio
+import collections
+import time
+
+import aiohttp
+
+import crawler.downloader
+import crawler.executor
+import crawler.extraction
+import crawler.html_download
+import crawler.metrics
+import crawler.player_data
+from crawler.utils import DEFAULT_ENGINE, read_constants
+
+TTL_SECONDS = 15 * 60
+MAX_SIZE = 10000
+MAX_CONCURRENCY = 8
+RATE = 10.0  # requests per second
+BURST = 20  # requests that can be made at once after an idle period
+MAX_RETRIES = 2
+
+_Entry = collections.namedtuple('_Entry', ['expires', 'record', 'validator'])
+
+
+class TTLCache:
+    """An LRU cache whose entries expire ttl seconds after they are put. Expired entries
+    are kept, until evicted, so they can be revalidated; see get_entry."""
+
+    def __init__(self, max_size=MAX_SIZE, ttl=TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+
+    def get_entry(self, key):
+        """The (expires, record, validator) entry for key, expired or not, or None."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def get(self, key):
+        """The record for key, or None if it isn't cached or has expired."""
+        entry = self.get_entry(key)
+        if entry is None or entry.expires <= time.monotonic():
+            return None
+        return entry.record
+
+    def put(self, key, record, validator=None):
+        self._entries[key] = _Entry(time.monotonic() + self.ttl, record, validator)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RateLimiter:
+    """Token bucket: acquire waits until a request can be made without averaging more
+    than rate per second, allowing bursts of up to burst requests."""
+
+    def __init__(self, rate=RATE, burst=BURST):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def _parse_player_page(extract_page, url, html):
+    """Runs in the pool: only the record is sent back, not the fragment."""
+    return extract_page(url, html)[1]
+
+
+class PlayerFetcher:
+    """Fetches, parses and caches player records; see the module docstring. Use as an async
+    context manager, or call close, so the session and the parse processes are shut down.
+
+    Parameters
+    ----------
+    ttl, max_size : seconds a record is served from the cache, and number of players kept.
+    max_concurrency : requests to the site at a time.
+    rate, burst : average requests per second to the site, and the burst allowed after an idle period.
+    engine : crawler.extraction engine.
+    n_processes : parse processes, defaults to crawler.executor.N_PROCESSES.
+    """
+
+    def __init__(self, ttl=TTL_SECONDS, max_size=MAX_SIZE, max_concurrency=MAX_CONCURRENCY, rate=RATE,
+                 burst=BURST, engine=DEFAULT_ENGINE, n_processes=None):
+        self.cache = TTLCache(max_size, ttl)
+        self.constants = read_constants()
+        self._limiter = RateLimiter(rate, burst)
+        self._max_concurrency = max_concurrency
+        self._extract_page = crawler.extraction.get_page_functions('player', engine).extract_page
+        self._n_processes = n_processes
+        self._session = None
+        self._pool = None
+        self._in_flight = {}
+
+    def _start(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self._max_concurrency, keepalive_timeout=60)
+            timeout = aiohttp.ClientTimeout(total=crawler.downloader.REQUEST_TIMEOUT)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._pool = crawler.executor.create_pool(self.constants, self._n_processes)
+
+    async def fetch_player(self, ID):
+        """The parsed record of player ID, from the cache if it is fresh. Raises
+        aiohttp.ClientResponseError for players the site doesn't have."""
+        ID = int(ID)
+        record = self.cache.get(ID)
+        if record is not None:
+            crawler.metrics.increment('live.cache_hits')
+            return record
+        if ID in self._in_flight:
+            crawler.metrics.increment('live.coalesced')
+        else:
+            self._start()
+            future = asyncio.ensure_future(self._refresh(ID))
+            future.add_done_callback(lambda done: self._on_done(ID, done))
+            self._in_flight[ID] = future
+        # shielded, so a caller that gives up doesn't cancel the fetch for the others
+        return await asyncio.shield(self._in_flight[ID])
+
+    async def fetch_players(self, IDs):
+        """{ID: record} for several players, fetched concurrently."""
+        records = await asyncio.gather(*(self.fetch_player(ID) for ID in IDs))
+        return dict(zip(IDs, records))
+
+    def _on_done(self, ID, future):
+        del self._in_flight[ID]
+        if not future.cancelled():
+            # retrieved here, so it isn't reported as never retrieved if every caller gave up
+            future.exception()
+
+    async def _refresh(self, ID):
+        url = crawler.html_download.get_player_urls([ID])[0]
+        entry = self.cache.get_entry(ID)
+        validators = {url: entry.validator} if entry is not None and entry.validator else {}
+        await self._limiter.acquire()
+        crawler.metrics.increment('live.requests')
+        html = await crawler.downloader._fetch_with_retries(self._session, url, validators, MAX_RETRIES,
+                                                            crawler.downloader.BACKOFF_BASE,
+                                                            crawler.downloader.BACKOFF_CAP)
+        if html is crawler.downloader.NOT_MODIFIED:
+            record = entry.record
+        else:
+            record = await asyncio.get_running_loop().run_in_executor(self._pool, _parse_player_page,
+                                                                      self._extract_page, url, html)
+        self.cache.put(ID, record, validators.get(url))
+        return record
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._pool.shutdown()
+            self._session = self._pool = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+_default_fetchers = {}
+
+
+def default_fetcher():
+    """The PlayerFetcher shared by the running event loop, created with the default settings."""
+    loop = asyncio.get_running_loop()
+    if loop not in _default_fetchers:
+        _default_fetchers[loop] = PlayerFetcher()
+    return _default_fetchers[loop]
+
+
+async def fetch_player(ID):
+    """PlayerFetcher.fetch_player with the running loop's default_fetcher."""
+    return await default_fetcher().fetch_player(ID)
+
+
+async def close_default_fetcher():
+    fetcher = _default_fetchers.pop(asyncio.get_running_loop(), None)
+    if fetcher is not None:
+        await fetcher.close()
+
+
+def player_frame(records, constants=None):
+    """Rows of the player table (see crawler.player_data.clean_player_detailed_data) for records."""
+    constants = constants or read_constants()
+    data = crawler.player_data._typed_player_table(list(records), constants).to_pandas()
+    return crawler.player_data.clean_player_detailed_data(data, constants)
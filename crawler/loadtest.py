@@ -0,0 +1,132 @@
+"""Load test of the download pipeline against a local stand-in of sofifa (see crawler.standin).
+
+    python -m crawler.loadtest --players 5000 --workers 25 50 100 --latency lognormal 0.05 0.5 --rate-limit 0.01
+
+For each number of download workers, a fresh stand-in is started and every page of its
+synthetic site is downloaded, filtered and parsed by crawler.pipeline, as in a real crawl
+but without touching the html store. Reports pages per second, retries and failures,
+the stand-in's latency percentiles and busiest moment, and the peak memory of the crawler
+and its parse workers. Every run is appended to data/loadtests/results.jsonl.
+"""
+import argparse
+import json
+import multiprocessing
+import time
+
+import crawler.downloader
+import crawler.executor
+import crawler.extraction
+import crawler.fixtures
+import crawler.metrics
+import crawler.pipeline
+import crawler.standin
+import crawler.utils
+from crawler.player_data import pack_player_records
+from crawler.utils import DATA_DIR, DEFAULT_ENGINE, read_constants
+
+RESULTS_PATH = DATA_DIR / 'loadtests' / 'results.jsonl'
+
+
+def _ignore_chunk(urls, fragments, collected):
+    pass
+
+
+def _category_urls(universe):
+    return {'overview': [crawler.fixtures.overview_url(offset) for offset in universe.overview_offsets()],
+            'league_overview': [crawler.utils.BASE_URL + '/leagues'],
+            'league': [crawler.fixtures.league_url(league_ID) for league_ID in universe.league_IDs],
+            'player': [crawler.fixtures.player_url(ID) for ID in universe.player_IDs]}
+
+
+def run_crawl(base_url, n_players, n_workers, engine=DEFAULT_ENGINE, n_processes=None):
+    """Downloads and parses every page of a stand-in at base_url, and returns the timings and counters."""
+    crawler.utils.BASE_URL = base_url
+    crawler.downloader.N_WORKERS = n_workers
+    crawler.metrics.reset()
+    constants = read_constants()
+    failures = {}
+    start = time.perf_counter()
+    for category_key, urls in _category_urls(crawler.fixtures.Universe(n_players)).items():
+        page_functions = crawler.extraction.get_page_functions(category_key, engine)
+        collect_func = pack_player_records if category_key == 'player' else None
+        with crawler.metrics.span(category_key):
+            failures.update(crawler.pipeline.run_pipeline(urls, page_functions.extract_page, _ignore_chunk,
+                                                          collect_func=collect_func, constants=constants,
+                                                          n_processes=n_processes))
+    seconds = time.perf_counter() - start
+    report = crawler.metrics.report()
+    counters = report['counters']
+    return {'seconds': seconds,
+            'pages_per_second': counters.get('pages_fetched', 0) / seconds,
+            'stage_seconds': {path: entry['seconds'] for path, entry in report['spans'].items()},
+            'pages_fetched': counters.get('pages_fetched', 0),
+            'bytes_downloaded': counters.get('bytes_downloaded', 0),
+            'retries': counters.get('retries', 0),
+            'failures': len(failures),
+            'peak_rss': report['peak_rss']}
+
+
+def _run_crawl_in_process(queue, *args):
+    queue.put(run_crawl(*args))
+
+
+def run_load_test(standin, n_workers, engine=DEFAULT_ENGINE, n_processes=None):
+    """Starts standin in its own process and crawls it in another, so the peak memory
+    reported is the crawler's alone. Returns the result record."""
+    context = multiprocessing.get_context('spawn')
+    with crawler.standin.StandInProcess(standin) as server:
+        queue = context.Queue()
+        process = context.Process(target=_run_crawl_in_process,
+                                  args=(queue, server.base_url, standin.universe.n_players, n_workers, engine,
+                                        n_processes))
+        process.start()
+        crawl = queue.get()
+        process.join()
+        server_stats = server.stats()
+    return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'n_players': standin.universe.n_players,
+            'n_workers': n_workers,
+            'n_processes': crawler.executor.resolve_n_processes(n_processes),
+            'engine': engine,
+            'standin': {'latency': standin.latency, 'rate_limit_rate': standin.rate_limit_rate,
+                        'error_rate': standin.error_rate, 'slow_body_rate': standin.slow_body_rate,
+                        'reset_rate': standin.reset_rate},
+            'crawl': crawl,
+            'server': server_stats}
+
+
+def record_result(result, path=RESULTS_PATH):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'a', encoding='utf_8') as f:
+        f.write(json.dumps(result) + '\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    crawler.standin.add_arguments(parser)
+    parser.add_argument('--workers', type=int, nargs='+', default=[crawler.downloader.N_WORKERS],
+                        help='numbers of download workers to try')
+    parser.add_argument('--processes', type=int, help='parse worker processes, defaults to the number of cpus')
+    parser.add_argument('--engine', default=DEFAULT_ENGINE, choices=sorted(crawler.extraction.ENGINES))
+    parser.add_argument('--no-record', action='store_true', help="don't append the results to " + str(RESULTS_PATH))
+    args = parser.parse_args(argv)
+    if args.recorded_dir:
+        parser.error('the load test crawls the synthetic site, --recorded-dir is only for crawler.standin')
+    standin = crawler.standin.from_arguments(args)
+    for n_workers in args.workers:
+        result = run_load_test(standin, n_workers, args.engine, args.processes)
+        crawl, server = result['crawl'], result['server']
+        print('{} workers: {} pages in {:.2f}s, {:.1f} pages/s, {} retries, {} failures, '
+              'peak RSS {:.0f} MB (+{:.0f} MB in parse workers)'.format(
+                  n_workers, crawl['pages_fetched'], crawl['seconds'], crawl['pages_per_second'], crawl['retries'],
+                  crawl['failures'], crawl['peak_rss']['self'] / 2 ** 20, crawl['peak_rss']['children'] / 2 ** 20))
+        print('  stand-in: {} requests {}, latency {}, at most {} in flight'.format(
+            server['requests'], server['statuses'],
+            ', '.join('{} {:.3f}s'.format(name, value) for name, value in server['seconds'].items()
+                      if value is not None), server['max_in_flight']))
+        if not args.no_record:
+            record_result(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,36 +1,90 @@
 from crawler.overview_data import get_overview_data
 from crawler.player_data import get_player_detailed_data
 from crawler.league_data import get_league_IDs, get_league_data
+from crawler.incremental import get_reusable_player_data
+from crawler.utils import DEFAULT_ENGINE, read_constants
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import functools
 import shutil
+import crawler.assets
+import crawler.diff
+import crawler.export
+import crawler.flags
+import crawler.metrics
+import crawler.query
+import crawler.scheduler
+import crawler.schema
+import crawler.sharding
+import crawler.similarity
+import crawler.snapshots
 import crawler.utils
 
 _FEATHER_FILEPATHS = crawler.utils.filepath_tree('final', '.feather')
 _CSV_FILEPATHS = crawler.utils.filepath_tree('final', '.csv')
 
-def save_data(data, category_key):
-    """Saves df to .feather and .csv"""
+def write_files(data, feather_path, csv_path, parquet_data=None, parquet_path=None, partition_cols=('league',)):
+    """Writes data to feather_path and csv_path, and parquet_data (if given) to a Parquet
+    dataset at parquet_path partitioned by partition_cols. The files are written concurrently."""
+    writers = [functools.partial(data.to_feather, str(feather_path)),
+               # the CSV keeps a bool column per flag, so it can be read without crawler.flags
+               functools.partial(crawler.flags.to_wide(data).to_csv, str(csv_path), index=False, encoding='utf_8')]
+    if parquet_data is not None:
+        writers.append(functools.partial(crawler.export.write_parquet, parquet_data, None, partition_cols,
+                                         path=parquet_path))
+    with ThreadPoolExecutor(len(writers)) as executor:
+        futures = [executor.submit(writer) for writer in writers]
+    for future in futures:
+        future.result()
+
+def save_data(data, category_key, parquet_data=None, partition_cols=('league',)):
+    """Saves df to .feather and .csv, and parquet_data (if given) to a Parquet dataset
+    partitioned by partition_cols; see write_files.
+    The query store and similarity index (see crawler.query and crawler.similarity) are
+    rebuilt afterwards for the categories that have them."""
     version_key = 'current'
-    feather_path = str(_FEATHER_FILEPATHS[version_key][category_key])
-    data.to_feather(feather_path)
-    csv_path = str(_CSV_FILEPATHS[version_key][category_key])
-    data.to_csv(csv_path, index=False, encoding='utf_8')
+    write_files(data, _FEATHER_FILEPATHS[version_key][category_key], _CSV_FILEPATHS[version_key][category_key],
+                parquet_data, crawler.export.parquet_path(category_key, version_key), partition_cols)
+    if category_key in crawler.query.QUERY_CATEGORIES:
+        # written after the feather file so that the store isn't treated as stale
+        crawler.query.build_query_store(data, category_key, version_key)
+    if category_key in crawler.similarity.SIMILARITY_CATEGORIES:
+        crawler.similarity.build_similarity_index(data, category_key, version_key)
 
 def move_if_exists(src, dst):
     try:
-        shutil.move(src, dst)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        if dst.is_dir():
+            # shutil.move would put src inside dst instead of replacing it
+            shutil.rmtree(dst)
+        shutil.move(str(src), str(dst))
     except FileNotFoundError:
         pass
 
-def update_data(data, category_key):
+def update_data(data, category_key, parquet_data=None, partition_cols=('league',)):
     csv_path_current = _CSV_FILEPATHS['current'][category_key]
     csv_path_previous = _CSV_FILEPATHS['previous'][category_key]
     feather_path_current = _FEATHER_FILEPATHS['current'][category_key]
     feather_path_previous = _FEATHER_FILEPATHS['previous'][category_key]
     move_if_exists(csv_path_current, csv_path_previous)
     move_if_exists(feather_path_current, feather_path_previous)
-    save_data(data, category_key)
+    if parquet_data is not None:
+        move_if_exists(crawler.export.parquet_path(category_key, 'current'),
+                       crawler.export.parquet_path(category_key, 'previous'))
+    move_if_exists(crawler.query.query_dir(category_key, 'current'), crawler.query.query_dir(category_key, 'previous'))
+    move_if_exists(crawler.similarity.similarity_dir(category_key, 'current'),
+                   crawler.similarity.similarity_dir(category_key, 'previous'))
+    save_data(data, category_key, parquet_data, partition_cols)
+
+def _with_partition_cols(data, complete_data, partition_cols):
+    """Adds the partition columns that data doesn't have, looked up by ID in complete_data."""
+    missing_cols = [col for col in partition_cols if col not in data.columns]
+    if not missing_cols:
+        return data
+    return data.merge(complete_data[['ID', *missing_cols]], on='ID', how='left')
 
-def get_complete_data(player_overview_data, league_data, player_detailed_data):
+def get_complete_data(player_overview_data, league_data, player_detailed_data, constants=None):
     col_order = ['ID', 'name', 'full_name', 'club', 'club_logo', 'special',
                  'age', 'league', 'birth_date', 'height_cm', 'weight_kg',
                  'body_type', 'real_face', 'flag', 'nationality', 'photo', 'eur_value',
@@ -48,41 +102,17 @@ def get_complete_data(player_overview_data, league_data, player_detailed_data):
                  'gk_reflexes', 'rs', 'rw', 'rf', 'ram', 'rcm', 'rm', 'rdm',
                  'rcb', 'rb', 'rwb', 'st', 'lw', 'cf', 'cam', 'cm', 'lm', 'cdm',
                  'cb', 'lb', 'lwb', 'ls', 'lf', 'lam', 'lcm', 'ldm', 'lcb', 'gk',
-                 '1_on_1_rush_trait', 'acrobatic_clearance_trait', 'argues_with_officials_trait',
-                 'avoids_using_weaker_foot_trait', 'backs_into_player_trait', 'bicycle_kicks_trait',
-                 'cautious_with_crosses_trait', 'chip_shot_trait', 'chipped_penalty_trait',
-                 'comes_for_crosses_trait', 'corner_specialist_trait', 'diver_trait',
-                 'dives_into_tackles_trait', 'diving_header_trait', 'driven_pass_trait',
-                 'early_crosser_trait', "fan's_favourite_trait", 'fancy_flicks_trait',
-                 'finesse_shot_trait', 'flair_trait', 'flair_passes_trait',
-                 'gk_flat_kick_trait', 'gk_long_throw_trait', 'gk_up_for_corners_trait',
-                 'giant_throw_in_trait', 'inflexible_trait', 'injury_free_trait',
-                 'injury_prone_trait', 'leadership_trait', 'long_passer_trait',
-                 'long_shot_taker_trait', 'long_throw_in_trait', 'one_club_player_trait',
-                 'outside_foot_shot_trait', 'playmaker_trait', 'power_free_kick_trait',
-                 'power_header_trait', 'puncher_trait', 'rushes_out_of_goal_trait',
-                 'saves_with_feet_trait', 'second_wind_trait', 'selfish_trait',
-                 'skilled_dribbling_trait', 'stutter_penalty_trait', 'swerve_pass_trait',
-                 'takes_finesse_free_kicks_trait', 'target_forward_trait', 'team_player_trait',
-                 'technical_dribbler_trait', 'tries_to_beat_defensive_line_trait',
-                 'poacher_speciality', 'speedster_speciality', 'aerial_threat_speciality',
-                 'dribbler_speciality', 'playmaker_speciality', 'engine_speciality',
-                 'distance_shooter_speciality', 'crosser_speciality',
-                 'free_kick_specialist_speciality', 'tackling_speciality', 'tactician_speciality',
-                 'acrobat_speciality', 'strength_speciality', 'clinical_finisher_speciality',
-                 'prefers_rs', 'prefers_rw', 'prefers_rf', 'prefers_ram', 'prefers_rcm',
-                 'prefers_rm', 'prefers_rdm', 'prefers_rcb', 'prefers_rb', 'prefers_rwb',
-                 'prefers_st', 'prefers_lw', 'prefers_cf', 'prefers_cam', 'prefers_cm',
-                 'prefers_lm', 'prefers_cdm', 'prefers_cb', 'prefers_lb', 'prefers_lwb',
-                 'prefers_ls', 'prefers_lf', 'prefers_lam', 'prefers_lcm', 'prefers_ldm',
-                 'prefers_lcb', 'prefers_gk']
+                 'traits_bits', 'specialities_bits', 'position_preferences_bits']
     complete_data = (player_overview_data
                      .merge(league_data, on='club', how='left')
                      .merge(player_detailed_data, on='ID'))[col_order]
-    return complete_data
+    return complete_data.pipe(crawler.schema.restore_dtypes,
+                              crawler.schema.complete_schema(constants or read_constants()))
 
 
-def main(from_file=False, update_html_store=True, transfer_old_data=True):
+def main(from_file=False, update_html_store=True, transfer_old_data=True, incremental=False,
+         engine=DEFAULT_ENGINE, parquet=True, partition_by_nationality=False, archive=True,
+         snapshot_version=None, profile=False, shard_workers=None, assets=False):
     """Creates and exports the full dataset.
 
     Parameters
@@ -90,26 +120,154 @@ def main(from_file=False, update_html_store=True, transfer_old_data=True):
     from_file : Boolean, default False
         If set to False, then the crawler will be called to download all the html from scratch.
     update_html_store : Boolean, default True
-        If set to True and from_file is set to false, the html .json files will be updated with the newly downloaded html.
-        Otherwise, the pre-existing .json files containing raw html will be used.
+        If set to True and from_file is set to false, the html store will be updated with the newly downloaded html.
+        Otherwise, the pre-existing html store will be used.
     transfer_old_data: Boolean, default True
-        Move the data in crawler/final/current to crawler/final/previous, instead of just overwriting it.
+        Move the data in crawler/final/current to crawler/final/previous, instead of just overwriting it,
+        and write the change log of the complete table (see crawler.diff).
+    incremental: Boolean, default False
+        Only download player pages for players that are new or whose overview data
+        (overall, potential, value, wage, club, special) changed since the last exported snapshot.
+        Everyone else keeps their row from that snapshot. Ignored if from_file is set to True.
+    engine: str, default 'lxml'
+        The crawler.extraction engine used to filter and parse pages. 'parsel' is the reference implementation.
+    parquet: Boolean, default True
+        Also export the overview, player and complete tables as Parquet datasets partitioned by league
+        (see crawler.export).
+    partition_by_nationality: Boolean, default False
+        Partition the Parquet datasets by nationality within each league as well.
+    archive: Boolean, default True
+        Add the complete table to the snapshot archive (see crawler.snapshots), which keeps every
+        version rather than just current and previous.
+    snapshot_version: str, optional
+        Name of the archived version, e.g. an edition or sofifa update date. Defaults to the crawl time.
+    profile: Boolean, default False
+        Sample the stacks of the parse workers and write them to data/metrics/profiles/ (see crawler.metrics).
+    shard_workers: int, optional
+        Download through a sharded crawl in crawler.sharding.SHARD_DIR with this many local worker
+        processes, or 0 to leave the shards to workers started elsewhere. Can't be combined with from_file
+        or incremental.
+    assets: Boolean, default False
+        Mirror the player photos, flags and club logos into data/assets (see crawler.assets), and export the
+        overview and complete tables with the paths of the mirrored images instead of their urls. The
+        snapshot archive keeps the urls, and so do the exports for images that couldn't be downloaded,
+        which are counted in the asset_failures counter of the metrics.
+
+    The time taken by each stage, the download and row counters and the peak memory use are
+    written to data/final/current/metrics.json and appended to data/metrics/history.jsonl,
+    also if the crawl fails, in which case the report records the error and the failed stages.
     """
+    if shard_workers is not None and (from_file or incremental):
+        raise ValueError("a sharded crawl downloads every page, so it can't be combined with from_file or incremental")
+    crawler.metrics.reset()
+    crawler.metrics.PROFILE_INTERVAL = crawler.metrics.DEFAULT_PROFILE_INTERVAL if profile else None
+    with crawler.metrics.reporting():
+        with crawler.metrics.span('main'):
+            results = crawler.scheduler.run_stages(_stages(from_file, update_html_store, transfer_old_data,
+                                                           incremental, engine, parquet, partition_by_nationality,
+                                                           archive, snapshot_version, shard_workers, assets))
+        for category_key in ['overview', 'player', 'league', 'complete']:
+            crawler.metrics.gauge('rows.' + category_key, len(results[category_key]))
 
-    player_overview_data = get_overview_data(from_file, update_html_store)
 
-    IDs = player_overview_data['ID']
-    league_IDs = get_league_IDs(from_file, update_html_store)
-    league_data = get_league_data(league_IDs, from_file, update_html_store)
-    player_detailed_data = get_player_detailed_data(IDs, from_file)
-    complete_data = get_complete_data(player_overview_data, league_data, player_detailed_data)
-    if transfer_old_data:
-        update_data(player_overview_data, 'overview')
-        update_data(player_detailed_data, 'player')
-        update_data(league_data, 'league')
-        update_data(complete_data, 'complete')
+def _stages(from_file, update_html_store, transfer_old_data, incremental, engine, parquet, partition_by_nationality,
+            archive, snapshot_version, shard_workers=None, assets=False):
+    """The stages of main() for crawler.scheduler.run_stages.
+
+    The league branch runs alongside the overview and player crawls. Unless the player
+    pages are read from file or fetched incrementally (which needs the complete overview
+    data first), the overview crawl streams the IDs it finds to the player crawl, which
+    starts downloading as soon as the first overview chunk is parsed. The concurrent crawls
+    share the requests in flight allowed by crawler.downloader.MAX_REQUESTS.
+    A sharded crawl replaces the overview, league and player crawls with a single stage.
+    The exports all wait for the complete table, so a failed crawl doesn't leave some
+    tables updated and others not, and then run in parallel. The images are mirrored while
+    the player pages are crawled, and the change log is written once the complete table is."""
+    partition_cols = ('league', 'nationality') if partition_by_nationality else ('league',)
+    save = update_data if transfer_old_data else save_data
+    stream_player_IDs = not (from_file or incremental)
+
+    def overview(player_IDs=None):
+        return get_overview_data(from_file, update_html_store, engine,
+                                 on_IDs=None if player_IDs is None else player_IDs.put)
+
+    def player(overview):
+        if incremental and not from_file:
+            previous_player_data = get_reusable_player_data(overview)
+        else:
+            previous_player_data = None
+        player_data = get_player_detailed_data(overview['ID'], from_file, update_html_store, previous_player_data,
+                                               engine)
+        return _in_overview_order(player_data, overview)
+
+    def mirror_images(overview):
+        manifest, failures = crawler.assets.mirror_table(overview)
+        # counted by mirror_assets; these keep their urls in the exports, and are tried again by the next crawl
+        if failures:
+            crawler.metrics.gauge('asset_failures.examples', {url: '{}: {}'.format(type(e).__name__, e)
+                                                              for url, e in list(failures.items())[:5]})
+        return manifest
+
+    def exporter(category_key):
+        def export(complete, **tables):
+            data = tables.get(category_key, complete)
+            if 'assets' in tables:
+                data = crawler.assets.localize(data, tables['assets'])
+            parquet_data = None
+            if parquet and category_key != 'league':
+                parquet_data = _with_partition_cols(data, complete, partition_cols)
+            save(data, category_key, parquet_data, partition_cols)
+        return export
+
+    stage = crawler.scheduler.stage
+    if shard_workers is not None:
+        stages = [stage('shards', lambda: crawler.sharding.crawl(shard_workers, crawler.sharding.SHARD_DIR,
+                                                                 engine, update_html_store)),
+                  stage('overview', lambda shards: shards['overview'], inputs=['shards']),
+                  stage('league', lambda shards: shards['league'], inputs=['shards']),
+                  stage('player', lambda shards, overview: _in_overview_order(shards['player'], overview),
+                        inputs=['shards', 'overview'])]
     else:
-        save_data(player_overview_data, 'overview')
-        save_data(player_detailed_data, 'player')
-        save_data(league_data, 'league')
-        save_data(complete_data, 'complete')
\ No newline at end of file
+        stages = [stage('overview', overview, produces=['player_IDs'] if stream_player_IDs else []),
+                  stage('league_IDs', lambda: get_league_IDs(from_file, update_html_store, engine)),
+                  stage('league', lambda league_IDs: get_league_data(league_IDs, from_file, update_html_store,
+                                                                     engine),
+                        inputs=['league_IDs'])]
+        if stream_player_IDs:
+            stages += [stage('player_pages', lambda player_IDs: get_player_detailed_data(
+                                 None, update_html_store=update_html_store, engine=engine,
+                                 ID_batches=player_IDs.batches()), streams=['player_IDs']),
+                       stage('player', _in_overview_order, inputs=['player_pages', 'overview'])]
+        else:
+            stages.append(stage('player', player, inputs=['overview']))
+    stages.append(stage('complete', lambda overview, league, player: get_complete_data(overview, league, player),
+                        inputs=['overview', 'league', 'player']))
+    if assets:
+        stages.append(stage('assets', mirror_images, inputs=['overview']))
+    for category_key in ['overview', 'player', 'league', 'complete']:
+        inputs = {'complete', category_key}
+        if assets and category_key in ['overview', 'complete']:
+            inputs.add('assets')
+        stages.append(stage('export/' + category_key, exporter(category_key), inputs=sorted(inputs)))
+    if transfer_old_data:
+        def changes(complete, **tables):
+            if 'assets' in tables:
+                # compared with the previous export, which has the paths of the mirrored images
+                complete = crawler.assets.localize(complete, tables['assets'])
+            return crawler.diff.update_change_log(complete)
+
+        inputs = ['complete', 'export/complete'] + (['assets'] if assets else [])
+        stages.append(stage('changes', changes, inputs=inputs))
+    if archive:
+        stages.append(stage('archive', lambda complete: crawler.snapshots.add_snapshot(complete, 'complete',
+                                                                                       snapshot_version),
+                            inputs=['complete']))
+    return stages
+
+
+def _in_overview_order(player_pages, overview):
+    """The player rows of the players in overview, in the same order."""
+    positions = pd.Index(overview['ID']).get_indexer(player_pages['ID'])
+    in_overview = positions >= 0
+    order = np.argsort(positions[in_overview], kind='stable')
+    return player_pages[in_overview].iloc[order].reset_index(drop=True)
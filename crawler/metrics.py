@@ -0,0 +1,192 @@
+"""Timing spans, counters and an optional sampling profiler for a crawl.
+
+Spans are nested with the span context manager and recorded by their path, e.g.
+'main/player/download'. Each thread nests its own spans; a thread started for part of
+a span can continue its path with inherit(stack()). Counters are incremented from anywhere in the main process
+(pages fetched, bytes downloaded, retries, quarantined rows, ...) and gauges hold
+single values such as the row count of each table. write_report saves everything,
+plus the peak RSS of the crawler and its worker processes, as JSON next to the data.
+The parse workers are started by a forkserver rather than by the crawler, so they send
+their own peak RSS back with their results (see record_worker_rss).
+The reporting context manager writes the report of a run whether it succeeds or fails.
+
+If PROFILE_INTERVAL is set, the parse workers sample their own stack every
+PROFILE_INTERVAL seconds of CPU time and write the counts to data/metrics/profiles/
+in the collapsed-stack format used by flame graph tools.
+"""
+import collections
+import contextlib
+import json
+import os
+import resource
+import signal
+import sys
+import threading
+import time
+
+from crawler.utils import DATA_DIR
+
+REPORT_PATH = DATA_DIR / 'final' / 'current' / 'metrics.json'
+HISTORY_PATH = DATA_DIR / 'metrics' / 'history.jsonl'
+PROFILE_DIR = DATA_DIR / 'metrics' / 'profiles'
+
+PROFILE_INTERVAL = None  # seconds of CPU time between stack samples in the parse workers
+DEFAULT_PROFILE_INTERVAL = 0.005
+
+_spans = collections.OrderedDict()
+_local = threading.local()
+_lock = threading.Lock()
+_counters = collections.Counter()
+_gauges = {}
+_started = time.time()
+_worker_rss = 0  # bytes, the largest peak reported through record_worker_rss
+
+_samples = collections.Counter()
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def stack():
+    """The names of the spans open in this thread, outermost first."""
+    return list(_stack())
+
+
+@contextlib.contextmanager
+def inherit(names):
+    """Nests the spans opened by this thread in the enclosed block under names, e.g. the
+    stack() of the thread that started it."""
+    previous, _local.stack = _stack(), list(names)
+    try:
+        yield
+    finally:
+        _local.stack = previous
+
+
+def reset():
+    global _started, _worker_rss
+    _spans.clear()
+    _local.stack = []
+    _counters.clear()
+    _gauges.clear()
+    _started = time.time()
+    _worker_rss = 0
+
+
+@contextlib.contextmanager
+def span(name):
+    """Times the enclosed block as a child of the enclosing span."""
+    names = _stack()
+    names.append(name)
+    path = '/'.join(names)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        names.pop()
+        with _lock:
+            entry = _spans.setdefault(path, {'seconds': 0.0, 'count': 0})
+            entry['seconds'] += seconds
+            entry['count'] += 1
+
+
+def increment(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+
+
+def gauge(name, value):
+    _gauges[name] = value
+
+
+def _maxrss(who):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(who).ru_maxrss * unit
+
+
+def own_peak_rss():
+    """Peak resident set size in bytes of the calling process, e.g. a parse worker."""
+    return _maxrss(resource.RUSAGE_SELF)
+
+
+def record_worker_rss(nbytes):
+    """Records the own_peak_rss() sent back by a worker process."""
+    global _worker_rss
+    with _lock:
+        _worker_rss = max(_worker_rss, nbytes)
+
+
+def peak_rss():
+    """Peak resident set size in bytes of this process and of its largest child: the largest
+    worker peak recorded with record_worker_rss, or the largest finished child process that
+    the crawler started itself, e.g. a shard worker. Workers that never reported aren't counted."""
+    return {'self': _maxrss(resource.RUSAGE_SELF),
+            'children': max(_worker_rss, _maxrss(resource.RUSAGE_CHILDREN))}
+
+
+def report(error=None):
+    """error: the exception that ended the run, if it failed."""
+    with _lock:
+        spans = {path: dict(entry) for path, entry in _spans.items()}
+    download_seconds = sum(entry['seconds'] for path, entry in spans.items() if path.endswith('/download'))
+    return {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(_started)),
+            'spans': spans,
+            'counters': dict(_counters),
+            'gauges': dict(_gauges),
+            'peak_rss': peak_rss(),
+            'pages_per_second': _counters['pages_fetched'] / download_seconds if download_seconds else None,
+            'status': 'ok' if error is None else 'failed',
+            'error': None if error is None else '{}: {}'.format(type(error).__name__, error)}
+
+
+def write_report(path=REPORT_PATH, history_path=HISTORY_PATH, error=None):
+    """Writes report(error) to path and appends it to history_path, and returns it."""
+    run_report = report(error)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', encoding='utf_8') as f:
+        json.dump(run_report, f, indent=1)
+    history_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(history_path, 'a', encoding='utf_8') as f:
+        f.write(json.dumps(run_report) + '\n')
+    return run_report
+
+
+@contextlib.contextmanager
+def reporting(path=REPORT_PATH, history_path=HISTORY_PATH):
+    """Calls write_report when the enclosed block exits, with the exception if it raised one."""
+    try:
+        yield
+    except BaseException as e:
+        write_report(path, history_path, error=e)
+        raise
+    write_report(path, history_path)
+
+
+def _sample_stack(signum, frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    _samples[';'.join(reversed(stack))] += 1
+
+
+def start_sampling(interval):
+    """Samples the stack of this process every interval seconds of CPU time. Unix only."""
+    signal.signal(signal.SIGPROF, _sample_stack)
+    signal.setitimer(signal.ITIMER_PROF, interval, interval)
+
+
+def flush_samples():
+    """Writes the samples collected so far by this process, if it is sampling."""
+    if not _samples:
+        return
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    with open(PROFILE_DIR / '{}.collapsed'.format(os.getpid()), 'w', encoding='utf_8') as f:
+        for stack, count in _samples.items():
+            f.write('{} {}\n'.format(stack, count))
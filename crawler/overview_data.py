@@ -1,9 +1,9 @@
-from multiprocessing import Pool, cpu_count
 import pandas as pd
-import numpy as np
 import parsel
-from crawler.utils import convert_currency, standardise_col_names
+from crawler.utils import standardise_col_names, DEFAULT_ENGINE
 from crawler.html_download import get_overview_htmls
+import crawler.extraction
+import crawler.schema
 
 
 def parse_single_row(row_selector):
@@ -45,32 +45,31 @@ def parse_single_overview_page(html):
     return row_dicts
 
 
-def parse_overview_data(overview_htmls):
-    pool = Pool(cpu_count())
-    htmls = list(overview_htmls.values())
-    data_lists = pool.map(parse_single_overview_page, htmls)
+def _overview_rows_to_df(data_lists):
     data = []
     for sub_list in data_lists:
         data.extend(sub_list)
     return pd.DataFrame(data)
 
 
-def clean_overview_data(df):
+def clean_overview_data(df, quarantine_dir=crawler.schema.QUARANTINE_DIR):
     return (df.drop_duplicates('ID')
-            .assign(EUR_value = lambda df: df['Value'].pipe(convert_currency),
-                    EUR_wage = lambda df: df['Wage'].pipe(convert_currency))
-            .drop(['Value', 'Wage'], axis=1))
+            .rename(columns={'Value': 'EUR_value', 'Wage': 'EUR_wage'})
+            [['ID', 'Name', 'Club', 'Club logo', 'Flag', 'Photo', 'Nationality',
+              'EUR_value', 'EUR_wage', 'Overall', 'Potential',
+              'Special', 'Age']]
+            .pipe(standardise_col_names)
+            .pipe(crawler.schema.apply_schema, crawler.schema.overview_schema(), 'overview', quarantine_dir)
+            .reset_index(drop=True))
 
-def get_overview_data(from_file=False, update_html_store=False):
-    overview_htmls = get_overview_htmls(from_file, update_html_store)
-    df = parse_overview_data(overview_htmls).pipe(clean_overview_data)
-    numeric_cols_to_be_converted = ['ID', 'Overall', 'Potential',
-                                    'Special', 'Age']
-    for col in numeric_cols_to_be_converted:
-        df.loc[:, col] = pd.to_numeric(df[col])
-    return (df[['ID', 'Name', 'Club', 'Club logo', 'Flag', 'Photo', 'Nationality',
-               'EUR_value', 'EUR_wage', 'Overall', 'Potential',
-               'Special', 'Age']]
-            .reset_index(drop=True)
-            .replace({'Club':{'':np.nan}})
-            .pipe(standardise_col_names))
\ No newline at end of file
+
+def get_overview_data(from_file=False, update_html_store=False, engine=DEFAULT_ENGINE, on_IDs=None):
+    """on_IDs: optional function called with the list of player IDs on each chunk of overview
+    pages as soon as it is parsed, e.g. to start fetching their player pages. IDs can repeat."""
+    page_functions = crawler.extraction.get_page_functions('overview', engine)
+    on_parsed = None
+    if on_IDs is not None:
+        def on_parsed(pages):
+            on_IDs([row['ID'] for rows in pages for row in rows])
+    overview_rows = get_overview_htmls(from_file, update_html_store, page_functions, on_parsed)
+    return _overview_rows_to_df(overview_rows.values()).pipe(clean_overview_data)
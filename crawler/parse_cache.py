@@ -0,0 +1,170 @@
+"""On-disk cache of parsed pages, keyed by the hash of the url and stored fragment.
+
+Reading the html store with from_file=True parses every fragment again, although the
+fragments rarely change between runs. With the cache, a fragment whose hash is already
+known is sent to the workers as its pickled parse result instead, so only the pages
+that are new or changed since the last run are parsed.
+
+Each category and engine has a SQLite database in data/parse_cache/. It is emptied when
+its parser version changes: a hash of the parse function's name, the constants and the source of
+crawler.extraction and of the parse functions it calls in the other modules (see
+PARSER_SOURCES). Changing the cleaning or merging code therefore keeps the cache.
+Entries that haven't been used in the last KEEP_RUNS runs are deleted.
+"""
+import ast
+import functools
+import hashlib
+import json
+import pickle
+import sqlite3
+from pathlib import Path
+
+import crawler.utils
+
+CACHE_DIR = crawler.utils.DATA_DIR / 'parse_cache'
+ENABLED = True
+KEEP_RUNS = 3
+
+# module file -> names of the functions that parse pages, or None for the whole module
+PARSER_SOURCES = {
+    'extraction.py': None,
+    'player_data.py': ['parse_main_attributes', 'parse_player_metadata', '_player_metadata_from_strings',
+                       '_get_traits_and_specialities_dict', 'parse_traits_and_specialities',
+                       '_traits_and_specialities_from_strings', 'parse_player_miscellaneous_data',
+                       '_player_miscellaneous_data_from_strings', 'get_position_ratings',
+                       'get_full_position_preferences', 'parse_single_player_page', 'id_from_url'],
+    'overview_data.py': ['parse_single_row', 'parse_single_overview_page'],
+    'league_data.py': ['parse_league_overview', 'parse_single_league_page'],
+    'utils.py': ['headline_attribute_from_line', 'parse_headline_attributes', 'headline_attributes_from_script'],
+    'flags.py': ['bitmask'],
+}
+
+# what the workers get for each page
+_CACHED = 'cached'  # the pickled parse result
+_FRAGMENT = 'fragment'  # the fragment, to be parsed
+
+
+def _parser_source():
+    sources = []
+    for filename, function_names in PARSER_SOURCES.items():
+        source = (Path(__file__).parent / filename).read_text(encoding='utf_8')
+        if function_names is None:
+            sources.append(source)
+            continue
+        definitions = {node.name: ast.get_source_segment(source, node) for node in ast.parse(source).body
+                       if isinstance(node, ast.FunctionDef)}
+        sources.extend(definitions[name] for name in function_names)
+    return '\n'.join(sources)
+
+
+@functools.lru_cache()
+def _source_hash():
+    return hashlib.blake2b(_parser_source().encode(), digest_size=16).hexdigest()
+
+
+def parser_version(parse_fragment, constants=None):
+    name = '{}.{}'.format(parse_fragment.__module__, parse_fragment.__qualname__)
+    return hashlib.blake2b(json.dumps([name, constants, _source_hash()], sort_keys=True).encode(),
+                           digest_size=16).hexdigest()
+
+
+def fragment_hash(url, fragment_bytes):
+    """Hash of a url and the JSON encoding of its stored fragment, as returned by PageStore.get_bytes.
+    Parsers can read the url too, e.g. for the player ID."""
+    digest = hashlib.blake2b(url.encode(), digest_size=16)
+    digest.update(fragment_bytes)
+    return digest.digest()
+
+
+class ParseCache:
+    """The cached parse results for one category and engine. Use as a context manager,
+    from a single thread; the entries are committed on close."""
+
+    def __init__(self, path, version):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(str(path))
+        self._connection.executescript('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);'
+                                       'CREATE TABLE IF NOT EXISTS entries '
+                                       '(hash BLOB PRIMARY KEY, value BLOB, last_used INTEGER);')
+        meta = dict(self._connection.execute('SELECT key, value FROM meta'))
+        if meta.get('version') != version:
+            self._connection.execute('DELETE FROM entries')
+        self.run = int(meta.get('run', 0)) + 1
+        self._connection.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                     [('version', version), ('run', str(self.run))])
+        self._used = []
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        """The pickled parse result for a fragment_hash, or None."""
+        row = self._connection.execute('SELECT value FROM entries WHERE hash = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._used.append((self.run, key))
+        return row[0]
+
+    def put_many(self, items):
+        """Stores (fragment_hash, pickled parse result) pairs."""
+        self._connection.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                                     [(key, value, self.run) for key, value in items])
+
+    def close(self):
+        self._connection.executemany('UPDATE entries SET last_used = ? WHERE hash = ?', self._used)
+        self._connection.execute('DELETE FROM entries WHERE last_used <= ?', (self.run - KEEP_RUNS,))
+        self._connection.commit()
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def cache_path(category_key, parse_fragment, name=None):
+    parts = [category_key, parse_fragment.__name__.strip('_')] + ([] if name is None else [name])
+    return CACHE_DIR / '{}.sqlite'.format('.'.join(parts))
+
+
+def open_cache(category_key, parse_fragment, constants=None, name=None):
+    """The cache of the results of parse_fragment (the parse_fragment of an engine's
+    crawler.extraction.PageFunctions) for category_key. name gives a separate cache, e.g.
+    for other constants, which would otherwise empty this one."""
+    return ParseCache(cache_path(category_key, parse_fragment, name), parser_version(parse_fragment, constants))
+
+
+def cached_page(cache, key, fragment_bytes):
+    """What parse_or_load expects for a fragment with the given fragment_hash."""
+    cached = cache.get(key)
+    if cached is None:
+        return _FRAGMENT, json.loads(fragment_bytes.decode())
+    return _CACHED, cached
+
+
+def cached_fragments(cache, store, urls):
+    """Yields (url, page, key) for the urls in store (a crawler.html_store.PageStore), where
+    page is what parse_or_load expects and key is the fragment_hash to store the result under."""
+    for url in urls:
+        if url not in store:
+            continue
+        fragment_bytes = store.get_bytes(url)
+        key = fragment_hash(url, fragment_bytes)
+        yield url, cached_page(cache, key, fragment_bytes), key
+
+
+def parse_or_load(parse_fragment, url, page):
+    """fragment_func for crawler.pipeline: returns (parsed, pickled parsed if it was just parsed, else None)."""
+    source, value = page
+    if source == _CACHED:
+        return pickle.loads(value), None
+    parsed = parse_fragment(url, value)
+    return parsed, pickle.dumps(parsed, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def collect_with_pickles(collect_func, results):
+    """collect_func for crawler.pipeline, to use with parse_or_load: returns (collected, pickles),
+    where collected is what collect_func (or no collect_func) would have returned."""
+    parsed = [result[0] for result in results]
+    return (parsed if collect_func is None else collect_func(parsed)), [result[1] for result in results]
@@ -0,0 +1,186 @@
+"""Streams pages from the downloader through filtering and parsing in worker processes.
+
+Downloaded pages are grouped into small chunks and sent to a process pool as they arrive,
+where each page is trimmed to its relevant fragment and parsed (see crawler.extraction).
+Only the fragments and the parsed results come back to the main process, so raw html
+never accumulates. The number of chunks waiting for a worker is capped; once the cap is
+reached, download workers stop fetching until a slot frees up. Inputs that fit in a
+single chunk, like the league overview page, are parsed in the calling process without
+starting any workers. Urls and fragments that only become known while the pipeline runs,
+e.g. from a crawler.scheduler.Stream, are fed to the same downloads and workers.
+
+The seconds spent on each page in the workers are added up in the pipeline_pages and
+pipeline_page_seconds counters (see crawler.metrics).
+"""
+import asyncio
+import contextlib
+import time
+
+import crawler.downloader
+import crawler.executor
+import crawler.metrics
+
+CHUNK_SIZE = 32
+
+# where a page handed to a worker came from
+_DOWNLOADED = 'downloaded'  # raw html, needs filtering
+_STORED = 'stored'  # fragment reused after a 304, the caller hasn't seen it yet
+_FRAGMENT = 'fragment'  # fragment the caller already has
+_END = object()
+
+
+async def _in_thread(iterable):
+    """Iterates over a blocking iterable without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    iterator = iter(iterable)
+    while True:
+        item = await loop.run_in_executor(None, next, iterator, _END)
+        if item is _END:
+            return
+        yield item
+
+
+def _process_chunk(pages, page_func, fragment_func, collect_func):
+    urls, fragments, parsed, timings = [], [], [], []
+    for url, page, source in pages:
+        start = time.perf_counter()
+        if source == _DOWNLOADED:
+            fragment, result = page_func(url, page)
+        else:
+            fragment = page if source == _STORED else None
+            result = None if fragment_func is None else fragment_func(url, page)
+        urls.append(url)
+        fragments.append(fragment)
+        parsed.append(result)
+        timings.append(time.perf_counter() - start)
+    collected = parsed if collect_func is None else collect_func(parsed)
+    crawler.metrics.flush_samples()
+    return urls, fragments, collected, timings, crawler.metrics.own_peak_rss()
+
+
+async def _run_pipeline(urls, fragments, batches, page_func, fragment_func, collect_func, on_chunk, validators,
+                        stored_fragments, constants, n_processes, max_pending, chunk_size, pool, timings):
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(max_pending)
+    pending = set()
+    errors = []
+    buffer = []
+
+    def on_result(chunk_urls, fragments, collected, chunk_timings, worker_rss):
+        timings.extend(chunk_timings)
+        crawler.metrics.record_worker_rss(worker_rss)
+        on_chunk(chunk_urls, fragments, collected)
+
+    def on_done(future):
+        slots.release()
+        pending.discard(future)
+        if future.exception() is not None:
+            errors.append(future.exception())
+        else:
+            on_result(*future.result())
+
+    with contextlib.ExitStack() as stack:
+        def get_pool():
+            nonlocal pool
+            if pool is None:
+                # started on the first full chunk, so that tiny inputs never start one
+                pool = stack.enter_context(crawler.executor.create_pool(constants, n_processes))
+            return pool
+
+        async def flush(last=False):
+            nonlocal buffer
+            chunk, buffer = buffer, []
+            if last and pool is None:
+                # everything fitted in this chunk, which is cheaper to parse here than to send to new workers
+                on_result(*crawler.executor.call_serial(_process_chunk, (chunk, page_func, fragment_func,
+                                                                         collect_func), constants))
+                return
+            await slots.acquire()
+            future = loop.run_in_executor(get_pool(), _process_chunk, chunk, page_func, fragment_func,
+                                          collect_func)
+            pending.add(future)
+            future.add_done_callback(on_done)
+
+        async def submit(url, page, source):
+            buffer.append((url, page, source))
+            if len(buffer) >= chunk_size:
+                await flush()
+
+        async def submit_fragments():
+            for url, fragment in fragments:
+                await submit(url, fragment, _FRAGMENT)
+
+        async def on_page(url, html):
+            if html is crawler.downloader.NOT_MODIFIED:
+                await submit(url, stored_fragments.get(url), _STORED)
+            else:
+                await submit(url, html, _DOWNLOADED)
+
+        async def url_batches():
+            async for batch_urls, batch_fragments in _in_thread(batches):
+                for url, fragment in batch_fragments:
+                    await submit(url, fragment, _FRAGMENT)
+                yield batch_urls
+
+        _, failures = await asyncio.gather(submit_fragments(), crawler.downloader.download_async(
+            urls, on_page, validators, url_batches=None if batches is None else url_batches()))
+        if buffer:
+            await flush(last=True)
+        while pending:
+            await asyncio.wait(list(pending))
+    if errors:
+        raise errors[0]
+    return failures
+
+
+def run_pipeline(urls, page_func, on_chunk, fragments=(), fragment_func=None, collect_func=None,
+                 validators=None, stored_fragments=None, constants=None, n_processes=None,
+                 max_pending=None, chunk_size=CHUNK_SIZE, pool=None, timings=None, batches=None):
+    """Downloads urls and filters/parses the pages in a process pool as they arrive.
+
+    Parameters
+    ----------
+    urls : list of urls to download.
+    page_func : picklable function (url, html) -> (fragment, parsed), run in the workers.
+    on_chunk : called in the main process as on_chunk(urls, fragments, collected) for every
+        chunk of pages. fragments holds the new fragment for each downloaded page, and None
+        for pages that were passed in through fragments.
+    fragments : iterable of (url, fragment) pairs that are already filtered (e.g. from a
+        checkpoint or the html store). These are only parsed.
+    fragment_func : optional picklable function (url, fragment) -> parsed, run in the workers.
+        If it is None, parsed is None for these pages.
+        Both functions can read constants through crawler.executor.worker_constants().
+    collect_func : optional picklable function (parsed list) -> collected, run in the
+        workers on each chunk, e.g. to pack the records into columns. If it is None,
+        collected is the list of parsed values.
+    validators, stored_fragments : see crawler.downloader.download. stored_fragments is a
+        mapping used to look up the fragment for urls that come back as 304.
+    n_processes : number of worker processes, defaults to crawler.executor.N_PROCESSES.
+    max_pending : maximum number of chunks waiting for or being processed by a worker,
+        defaults to twice the number of processes.
+    chunk_size : number of pages sent to a worker at a time.
+    pool : a crawler.executor.create_pool pool to use instead of starting one, for callers
+        that run many small pipelines. constants and n_processes are then the pool's.
+        Without one, a pool is started once there is more than a chunk of pages.
+    timings : optional list, extended with the seconds taken by each page in the workers.
+    batches : optional blocking iterable of (urls, fragments) pairs, handled like the
+        urls and fragments arguments as they arrive, e.g. crawler.scheduler.Stream.batches().
+        It is read in a thread, and validators can be filled in for a batch's urls before
+        it is yielded.
+
+    Returns the {url: exception} download failures. Exceptions raised in the workers are
+    re-raised once everything in flight has finished.
+    """
+    n_processes = crawler.executor.resolve_n_processes(n_processes)
+    max_pending = max_pending or 2 * n_processes
+    task_timings = []
+    try:
+        return asyncio.run(_run_pipeline(urls, fragments, batches, page_func, fragment_func, collect_func, on_chunk,
+                                         validators, stored_fragments, constants, n_processes, max_pending,
+                                         chunk_size, pool, task_timings))
+    finally:
+        summary = crawler.executor.summarise_timings(task_timings)
+        crawler.metrics.increment('pipeline_pages', summary['n_tasks'])
+        crawler.metrics.increment('pipeline_page_seconds', summary['total'])
+        if timings is not None:
+            timings.extend(task_timings)
@@ -1,9 +1,15 @@
+import json
 import pandas as pd
 import numpy as np
-from crawler.utils import parse_headline_attributes, read_constants, convert_currency, standardise_col_names
-from crawler.html_download import get_player_htmls
+from crawler.utils import parse_headline_attributes, read_constants, standardise_col_names, DEFAULT_ENGINE
+from crawler.html_download import get_player_htmls, get_player_htmls_in_batches
+import crawler.extraction
+import crawler.columnar
+import crawler.executor
+import crawler.flags
+import crawler.schema
 import parsel
-from multiprocessing import Pool, cpu_count
+import pyarrow as pa
 
 
 def parse_main_attributes(main_rectangle_selector):
@@ -18,11 +24,15 @@ def parse_main_attributes(main_rectangle_selector):
 
 def parse_player_metadata(metadata_selector):
 
-    attribute_dict = {}
     span_selector = metadata_selector.xpath('./body/div/div[1]/div/span')
     subspan_selector = span_selector.xpath('span')
     span_strings = [s.strip() for s in span_selector.xpath('text()').extract()]
     subspan_strings = [s.strip() for s in subspan_selector.xpath('text()').extract()]
+    return _player_metadata_from_strings(span_strings, subspan_strings)
+
+
+def _player_metadata_from_strings(span_strings, subspan_strings):
+    attribute_dict = {}
     attribute_dict['full_name'] = span_strings[0].strip()
     age_height_weight = span_strings[-1].split()
     attribute_dict['Birth date'] = ' '.join(age_height_weight[2:5]).replace(',', '').strip('(').strip(')')
@@ -36,24 +46,32 @@ def parse_player_metadata(metadata_selector):
 def _get_traits_and_specialities_dict(player_traits, player_specialities, all_traits, all_specialities):
     player_traits = [str(trait) + '_trait' for trait in player_traits]
     player_specialities = [str(spec) + '_speciality' for spec in player_specialities]
-    trait_dict = {trait: (trait in player_traits) for trait in all_traits}
-    speciality_dict = {speciality: (speciality in player_specialities) for speciality in all_specialities}
-    return {**trait_dict, **speciality_dict}
+    return {'traits_bits': crawler.flags.bitmask(player_traits, all_traits),
+            'specialities_bits': crawler.flags.bitmask(player_specialities, all_specialities)}
 
 
 def parse_traits_and_specialities(main_rectangle_selector_list, all_traits, all_specialities):
     div_selector = main_rectangle_selector_list[1].xpath('./body/div/div[last()]/div')
     if not div_selector:
-        player_traits, player_specialities = [np.nan], [np.nan]
+        ul_string_lists, first_ul_heading = None, None
     else:
         uls = div_selector.xpath('ul')
-        n_uls = len(uls)
+        ul_string_lists = [[s.strip() for s in ul.xpath('li/text()').extract()] for ul in uls]
+        first_ul_heading = uls[:1].xpath('../h5/text()').extract_first()
+    return _traits_and_specialities_from_strings(ul_string_lists, first_ul_heading, all_traits, all_specialities)
+
+
+def _traits_and_specialities_from_strings(ul_string_lists, first_ul_heading, all_traits, all_specialities):
+    """ul_string_lists is None if the player has no traits/specialities section."""
+    if ul_string_lists is None:
+        player_traits, player_specialities = [np.nan], [np.nan]
+    else:
+        n_uls = len(ul_string_lists)
         # if the player has both traits and specialities, we know traits come first
         # if they only have traits or only specialities, we need to work out which
         if n_uls == 1:
-            ul = uls[0]
-            ul_strings = [s.strip() for s in ul.xpath('li/text()').extract()]
-            ul_h5_text = ul.xpath('../h5/text()').extract_first().strip()
+            ul_strings = ul_string_lists[0]
+            ul_h5_text = first_ul_heading.strip()
             if ul_h5_text == 'Traits':
                 player_traits = ul_strings
                 player_specialities = [np.nan]
@@ -61,8 +79,8 @@ def parse_traits_and_specialities(main_rectangle_selector_list, all_traits, all_
                 player_traits = [np.nan]
                 player_specialities = ul_strings
         else:
-            player_traits = [s.strip() for s in uls[0].xpath('li/text()').extract()]
-            player_specialities = [s.strip() for s in uls[1].xpath('li/text()').extract()]
+            player_traits = ul_string_lists[0]
+            player_specialities = ul_string_lists[1]
     result = _get_traits_and_specialities_dict(player_traits, player_specialities, all_traits, all_specialities)
     return result
 
@@ -72,6 +90,10 @@ def parse_player_miscellaneous_data(metadata_selector):
     miscellaneous_info_div = metadata_selector
     ul_selector = miscellaneous_info_div.xpath('./body/div/div[3]/table/tr/td[1]/ul[1]')[0]
     strings = [x.strip() for x in ul_selector.xpath('.//text()').extract() if not x.isspace()]
+    return _player_miscellaneous_data_from_strings(strings)
+
+
+def _player_miscellaneous_data_from_strings(strings):
     attribute_dict = dict(zip(strings[::2], strings[1::2]))
     work_rates = attribute_dict.pop('Work rate').split(' / ')
     attribute_dict['Work rate att'] = work_rates[0]
@@ -102,7 +124,7 @@ def get_position_ratings(position_ratings_selector, metadata_selector, all_posit
 
 
 def get_full_position_preferences(preferred_positions_list, all_positions):
-    return {'prefers_' + pos: (pos in preferred_positions_list) for pos in all_positions}
+    return {'position_preferences_bits': crawler.flags.bitmask(preferred_positions_list, all_positions)}
 
 
 def parse_single_player_page(url, html_dict, constants):
@@ -134,75 +156,108 @@ def parse_single_player_page(url, html_dict, constants):
 def id_from_url(url):
     return url.split('/')[-1]
 
-def _feet_to_cm(str_series):
-    inches_to_cm_factor = 2.54
-    feet_inches_df = (str_series.str.strip('"')
-                      .str.split("'", expand=True)
-                      .rename(columns={0:'feet', 1:'inches'})
-                      .astype('int'))
-    total_inches_series = feet_inches_df['feet']*12 + feet_inches_df['inches']
-    return (total_inches_series * inches_to_cm_factor).round().astype('int').rename('Height_cm')
-
-def _convert_height_col(height_series):
-    feet_index = height_series.str.contains('"')
-    if feet_index.any():
-        feet_series = height_series[feet_index]
-        return (height_series
-                .mask(feet_index, other=_feet_to_cm(feet_series))
-                .pipe(pd.to_numeric, errors='ignore'))
-    else:
-        return height_series
-
-def _lb_to_kg(str_series):
-    lb_to_kg_factor = 0.453592
-    return (str_series.str.strip('lbs')
-            .astype('int')
-            .mul(lb_to_kg_factor)
-            .round().astype('int'))
-
-def _convert_weight_col(weight_series):
-    lb_index = weight_series.str.contains('lbs')
-    if lb_index.any():
-        lb_series = weight_series[lb_index]
-        return (weight_series
-                .mask(lb_index, other=_lb_to_kg(lb_series))
-                .pipe(pd.to_numeric, errors='ignore'))
-    else:
-        return weight_series
-
-
-def parse_player_detailed_data(player_htmls, constants):
-    pool = Pool(cpu_count())
-    func_args = [(url, html, constants) for url, html in player_htmls.items()]
-    data = pool.starmap(parse_single_player_page, func_args)
-    df = pd.DataFrame(data)
-    col_order = [*constants['uncategorised'],
-                 *constants['body_features'],
-                 *constants['headline_attributes'],
-                 *constants['special_attributes'],
-                 *constants['main_attributes'],
-                 *constants['positions'],
-                 *constants['traits'],
-                 *constants['specialities'],
-                 *constants['position_preferences']]
-    df.loc[:, 'Release clause'] = df['Release clause'].pipe(convert_currency)
-    df.loc[:, 'Birth date'] = pd.to_datetime(df['Birth date'], format='%b %d %Y')
-    df.loc[:, 'Real face'] = np.where(df['Real face']=='Yes', True, False)
-    df.loc[:, 'Height_cm'] = _convert_height_col(df['Height_cm'])
-    df.loc[:, 'Weight_kg'] = _convert_weight_col(df['Weight_kg'])
-    numeric_cols_to_be_converted = ['ID',
-                                    *constants['headline_attributes'],
-                                    *constants['main_attributes'],
-                                    'International reputation',
-                                    'Skill moves',
-                                    'Weak foot',
-                                    *constants['positions']]
-    for col in numeric_cols_to_be_converted:
-        df.loc[:, col] = pd.to_numeric(df[col], errors='ignore') #deal with errors later
-    return df[col_order].rename(columns={'Release clause':'EUR_release_clause'})
-
-
-def get_player_detailed_data(IDs, from_file=False, update_html_store=False):
+
+def player_columns(constants):
+    return [*constants['uncategorised'],
+            *constants['body_features'],
+            *constants['headline_attributes'],
+            *constants['special_attributes'],
+            *constants['main_attributes'],
+            *constants['positions'],
+            *[crawler.flags.bits_col(group) for group in crawler.flags.FLAG_GROUPS]]
+
+
+_QUARANTINE_COL = '_quarantine'  # the scraped row as JSON, for rows that failed to convert
+
+
+def _player_frame(records, constants):
+    """The parsed records with the standardised player columns, as scraped."""
+    return (pd.DataFrame.from_records(records, columns=player_columns(constants))
+            .rename(columns={'Release clause': 'EUR_release_clause'})
+            .pipe(standardise_col_names))
+
+
+def _player_arrow_schema(constants):
+    """Schema of the player records sent back by the workers: every column converted to its
+    crawler.schema.arrow_type, plus the scraped rows that failed to convert, in _QUARANTINE_COL."""
+    schema = crawler.schema.player_schema(constants)
+    return pa.schema([(col, crawler.schema.arrow_type(schema.get(col, crawler.schema.Column('string', True))))
+                      for col in _player_frame([], constants).columns] + [(_QUARANTINE_COL, pa.string())])
+
+
+_schema_cache = {}
+
+
+def _player_schemas(constants):
+    """(crawler.schema.player_schema, _player_arrow_schema), built once per set of columns."""
+    columns = tuple(player_columns(constants))
+    if columns not in _schema_cache:
+        _schema_cache[columns] = crawler.schema.player_schema(constants), _player_arrow_schema(constants)
+    return _schema_cache[columns]
+
+
+def _typed_player_table(records, constants):
+    schema, arrow_schema = _player_schemas(constants)
+    converted, quarantine = crawler.schema.convert(_player_frame(records, constants), schema)
+    table = crawler.schema.to_arrow(converted, arrow_schema)
+    if len(quarantine):
+        quarantined = pd.DataFrame({_QUARANTINE_COL: [json.dumps(row, default=str)
+                                                      for row in quarantine.to_dict('records')]})
+        table = pa.concat_tables([table, crawler.schema.to_arrow(quarantined, arrow_schema)])
+    return table
+
+
+def pack_player_records(records):
+    """collect_func for crawler.executor and crawler.pipeline: converts a chunk of parsed
+    player records in the worker and packs them into Arrow IPC bytes."""
+    return crawler.columnar.table_to_ipc(_typed_player_table(records, crawler.executor.worker_constants()))
+
+
+def clean_player_detailed_data(df, constants, quarantine_dir=crawler.schema.QUARANTINE_DIR):
+    """The player table from the records packed by pack_player_records. The columns are
+    already converted, so this only restores their pandas dtypes and saves the quarantine
+    in quarantine_dir."""
+    failed = df[_QUARANTINE_COL].notna()
+    quarantine = pd.DataFrame.from_records([json.loads(row) for row in df.loc[failed, _QUARANTINE_COL]])
+    # without the quarantined rows, columns that had nulls for them get their own dtype back
+    converted, not_restored = crawler.schema.convert(df[~failed].drop(columns=_QUARANTINE_COL).infer_objects(),
+                                                     crawler.schema.player_schema(constants))
+    crawler.schema.save_quarantine(pd.concat([quarantine, not_restored], ignore_index=True), 'player', quarantine_dir)
+    return converted.reset_index(drop=True)
+
+
+def get_player_detailed_data(IDs, from_file=False, update_html_store=False, previous_data=None,
+                             engine=DEFAULT_ENGINE, ID_batches=None):
+    """previous_data: optional player data from an earlier run.
+    Players that appear in it are not fetched again and their previous rows are reused.
+    engine: name of the crawler.extraction engine used to parse the pages.
+    ID_batches: optional iterable of lists of IDs to download as they arrive, e.g. the batches
+    of a crawler.scheduler.Stream, instead of IDs. The rows are then in order of arrival."""
     constants = read_constants()
-    player_htmls = get_player_htmls(IDs, from_file, update_html_store)
-    return parse_player_detailed_data(player_htmls, constants).pipe(standardise_col_names)
\ No newline at end of file
+    if ID_batches is not None:
+        buffers = get_player_htmls_in_batches(ID_batches, update_html_store,
+                                              crawler.extraction.get_page_functions('player', engine),
+                                              constants, collect_func=pack_player_records)
+        return (crawler.columnar.ipc_to_frame(buffers, _player_arrow_schema(constants))
+                .pipe(clean_player_detailed_data, constants))
+    if previous_data is None:
+        reused_IDs = []
+    else:
+        reused_IDs = list(previous_data['ID'])
+    reused_ID_set = set(reused_IDs)
+    IDs_to_fetch = [ID for ID in IDs if ID not in reused_ID_set]
+    # the workers send back each chunk of records as Arrow columns rather than pickled dicts
+    buffers = get_player_htmls(IDs_to_fetch, from_file, update_html_store, carry_over_IDs=reused_IDs,
+                               page_functions=crawler.extraction.get_page_functions('player', engine),
+                               constants=constants, collect_func=pack_player_records)
+    if not buffers:
+        return previous_data
+    data = (crawler.columnar.ipc_to_frame(buffers, _player_arrow_schema(constants))
+            .pipe(clean_player_detailed_data, constants))
+    if previous_data is None:
+        return data
+    order = pd.Series(range(len(IDs)), index=list(IDs))
+    return (pd.concat([previous_data, data], ignore_index=True)
+            .sort_values('ID', key=lambda ID: ID.map(order))
+            .reset_index(drop=True)
+            .pipe(crawler.schema.restore_dtypes, crawler.schema.player_schema(constants)))
\ No newline at end of file
@@ -0,0 +1,174 @@
+"""Indexed lookups over an exported table without loading it into a DataFrame.
+
+save_data writes the complete table to data/final/<version>/complete.query/ as an
+uncompressed Arrow file, along with one index per column in INDEXED_COLS. Each index
+is three arrays: the sorted distinct values of the column (keys), and the row
+positions for each key, grouped by key (rows, split at offsets). The same index
+serves equality lookups and range filters.
+
+Dataset memory-maps the Arrow file and the index arrays. Only the rows that match
+a query are converted to Python objects or a DataFrame.
+"""
+import json
+import shutil
+
+import numpy as np
+import pyarrow as pa
+
+import crawler.flags
+import crawler.utils
+
+INDEXED_COLS = ['ID', 'club', 'league', 'nationality', 'overall', 'age']
+QUERY_CATEGORIES = ['complete']
+
+_QUERY_DIRS = crawler.utils.filepath_tree('final', '.query')
+_FEATHER_PATHS = crawler.utils.filepath_tree('final', '.feather')
+
+
+def query_dir(category_key='complete', version_key='current'):
+    return _QUERY_DIRS[version_key][category_key]
+
+
+def _index_keys(values):
+    if values.dtype.kind in 'biuf':
+        return values.to_numpy()
+    # categoricals and strings are indexed by their string value
+    return values.astype('str').to_numpy(dtype='U')
+
+
+def _build_index(values):
+    positions = np.flatnonzero(values.notna().to_numpy())
+    keys = _index_keys(values.iloc[positions])
+    order = np.argsort(keys, kind='stable')
+    unique_keys, starts = np.unique(keys[order], return_index=True)
+    offsets = np.append(starts, len(keys)).astype('int64')
+    return unique_keys, offsets, positions[order].astype('uint32')
+
+
+def build_query_store(data, category_key='complete', version_key='current'):
+    """Writes data and its indexes to the query directory, replacing the previous ones."""
+    path = query_dir(category_key, version_key)
+    tmp_path = path.with_name(path.name + '.tmp')
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir(parents=True)
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    with pa.OSFile(str(tmp_path / 'data.arrow'), 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    indexed_cols = [col for col in INDEXED_COLS if col in data.columns]
+    for col in indexed_cols:
+        for name, array in zip(['keys', 'offsets', 'rows'], _build_index(data[col])):
+            np.save(tmp_path / '{}.{}.npy'.format(col, name), array)
+    with open(tmp_path / 'meta.json', 'w', encoding='utf_8') as f:
+        json.dump({'n_rows': len(data), 'indexed_cols': indexed_cols,
+                   'flag_layout': {col: names for col, names in crawler.flags.flag_layout().items()
+                                   if col in data.columns}}, f)
+    if path.exists():
+        shutil.rmtree(path)
+    tmp_path.rename(path)
+
+
+def _is_stale(category_key, version_key):
+    path = query_dir(category_key, version_key)
+    feather_path = _FEATHER_PATHS[version_key][category_key]
+    if not (path / 'meta.json').exists():
+        return True
+    return feather_path.exists() and feather_path.stat().st_mtime > (path / 'meta.json').stat().st_mtime
+
+
+def _take_indices(positions):
+    """positions as a pyarrow array for Table.take. Built from the buffer, because pa.array
+    imports pandas to check the type of its argument, which would triple the startup
+    time of a command line query."""
+    positions = np.ascontiguousarray(positions, dtype=np.uint32)
+    return pa.Array.from_buffers(pa.uint32(), len(positions), [None, pa.py_buffer(positions)])
+
+
+class Dataset:
+    """Read-only, indexed view of an exported table. Use as a context manager.
+
+    If the query store is missing or older than the table's feather export,
+    it is rebuilt from the feather file first."""
+
+    def __init__(self, category_key='complete', version_key='current'):
+        if _is_stale(category_key, version_key):
+            build_query_store(crawler.utils.read_data(category_key, version_key), category_key, version_key)
+        self._path = query_dir(category_key, version_key)
+        with open(self._path / 'meta.json', 'r', encoding='utf_8') as f:
+            meta = json.load(f)
+        self.indexed_cols = meta['indexed_cols']
+        self.flag_layout = meta.get('flag_layout') or None
+        self._source = pa.memory_map(str(self._path / 'data.arrow'), 'r')
+        self.table = pa.ipc.open_file(self._source).read_all()
+        self._indexes = {}
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def _index(self, col):
+        if col not in self._indexes:
+            if col not in self.indexed_cols:
+                raise KeyError('{} is not indexed; indexed columns are {}'.format(col, self.indexed_cols))
+            self._indexes[col] = tuple(np.load(self._path / '{}.{}.npy'.format(col, name), mmap_mode='r')
+                                       for name in ['keys', 'offsets', 'rows'])
+        return self._indexes[col]
+
+    def positions(self, col, value=None, low=None, high=None):
+        """Row positions where col == value, or low <= col <= high if value is None.
+        Either bound can be None. Positions are in key order, not table order."""
+        keys, offsets, rows = self._index(col)
+        if value is not None:
+            low = high = value
+        start = 0 if low is None else np.searchsorted(keys, low, side='left')
+        stop = len(keys) if high is None else np.searchsorted(keys, high, side='right')
+        return np.asarray(rows[offsets[start]:offsets[stop]])
+
+    def where(self, flags=None, **conditions):
+        """Positions of the rows matching every condition, in table order.
+        A condition is either a value to match or a (low, high) tuple for a range, e.g.
+        where(league='Spanish Primera División', overall=(80, None)).
+        flags is an expression of trait, speciality and position preference flags for
+        crawler.flags.mask, e.g. 'finesse_shot_trait AND speedster_speciality AND prefers_st'."""
+        result = None
+        if flags is not None:
+            result = np.flatnonzero(crawler.flags.mask(self.table, flags, self.flag_layout)).astype('uint32')
+        for col, condition in conditions.items():
+            if isinstance(condition, tuple):
+                positions = self.positions(col, low=condition[0], high=condition[1])
+            else:
+                positions = self.positions(col, condition)
+            result = positions if result is None else np.intersect1d(result, positions, assume_unique=True)
+        if result is None:
+            return np.arange(len(self))
+        return np.sort(result)
+
+    def records(self, positions, columns=None):
+        """The rows at positions as a list of dicts."""
+        table = self.table if columns is None else self.table.select(columns)
+        return table.take(_take_indices(positions)).to_pylist()
+
+    def frame(self, positions, columns=None):
+        """The rows at positions as a DataFrame."""
+        table = self.table if columns is None else self.table.select(columns)
+        return table.take(_take_indices(positions)).to_pandas()
+
+    def get(self, ID, columns=None):
+        """The row for a player ID as a dict, or None."""
+        positions = self.positions('ID', ID)
+        return self.records(positions[:1], columns)[0] if len(positions) else None
+
+    def query(self, columns=None, flags=None, **conditions):
+        """DataFrame of the rows matching conditions; see where."""
+        return self.frame(self.where(flags, **conditions), columns)
+
+    def close(self):
+        self.table = None
+        self._indexes = {}
+        self._source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
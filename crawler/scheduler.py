@@ -0,0 +1,156 @@
+"""Runs the stages of a crawl as a dependency graph.
+
+Each stage declares the stages whose results it needs (inputs) and starts, in its own
+thread, as soon as they have finished, so independent branches run concurrently. The
+stages mostly wait on the network, the parse workers or the disk, so threads are enough.
+
+A stage can also stream partial output to stages that start before it has finished: it
+declares the names of the streams it produces and puts items on them as they become
+available, and consumers declare the streams they read. Consumers get the Stream right
+away and read it with Stream.batches(). Streams are closed when their producer returns,
+and raise the producer's exception in the consumers if it fails.
+
+Stage functions are called with keyword arguments named after their inputs and streams.
+Each stage is timed by a crawler.metrics span named after it, nested under the spans
+open in the thread that called run_stages.
+"""
+import collections
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import crawler.metrics
+
+Stage = collections.namedtuple('Stage', ['name', 'func', 'inputs', 'streams', 'produces'])
+
+
+def stage(name, func, inputs=(), streams=(), produces=()):
+    return Stage(name, func, tuple(inputs), tuple(streams), tuple(produces))
+
+
+class StreamError(Exception):
+    """Raised in the consumers of a stream whose producer failed."""
+
+
+class Stream:
+    """Items passed from a running stage to the stages that consume them. Thread safe."""
+
+    def __init__(self, name):
+        self.name = name
+        self._items = []
+        self._closed = False
+        self._error = None
+        self._condition = threading.Condition()
+
+    def put(self, items):
+        with self._condition:
+            if self._closed:
+                raise ValueError('stream {} is closed'.format(self.name))
+            self._items.extend(items)
+            self._condition.notify_all()
+
+    def close(self, error=None):
+        with self._condition:
+            if not self._closed:
+                self._closed = True
+                self._error = error
+                self._condition.notify_all()
+
+    def batches(self):
+        """Yields lists of the items put since the last batch, waiting for new ones until the stream is closed."""
+        position = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._closed or len(self._items) > position)
+                batch = self._items[position:]
+                closed, error = self._closed, self._error
+            position += len(batch)
+            if batch:
+                yield batch
+            elif closed:
+                if error is not None:
+                    raise StreamError('the producer of stream {} failed'.format(self.name)) from error
+                return
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield from batch
+
+
+def _check_graph(stages):
+    names = [s.name for s in stages]
+    if len(set(names)) != len(names):
+        raise ValueError('stage names must be unique')
+    producers = {stream: s.name for s in stages for stream in s.produces}
+    dependencies = {}
+    for s in stages:
+        unknown = [name for name in s.inputs if name not in names] + [
+            stream for stream in s.streams if stream not in producers]
+        if unknown:
+            raise ValueError('stage {} depends on unknown stages or streams {}'.format(s.name, unknown))
+        dependencies[s.name] = set(s.inputs) | {producers[stream] for stream in s.streams}
+    # depth first search for a cycle
+    state = {}
+
+    def visit(name):
+        if state.get(name) == 'done':
+            return
+        if state.get(name) == 'visiting':
+            raise ValueError('the stages depend on each other in a cycle through {}'.format(name))
+        state[name] = 'visiting'
+        for dependency in dependencies[name]:
+            visit(dependency)
+        state[name] = 'done'
+
+    for name in names:
+        visit(name)
+
+
+def _run_stage(s, results, streams, parent_spans):
+    kwargs = {name: results[name] for name in s.inputs}
+    kwargs.update((name, streams[name]) for name in s.streams + s.produces)
+    try:
+        with crawler.metrics.inherit(parent_spans), crawler.metrics.span(s.name):
+            result = s.func(**kwargs)
+    except BaseException as e:
+        crawler.metrics.increment('failed_stages.' + s.name)
+        for name in s.produces:
+            streams[name].close(e)
+        raise
+    for name in s.produces:
+        streams[name].close()
+    return result
+
+
+def run_stages(stages):
+    """Runs stages (made with stage()) as soon as their inputs are available and returns
+    {stage name: result}. If a stage fails, the stages that haven't started are skipped
+    and the first exception is raised once the running ones have finished."""
+    _check_graph(stages)
+    streams = {name: Stream(name) for s in stages for name in s.produces}
+    parent_spans = crawler.metrics.stack()
+    results = {}
+    waiting = list(stages)
+    running = {}
+    error = None
+    with ThreadPoolExecutor(len(stages)) as executor:
+        while waiting or running:
+            if error is None:
+                for s in [s for s in waiting if all(name in results for name in s.inputs)]:
+                    waiting.remove(s)
+                    running[executor.submit(_run_stage, s, results, streams, parent_spans)] = s
+            elif not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                s = running.pop(future)
+                if future.exception() is None:
+                    results[s.name] = future.result()
+                elif error is None:
+                    error = future.exception()
+                    # the stages that haven't started will never run, so nothing will close their streams
+                    for skipped in waiting:
+                        for name in skipped.produces:
+                            streams[name].close(error)
+    if error is not None:
+        raise error
+    return results
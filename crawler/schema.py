@@ -0,0 +1,325 @@
+"""Column schemas and the type conversions applied to the scraped tables.
+
+Each table has a {column: Column} schema, keyed by the standardised column names and
+derived from the constants where the columns come from them. apply_schema converts
+every column in one vectorized pass to a compact dtype. A cell that can't be converted
+doesn't turn its whole column into strings: the row is dropped from the table and
+written to <quarantine_dir>/<category>.csv, data/quarantine by default, together with the names of the failed columns.
+
+Conversions are idempotent, so a table read back from an export can go through
+apply_schema again. Merging or concatenating tables whose categories differ turns
+categorical columns back into objects; restore_dtypes converts them again.
+
+Worker processes can convert their rows themselves and send them as Arrow columns of
+the arrow_type of each column (see to_arrow and crawler.columnar). Converting those
+again in the parent only restores the pandas dtypes, without parsing any strings.
+"""
+import collections
+import warnings
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+import crawler.flags
+import crawler.metrics
+from crawler.utils import DATA_DIR, standardise_col_name
+
+QUARANTINE_DIR = DATA_DIR / 'quarantine'
+
+# kind is a key of _CONVERTERS. Missing values are only allowed in nullable columns.
+Column = collections.namedtuple('Column', ['kind', 'nullable'])
+
+_UNSIGNED_DTYPES = {'uint8': ('uint8', 'UInt8'), 'uint16': ('uint16', 'UInt16'), 'uint32': ('uint32', 'UInt32')}
+
+_CURRENCY_MULTIPLIERS = {'': 1, 'K': 1e3, 'M': 1e6}
+_LB_TO_KG = 0.453592
+_INCH_TO_CM = 2.54
+
+
+def _strings(series):
+    return series.astype('string').str.strip()
+
+
+def _numbers(series):
+    """Floats, with NaN for missing or unparseable values. Ratings such as '78+2'
+    (base rating plus in-form boost) keep their base rating."""
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        return series.astype('float64')
+    leading_number = _strings(series).str.extract(r'^(\d+(?:\.\d+)?)(?:[+-]\d+)?$', expand=False)
+    return pd.to_numeric(leading_number, errors='coerce').astype('float64')
+
+
+def _unsigned(series, kind):
+    values = _numbers(series).to_numpy()
+    upper = np.iinfo(_UNSIGNED_DTYPES[kind][0]).max
+    in_range = (values >= 0) & (values <= upper) & (values == np.round(values))
+    return pd.Series(np.where(in_range, values, np.nan), index=series.index)
+
+
+def _currency(series):
+    if pd.api.types.is_numeric_dtype(series):
+        values = series.astype('float64')
+    else:
+        parts = _strings(series).str.extract(r'^€\s*(\d+(?:\.\d+)?)\s*([KM]?)$')
+        values = pd.to_numeric(parts[0], errors='coerce') * parts[1].map(_CURRENCY_MULTIPLIERS).astype('float64')
+    return _unsigned(values.round(), 'uint32')
+
+
+def _height(series):
+    if pd.api.types.is_numeric_dtype(series):
+        return _unsigned(series, 'uint8')
+    strings = _strings(series)
+    feet_inches = strings.str.extract(r'''^(\d+)'(\d+)"?$''').astype('float64')
+    cm = (feet_inches[0] * 12 + feet_inches[1]) * _INCH_TO_CM
+    return _unsigned(_numbers(strings).fillna(cm.round()), 'uint8')
+
+
+def _weight(series):
+    if pd.api.types.is_numeric_dtype(series):
+        return _unsigned(series, 'uint8')
+    strings = _strings(series)
+    lbs = pd.to_numeric(strings.str.extract(r'^(\d+)\s*lbs$', expand=False), errors='coerce')
+    return _unsigned(_numbers(strings).fillna((lbs * _LB_TO_KG).round()), 'uint8')
+
+
+def _date(series):
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    return pd.to_datetime(series, format='%b %d %Y', errors='coerce')
+
+
+def _yes_no(series):
+    if pd.api.types.is_bool_dtype(series):
+        return series
+    return _strings(series).map({'Yes': True, 'No': False}).astype('object')
+
+
+def _bool(series):
+    if pd.api.types.is_bool_dtype(series):
+        return series
+    return series.map({True: True, False: False, 'True': True, 'False': False}).astype('object')
+
+
+def _category(series):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series
+    strings = series.where(series.isna(), series.astype('str').str.strip())
+    return strings.replace('', np.nan).astype('object')
+
+
+def _bits(series):
+    """Bitmasks of crawler.flags, kept as integers: floats would lose the high bits."""
+    if pd.api.types.is_unsigned_integer_dtype(series):
+        return series
+    return pd.to_numeric(series, errors='coerce')
+
+
+def _string(series):
+    return series
+
+
+_CONVERTERS = {'uint8': lambda series: _unsigned(series, 'uint8'),
+               'uint16': lambda series: _unsigned(series, 'uint16'),
+               'uint32': lambda series: _unsigned(series, 'uint32'),
+               'currency': _currency,
+               'height': _height,
+               'weight': _weight,
+               'date': _date,
+               'yes_no': _yes_no,
+               'bool': _bool,
+               'category': _category,
+               'bits': _bits,
+               'string': _string}
+
+# dtype of each kind once its failed rows are dropped, (non-nullable, nullable)
+_FINAL_DTYPES = {**_UNSIGNED_DTYPES,
+                 'currency': _UNSIGNED_DTYPES['uint32'],
+                 'height': _UNSIGNED_DTYPES['uint8'],
+                 'weight': _UNSIGNED_DTYPES['uint8'],
+                 'yes_no': ('bool', 'boolean'),
+                 'bool': ('bool', 'boolean'),
+                 'bits': ('uint64', 'UInt64'),
+                 'category': ('category', 'category')}
+
+
+# Arrow type of the converted values of each kind; missing values are nulls
+_ARROW_TYPES = {'uint8': pa.uint8(),
+                'uint16': pa.uint16(),
+                'uint32': pa.uint32(),
+                'currency': pa.uint32(),
+                'height': pa.uint8(),
+                'weight': pa.uint8(),
+                'date': pa.timestamp('ns'),
+                'yes_no': pa.bool_(),
+                'bool': pa.bool_(),
+                'category': pa.dictionary(pa.int32(), pa.string()),
+                'bits': pa.uint64(),
+                'string': pa.string()}
+
+
+def _present(series):
+    """False for missing values and blank strings."""
+    present = series.notna()
+    if series.dtype == object:
+        present &= series.astype('str').str.strip() != ''
+    return present
+
+
+def _columns(names, kind, nullable=False):
+    return {standardise_col_name(name): Column(kind, nullable) for name in names}
+
+
+def overview_schema():
+    return {'ID': Column('uint32', False),
+            'name': Column('string', True),
+            'club': Column('category', True),
+            'club_logo': Column('category', True),
+            'flag': Column('category', True),
+            'photo': Column('string', True),
+            'nationality': Column('category', True),
+            'eur_value': Column('currency', False),
+            'eur_wage': Column('currency', False),
+            'overall': Column('uint8', False),
+            'potential': Column('uint8', False),
+            'special': Column('uint16', False),
+            'age': Column('uint8', False)}
+
+
+def league_schema():
+    return {'club': Column('category', True),
+            'league': Column('category', True)}
+
+
+def player_schema(constants):
+    return {'ID': Column('uint32', False),
+            'full_name': Column('string', True),
+            'birth_date': Column('date', False),
+            'eur_release_clause': Column('currency', True),
+            'height_cm': Column('height', False),
+            'weight_kg': Column('weight', False),
+            'body_type': Column('category', True),
+            'real_face': Column('yes_no', False),
+            **_columns(constants['headline_attributes'], 'uint8', nullable=True),
+            **_columns(['International reputation', 'Skill moves', 'Weak foot'], 'uint8'),
+            **_columns(['Work rate att', 'Work rate def', 'Preferred foot'], 'category', nullable=True),
+            **_columns(constants['main_attributes'], 'uint8'),
+            # outfield players have no GK rating and goalkeepers have no outfield ratings
+            **_columns(constants['positions'], 'uint8', nullable=True),
+            **_columns([crawler.flags.bits_col(group) for group in crawler.flags.FLAG_GROUPS], 'bits')}
+
+
+def complete_schema(constants):
+    return {**overview_schema(), **league_schema(), **player_schema(constants)}
+
+
+def _final_dtype(column, has_missing):
+    dtypes = _FINAL_DTYPES.get(column.kind)
+    if dtypes is None:
+        return None
+    return dtypes[1] if has_missing else dtypes[0]
+
+
+def _stacked(df, cols):
+    if len(cols) == 1:
+        return df[cols[0]]
+    return pd.concat([df[col] for col in cols], ignore_index=True)
+
+
+def _unstacked(values, column, cols, kept):
+    """{col: array} of the columns cols, stacked in values, for the rows that are kept,
+    with their final dtypes."""
+    values = values.to_numpy().reshape(len(cols), -1)[:, kept]
+    has_missing = pd.isna(values).any(axis=1)
+    arrays = {}
+    for col, col_values, missing in zip(cols, values, has_missing):
+        dtype = _final_dtype(column, missing)
+        if dtype is None:
+            arrays[col] = col_values
+        elif isinstance(pd.api.types.pandas_dtype(dtype), np.dtype):
+            arrays[col] = col_values.astype(dtype)
+        else:
+            arrays[col] = pd.array(col_values, dtype=dtype)
+    return arrays
+
+
+def convert(df, schema):
+    """Converts the columns of df that are in schema. Returns (converted, quarantine),
+    where quarantine holds the original rows with a cell that failed to convert,
+    plus a failed_columns column. Those rows are left out of converted.
+
+    Columns of the same kind and dtype are stacked and converted together, so a table
+    of a few rows doesn't pay the overhead of a pass per column. Bitmasks are converted
+    one column at a time: a missing value would turn the whole stack into floats."""
+    groups = collections.defaultdict(list)
+    for col in df.columns:
+        if col in schema:
+            stack_key = col if schema[col].kind == 'bits' else None
+            groups[schema[col], str(df[col].dtype), stack_key].append(col)
+    converted = {}
+    failures = {}
+    failed_rows = np.zeros(len(df), dtype=bool)
+    for (column, _, _), cols in groups.items():
+        stacked = _stacked(df, cols)
+        values = _CONVERTERS[column.kind](stacked)
+        failed = values.isna()
+        if column.nullable:
+            failed &= _present(stacked)
+        failed = failed.to_numpy().reshape(len(cols), -1)
+        failures.update((col, col_failed) for col, col_failed in zip(cols, failed) if col_failed.any())
+        failed_rows |= failed.any(axis=0)
+        converted[column, tuple(cols)] = values
+    kept = ~failed_rows
+    arrays = {col: df[col].array[kept] for col in df.columns if col not in schema}
+    for (column, cols), values in converted.items():
+        arrays.update(_unstacked(values, column, cols, kept))
+    quarantine = df[failed_rows].copy()
+    quarantine['failed_columns'] = [', '.join(col for col in df.columns if col in failures and failures[col][row])
+                                    for row in np.flatnonzero(failed_rows)]
+    return pd.DataFrame({col: arrays[col] for col in df.columns}, index=df.index[kept]), quarantine
+
+
+def arrow_type(column):
+    return _ARROW_TYPES[column.kind]
+
+
+def to_arrow(df, arrow_schema):
+    """A pyarrow Table with arrow_schema of the converted columns of df. Columns of
+    arrow_schema that df doesn't have are all nulls."""
+    arrays = []
+    for field in arrow_schema:
+        if field.name not in df.columns:
+            arrays.append(pa.nulls(len(df), field.type))
+        elif pa.types.is_dictionary(field.type):
+            # the index type of a categorical depends on its number of categories
+            arrays.append(pa.array(df[field.name], from_pandas=True).cast(field.type))
+        else:
+            arrays.append(pa.Array.from_pandas(df[field.name], type=field.type))
+    return pa.Table.from_arrays(arrays, schema=arrow_schema)
+
+
+def save_quarantine(quarantine, category_key, quarantine_dir=QUARANTINE_DIR):
+    """Writes the quarantined rows of category_key to quarantine_dir, warning if there are
+    any, or removes the file of an earlier run if there are none."""
+    crawler.metrics.increment('quarantined_rows.' + category_key, len(quarantine))
+    quarantine_path = quarantine_dir / (category_key + '.csv')
+    if len(quarantine):
+        warnings.warn('{} {} row(s) could not be converted and were written to {}'.format(
+            len(quarantine), category_key, quarantine_path))
+        quarantine_path.parent.mkdir(parents=True, exist_ok=True)
+        quarantine.to_csv(quarantine_path, index=False, encoding='utf_8')
+    elif quarantine_path.exists():
+        quarantine_path.unlink()
+
+
+def apply_schema(df, schema, category_key, quarantine_dir=QUARANTINE_DIR):
+    """Converts df with convert and saves the quarantined rows for category_key in quarantine_dir."""
+    converted, quarantine = convert(df, schema)
+    save_quarantine(quarantine, category_key, quarantine_dir)
+    return converted
+
+
+def restore_dtypes(df, schema):
+    categorical_cols = [col for col, column in schema.items()
+                        if column.kind == 'category' and col in df.columns]
+    return df.astype({col: 'category' for col in categorical_cols})
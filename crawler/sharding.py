@@ -0,0 +1,429 @@
+"""Sharded crawl: the pages are split into shards on a work queue that any number of
+worker processes take leases on, on this machine or on other hosts that share the
+shard directory.
+
+    python -m crawler crawl --shard-workers 4                 # coordinator with 4 local workers
+    python -m crawler worker --shard-dir /mnt/shared/shards   # one more worker, e.g. on another host
+
+The queue is a SQLite database in the shard directory. It starts with the overview pages,
+in shards of OVERVIEW_SHARD_SIZE, and a shard for the leagues. A worker that finishes an
+overview shard adds the players it found to the queue in shards of PLAYER_SHARD_SIZE,
+skipping players already queued, in the same transaction as it marks the shard done.
+Every shard is downloaded, filtered and parsed by the worker that holds it, through
+crawler.pipeline as in a normal crawl, and its parsed rows and page fragments are
+written to files in the shard directory named after the shard.
+
+A lease lasts LEASE_SECONDS and is renewed while the shard is being worked on, so the
+shards of a worker that dies are taken over once its leases run out. A shard that fails
+is retried, by any worker, up to MAX_ATTEMPTS times. Once no shard is left, the
+coordinator merges the outputs into the overview, player and league tables, and the
+fragments into the html store.
+
+SQLite's locking is only as reliable as the file system's: the shard directory can be on
+NFS for a few workers, but not on a file system without working locks.
+"""
+import collections
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+import pyarrow as pa
+import pyarrow.feather
+
+import crawler.columnar
+import crawler.downloader
+import crawler.executor
+import crawler.extraction
+import crawler.html_download
+import crawler.html_store
+import crawler.metrics
+import crawler.pipeline
+import crawler.player_data
+import crawler.schema
+import crawler.utils
+from crawler.league_data import _league_clubs_to_df
+from crawler.overview_data import _overview_rows_to_df, clean_overview_data
+from crawler.utils import DATA_DIR, DEFAULT_ENGINE, read_constants
+
+SHARD_DIR = DATA_DIR / 'shards'
+OVERVIEW_SHARD_SIZE = 20  # overview pages per shard
+PLAYER_SHARD_SIZE = 400  # player pages per shard
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 3
+POLL_SECONDS = 0.25
+
+Task = collections.namedtuple('Task', ['id', 'kind', 'payload', 'attempts'])
+
+
+class ShardError(Exception):
+    """Raised by the coordinator when shards failed MAX_ATTEMPTS times.
+
+    failures maps each failed shard ID to its last error."""
+
+    def __init__(self, failures):
+        super().__init__('{} shard(s) failed, e.g. {}'.format(len(failures), next(iter(failures.values()))))
+        self.failures = failures
+
+
+class WorkQueue:
+    """The shards of a crawl and their leases, in a SQLite database. Each process or thread
+    needs its own WorkQueue. Writes take the database lock for the whole transaction, so
+    two workers never lease the same shard."""
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = sqlite3.connect(str(path), timeout=60, isolation_level=None)
+        self._connection.executescript(
+            'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);'
+            'CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY KEY, kind TEXT, payload TEXT, state TEXT, '
+            'owner TEXT, lease_expires REAL, attempts INTEGER, error TEXT);'
+            'CREATE TABLE IF NOT EXISTS queued (kind TEXT, key TEXT, PRIMARY KEY (kind, key));')
+
+    def _transaction(self):
+        self._connection.execute('BEGIN IMMEDIATE')
+        return self._connection
+
+    def set_meta(self, values):
+        with self._transaction() as connection:
+            connection.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                   [(key, json.dumps(value)) for key, value in values.items()])
+
+    def meta(self):
+        return {key: json.loads(value) for key, value in self._connection.execute('SELECT key, value FROM meta')}
+
+    def _add(self, connection, kind, payloads):
+        connection.executemany("INSERT INTO tasks (kind, payload, state, attempts) VALUES (?, ?, 'pending', 0)",
+                               [(kind, json.dumps(payload)) for payload in payloads])
+
+    def add(self, kind, payloads):
+        with self._transaction() as connection:
+            self._add(connection, kind, payloads)
+
+    def lease(self, owner, lease_seconds=LEASE_SECONDS):
+        """Leases a pending shard, or one whose lease ran out, to owner. Returns a Task or None."""
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT id, kind, payload, attempts FROM tasks WHERE state = 'pending' OR "
+                "(state = 'leased' AND lease_expires < ? AND attempts < ?) ORDER BY id LIMIT 1",
+                (now, MAX_ATTEMPTS)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE tasks SET state = 'leased', owner = ?, lease_expires = ?, "
+                               "attempts = attempts + 1 WHERE id = ?", (owner, now + lease_seconds, row[0]))
+        return Task(row[0], row[1], json.loads(row[2]), row[3] + 1)
+
+    def renew(self, task, owner, lease_seconds=LEASE_SECONDS):
+        """Extends owner's lease on task. Returns False if owner lost it."""
+        with self._transaction() as connection:
+            return connection.execute("UPDATE tasks SET lease_expires = ? WHERE id = ? AND owner = ? "
+                                      "AND state = 'leased'",
+                                      (time.time() + lease_seconds, task.id, owner)).rowcount == 1
+
+    def complete(self, task, owner, new_kind=None, new_keys=(), shard_size=PLAYER_SHARD_SIZE):
+        """Marks task done and queues the new_keys that aren't queued yet as shards of new_kind,
+        in one transaction. Returns False, and changes nothing, if owner lost the lease."""
+        with self._transaction() as connection:
+            if connection.execute("UPDATE tasks SET state = 'done', lease_expires = NULL WHERE id = ? "
+                                  "AND owner = ? AND state = 'leased'", (task.id, owner)).rowcount != 1:
+                return False
+            new = [key for key in new_keys
+                   if connection.execute('INSERT OR IGNORE INTO queued VALUES (?, ?)',
+                                         (new_kind, str(key))).rowcount == 1]
+            self._add(connection, new_kind, [new[i:i + shard_size] for i in range(0, len(new), shard_size)])
+        return True
+
+    def fail(self, task, owner, error):
+        """Gives task back to the queue, to be retried unless it has had MAX_ATTEMPTS."""
+        with self._transaction() as connection:
+            connection.execute("UPDATE tasks SET state = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+                               "lease_expires = NULL, error = ? WHERE id = ? AND owner = ? AND state = 'leased'",
+                               (MAX_ATTEMPTS, error, task.id, owner))
+
+    def counts(self):
+        """{state: number of shards}, where failed counts shards that won't be retried."""
+        return dict(self._connection.execute('SELECT state, COUNT(*) FROM tasks GROUP BY state'))
+
+    def is_finished(self):
+        """True once every shard is done or has failed for good, including shards whose
+        worker stopped renewing the lease of their last attempt."""
+        return self._connection.execute(
+            "SELECT COUNT(*) FROM tasks WHERE state = 'pending' OR "
+            "(state = 'leased' AND (lease_expires >= ? OR attempts < ?))",
+            (time.time(), MAX_ATTEMPTS)).fetchone()[0] == 0
+
+    def failures(self):
+        return dict(self._connection.execute("SELECT id, error FROM tasks WHERE state != 'done'"))
+
+    def done(self, kind):
+        """The IDs of the finished shards of kind, in the order they were queued."""
+        return [row[0] for row in self._connection.execute(
+            "SELECT id FROM tasks WHERE kind = ? AND state = 'done' ORDER BY id", (kind,))]
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def queue_path(shard_dir=SHARD_DIR):
+    return shard_dir / 'queue.sqlite'
+
+
+def _output_path(shard_dir, kind, task_id):
+    return shard_dir / 'output' / kind / '{}.feather'.format(task_id)
+
+
+def _pages_paths(shard_dir, category_key, task_id):
+    base_path = shard_dir / 'pages' / category_key / str(task_id)
+    return base_path.with_suffix('.pages'), base_path.with_suffix('.index')
+
+
+def create_queue(shard_dir=SHARD_DIR, engine=DEFAULT_ENGINE):
+    """Empties shard_dir and queues the overview and league shards of a new crawl."""
+    if shard_dir.exists():
+        shutil.rmtree(shard_dir)
+    shard_dir.mkdir(parents=True)
+    urls = crawler.html_download.get_overview_urls()
+    with WorkQueue(queue_path(shard_dir)) as queue:
+        # the workers crawl the same site with the same engine as the coordinator
+        queue.set_meta({'base_url': crawler.utils.BASE_URL, 'engine': engine})
+        queue.add('league', [None])
+        queue.add('overview', [urls[i:i + OVERVIEW_SHARD_SIZE] for i in range(0, len(urls), OVERVIEW_SHARD_SIZE)])
+
+
+def _write_output(table, shard_dir, kind, task_id, owner):
+    """Writes the output of a shard under a temporary name first, so the coordinator never
+    reads a partial file, even if a worker that lost its lease is still writing."""
+    path = _output_path(shard_dir, kind, task_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name('{}.{}.tmp'.format(path.name, owner))
+    pyarrow.feather.write_feather(table, str(tmp_path))
+    os.replace(str(tmp_path), str(path))
+
+
+def _crawl_pages(urls, category_key, page_functions, shard_dir, task_id, owner, pool, collect_func=None):
+    """Downloads, filters and parses urls, writing the fragments to the shard's page store,
+    again under temporary names until it is complete. Returns {url: parsed page}, or the
+    list of collect_func results if it is given."""
+    results = {}
+    collected_chunks = []
+
+    def on_chunk(chunk_urls, fragments, collected):
+        for url, fragment in zip(chunk_urls, fragments):
+            writer.write(url, fragment)
+        if collect_func is None:
+            results.update(zip(chunk_urls, collected))
+        else:
+            collected_chunks.append(collected)
+
+    paths = _pages_paths(shard_dir, category_key, task_id)
+    tmp_paths = [path.with_name('{}.{}.tmp'.format(path.name, owner)) for path in paths]
+    # zlib, because the dictionaries of this host's html store may not exist on the coordinator's
+    with crawler.html_store.PageStoreWriter(*tmp_paths) as writer:
+        failures = crawler.pipeline.run_pipeline(urls, page_functions.extract_page, on_chunk,
+                                                 collect_func=collect_func, pool=pool)
+    if failures:
+        raise crawler.downloader.DownloadError(failures)
+    for tmp_path, path in zip(tmp_paths, paths):
+        os.replace(str(tmp_path), str(path))
+    return collected_chunks if collect_func is not None else results
+
+
+def _crawl_overview_shard(task, shard_dir, owner, engine, constants, pool):
+    rows = _crawl_pages(task.payload, 'overview', crawler.extraction.get_page_functions('overview', engine),
+                        shard_dir, task.id, owner, pool)
+    data = _overview_rows_to_df(rows[url] for url in task.payload)
+    # every column is a string until clean_overview_data, even if a shard only has missing values in it
+    schema = pa.schema([(col, pa.string()) for col in data.columns])
+    _write_output(pa.Table.from_pandas(data, schema=schema, preserve_index=False), shard_dir, 'overview', task.id,
+                  owner)
+    return 'player', (list(data['ID']) if len(data) else [])
+
+
+def _crawl_player_shard(task, shard_dir, owner, engine, constants, pool):
+    buffers = _crawl_pages(crawler.html_download.get_player_urls(task.payload), 'player',
+                           crawler.extraction.get_page_functions('player', engine), shard_dir, task.id, owner,
+                           pool, collect_func=crawler.player_data.pack_player_records)
+    table = crawler.columnar.ipc_to_table(buffers, crawler.player_data._player_arrow_schema(constants))
+    _write_output(table, shard_dir, 'player', task.id, owner)
+    return None, []
+
+
+def _crawl_league_shard(task, shard_dir, owner, engine, constants, pool):
+    url = crawler.html_download.get_league_overview_url()
+    league_IDs = _crawl_pages([url], 'league_overview',
+                              crawler.extraction.get_page_functions('league_overview', engine),
+                              shard_dir, task.id, owner, pool)[url]
+    league_clubs = _crawl_pages(crawler.html_download.get_league_urls(league_IDs), 'league',
+                                crawler.extraction.get_page_functions('league', engine), shard_dir, task.id,
+                                owner, pool)
+    data = _league_clubs_to_df(league_clubs, league_IDs)
+    _write_output(pa.Table.from_pandas(data, preserve_index=False), shard_dir, 'league', task.id, owner)
+    return None, []
+
+
+_SHARD_FUNCTIONS = {'overview': _crawl_overview_shard,
+                    'player': _crawl_player_shard,
+                    'league': _crawl_league_shard}
+
+
+class _LeaseKeeper:
+    """Renews a lease from a background thread, with its own connection, until stopped."""
+
+    def __init__(self, path, task, owner, lease_seconds):
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(path, task, owner, lease_seconds), daemon=True)
+
+    def _run(self, path, task, owner, lease_seconds):
+        with WorkQueue(path) as queue:
+            while not self._stopped.wait(lease_seconds / 3):
+                if not queue.renew(task, owner, lease_seconds):
+                    return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+
+def default_owner():
+    return '{}-{}-{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+def run_worker(shard_dir=SHARD_DIR, owner=None, lease_seconds=LEASE_SECONDS, poll_seconds=POLL_SECONDS):
+    """Works on the shards of the queue in shard_dir until none is left, and returns the number
+    of shards it completed. Shards that fail are given back to the queue."""
+    owner = owner or default_owner()
+    path = queue_path(shard_dir)
+    completed = 0
+    with WorkQueue(path) as queue:
+        meta = queue.meta()
+        crawler.utils.BASE_URL = meta['base_url']
+        constants = read_constants()
+        # one parse pool for all the shards, which are small pipelines
+        with crawler.executor.create_pool(constants) as pool:
+            while True:
+                task = queue.lease(owner, lease_seconds)
+                if task is None:
+                    if queue.is_finished():
+                        return completed
+                    # the overview shards that are still running may add players
+                    time.sleep(poll_seconds)
+                    continue
+                try:
+                    with _LeaseKeeper(path, task, owner, lease_seconds), crawler.metrics.span('shard/' + task.kind):
+                        new_kind, new_keys = _SHARD_FUNCTIONS[task.kind](task, shard_dir, owner, meta['engine'],
+                                                                         constants, pool)
+                except Exception as e:
+                    queue.fail(task, owner, repr(e))
+                    continue
+                if queue.complete(task, owner, new_kind, new_keys):
+                    completed += 1
+
+
+def _run_local_worker(shard_dir, lease_seconds, n_processes, n_download_workers):
+    crawler.executor.N_PROCESSES = n_processes
+    if n_download_workers is not None:
+        crawler.downloader.N_WORKERS = n_download_workers
+    run_worker(shard_dir, lease_seconds=lease_seconds)
+
+
+def _read_outputs(shard_dir, kind, task_ids):
+    tables = [pyarrow.feather.read_table(str(_output_path(shard_dir, kind, task_id))) for task_id in task_ids]
+    # the overview pages past the last player give tables without columns
+    tables = [table for table in tables if table.num_rows] or tables[:1]
+    return pa.concat_tables(tables) if tables else None
+
+
+def merge_shards(shard_dir=SHARD_DIR):
+    """The overview, player and league tables of a finished sharded crawl, as
+    {category: DataFrame}. Players are in the order of arrival, not overview order."""
+    constants = read_constants()
+    with WorkQueue(queue_path(shard_dir)) as queue:
+        done = {kind: queue.done(kind) for kind in _SHARD_FUNCTIONS}
+    overview = _read_outputs(shard_dir, 'overview', done['overview'])
+    player = _read_outputs(shard_dir, 'player', done['player'])
+    if player is None:
+        player = crawler.player_data._player_arrow_schema(constants).empty_table()
+    league = _read_outputs(shard_dir, 'league', done['league'])
+    return {'overview': clean_overview_data(overview.to_pandas()),
+            'player': crawler.player_data.clean_player_detailed_data(player.to_pandas(), constants),
+            'league': crawler.schema.restore_dtypes(league.to_pandas(), crawler.schema.league_schema())}
+
+
+def merge_pages(shard_dir=SHARD_DIR):
+    """Replaces the current html stores with the pages downloaded by the shards."""
+    for category_key in crawler.utils.CATEGORY_KEYS:
+        category_dir = shard_dir / 'pages' / category_key
+        if not category_dir.exists():
+            continue
+        pages_paths = sorted(category_dir.glob('*.pages'), key=lambda path: int(path.stem))
+        # the dictionary is trained on the largest shard, the closest to a sample of the whole crawl
+        largest_path = max(pages_paths, key=lambda path: path.stat().st_size)
+        with crawler.html_store.PageStore(largest_path, largest_path.with_suffix('.index')) as store:
+            crawler.html_store.update_dictionary(category_key, store)
+        crawler.html_store.rotate_store(category_key)
+        with crawler.html_store.open_store_writer(category_key) as writer:
+            for pages_path in pages_paths:
+                with crawler.html_store.PageStore(pages_path, pages_path.with_suffix('.index')) as store:
+                    store.copy_to(writer, list(store.keys()))
+
+
+def crawl(n_workers=None, shard_dir=SHARD_DIR, engine=DEFAULT_ENGINE, update_html_store=True, resume=False,
+          lease_seconds=LEASE_SECONDS, n_processes=1, n_download_workers=None):
+    """Runs a sharded crawl and returns its tables; see merge_shards.
+
+    Parameters
+    ----------
+    n_workers : number of worker processes to start on this machine, defaults to the number
+        of cpus. With 0, the shards are left to workers started elsewhere with run_worker.
+    shard_dir : directory of the queue and the shard outputs, shared with the other workers.
+    engine : crawler.extraction engine used by every worker.
+    update_html_store : replace the html stores with the downloaded pages afterwards.
+    resume : carry on with the queue in shard_dir instead of starting a new crawl.
+    lease_seconds : time after which the shards of a worker that stopped renewing its leases are taken over.
+    n_processes, n_download_workers : parse processes and concurrent downloads of each local worker.
+    """
+    if not (resume and queue_path(shard_dir).exists()):
+        create_queue(shard_dir, engine)
+    if n_workers is None:
+        n_workers = crawler.executor.resolve_n_processes()
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=_run_local_worker,
+                               args=(shard_dir, lease_seconds, n_processes, n_download_workers))
+               for _ in range(n_workers)]
+    for worker in workers:
+        worker.start()
+    with crawler.metrics.span('work'), WorkQueue(queue_path(shard_dir)) as queue:
+        while not queue.is_finished():
+            if workers and not any(worker.is_alive() for worker in workers):
+                # they only return once the queue is finished
+                raise RuntimeError('the local shard workers exited before the crawl was finished')
+            time.sleep(POLL_SECONDS)
+        counts = queue.counts()
+        failures = queue.failures()
+    for worker in workers:
+        worker.join()
+    for state, count in counts.items():
+        crawler.metrics.gauge('shards.' + state, count)
+    if failures:
+        raise ShardError(failures)
+    with crawler.metrics.span('merge'):
+        tables = merge_shards(shard_dir)
+        if update_html_store:
+            merge_pages(shard_dir)
+    return tables
@@ -0,0 +1,153 @@
+"""Similar-player search over the skill ratings and position ratings.
+
+Each player is represented by their main attributes and position ratings, scaled to
+zero mean and unit variance per column (a missing position rating counts as the
+column mean), as one row of a float32 matrix. Similarity is the cosine of the angle
+between rows. The rows are normalised, so a batch of queries becomes one matrix product.
+
+Filters (preferred position, max value, max age, league) are applied before the
+product, so a filtered query only scores the players that can match.
+
+save_data writes the index for the complete table to
+data/final/<version>/complete.similarity/. SimilarityIndex.from_frame builds one
+for any table with the same columns, e.g. an archived snapshot.
+"""
+import json
+import shutil
+
+import numpy as np
+
+import crawler.flags
+import crawler.utils
+from crawler.utils import read_constants, standardise_col_name
+
+SIMILARITY_CATEGORIES = ['complete']
+QUERY_BATCH_SIZE = 256
+
+_SIMILARITY_DIRS = crawler.utils.filepath_tree('final', '.similarity')
+
+
+def similarity_dir(category_key='complete', version_key='current'):
+    return _SIMILARITY_DIRS[version_key][category_key]
+
+
+def feature_cols(constants):
+    return [standardise_col_name(col) for col in [*constants['main_attributes'], *constants['positions']]]
+
+
+def _scaled_matrix(data, cols):
+    values = data[cols].astype('float32').to_numpy()
+    mean = np.nanmean(values, axis=0)
+    std = np.nanstd(values, axis=0)
+    std[~(std > 0)] = 1
+    scaled = np.nan_to_num((values - mean) / std)
+    norms = np.linalg.norm(scaled, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return (scaled / norms).astype('float32')
+
+
+class SimilarityIndex:
+
+    def __init__(self, IDs, matrix, positions, values, ages, league_codes, leagues, position_names):
+        self.IDs = IDs
+        self.matrix = matrix
+        self.positions = positions  # bit i is set if the player prefers position_names[i]
+        self.values = values
+        self.ages = ages
+        self.league_codes = league_codes  # index into leagues, -1 if unknown
+        self.leagues = leagues
+        self.position_names = position_names
+        self._row_by_ID = {ID: row for row, ID in enumerate(IDs.tolist())}
+
+    @classmethod
+    def from_frame(cls, data, constants=None):
+        constants = constants or read_constants()
+        position_names = constants['positions']
+        # bit i of the position preferences is position_names[i]; older snapshots have a bool column per flag
+        preferences = crawler.flags.to_packed(data, constants)['position_preferences_bits']
+        positions = preferences.to_numpy(dtype='uint64').astype('uint32')
+        league = data['league'].astype('category')
+        return cls(IDs=data['ID'].to_numpy(dtype='int64'),
+                   matrix=_scaled_matrix(data, feature_cols(constants)),
+                   positions=positions,
+                   values=data['eur_value'].astype('float64').fillna(np.inf).to_numpy(),
+                   ages=data['age'].to_numpy(dtype='uint8'),
+                   league_codes=league.cat.codes.to_numpy(dtype='int16'),
+                   leagues=[str(name) for name in league.cat.categories],
+                   position_names=position_names)
+
+    def save(self, path):
+        tmp_path = path.with_name(path.name + '.tmp')
+        if tmp_path.exists():
+            shutil.rmtree(tmp_path)
+        tmp_path.mkdir(parents=True)
+        for name in ['IDs', 'matrix', 'positions', 'values', 'ages', 'league_codes']:
+            np.save(tmp_path / (name + '.npy'), getattr(self, name))
+        with open(tmp_path / 'meta.json', 'w', encoding='utf_8') as f:
+            json.dump({'leagues': self.leagues, 'position_names': self.position_names}, f)
+        if path.exists():
+            shutil.rmtree(path)
+        tmp_path.rename(path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path / 'meta.json', 'r', encoding='utf_8') as f:
+            meta = json.load(f)
+        arrays = {name: np.load(path / (name + '.npy'), mmap_mode='r')
+                  for name in ['IDs', 'matrix', 'positions', 'values', 'ages', 'league_codes']}
+        return cls(**arrays, **meta)
+
+    def _candidates(self, position, max_value, max_age, league):
+        mask = np.ones(len(self.IDs), dtype=bool)
+        if position is not None:
+            mask &= (self.positions & np.uint32(1 << self.position_names.index(position))) != 0
+        if max_value is not None:
+            mask &= self.values <= max_value
+        if max_age is not None:
+            mask &= self.ages <= max_age
+        if league is not None:
+            leagues = [league] if isinstance(league, str) else league
+            codes = [self.leagues.index(name) for name in leagues if name in self.leagues]
+            mask &= np.isin(self.league_codes, codes)
+        return np.flatnonzero(mask)
+
+    def search(self, IDs, k=10, position=None, max_value=None, max_age=None, league=None, exclude_self=True):
+        """The k most similar players to each player in IDs.
+
+        Returns (neighbour_IDs, similarities), both of shape (len(IDs), k), most similar first.
+        If fewer than k players pass the filters, the rows are padded with ID -1 and similarity -inf.
+        position is a position name such as 'ST' that the neighbours must prefer, and league
+        is a league name or a list of them."""
+        query_rows = np.array([self._row_by_ID[ID] for ID in IDs], dtype='int64')
+        candidates = self._candidates(position, max_value, max_age, league)
+        candidate_matrix = np.asarray(self.matrix[candidates])
+        neighbour_IDs = np.full((len(query_rows), k), -1, dtype='int64')
+        similarities = np.full((len(query_rows), k), -np.inf, dtype='float32')
+        n = min(k, len(candidates))
+        if n == 0:
+            return neighbour_IDs, similarities
+        for start in range(0, len(query_rows), QUERY_BATCH_SIZE):
+            rows = query_rows[start:start + QUERY_BATCH_SIZE]
+            scores = np.asarray(self.matrix[rows]) @ candidate_matrix.T
+            if exclude_self:
+                self_cols = np.minimum(np.searchsorted(candidates, rows), len(candidates) - 1)
+                is_candidate = candidates[self_cols] == rows
+                scores[np.flatnonzero(is_candidate), self_cols[is_candidate]] = -np.inf
+            top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind='stable')
+            top = np.take_along_axis(top, order, axis=1)
+            batch = slice(start, start + len(rows))
+            neighbour_IDs[batch, :n] = self.IDs[candidates[top]]
+            similarities[batch, :n] = np.take_along_axis(top_scores, order, axis=1)
+        # an excluded query player can end up in the last slot when there are only n candidates
+        neighbour_IDs[np.isneginf(similarities)] = -1
+        return neighbour_IDs, similarities
+
+
+def build_similarity_index(data, category_key='complete', version_key='current'):
+    SimilarityIndex.from_frame(data).save(similarity_dir(category_key, version_key))
+
+
+def load_similarity_index(category_key='complete', version_key='current'):
+    return SimilarityIndex.load(similarity_dir(category_key, version_key))
@@ -0,0 +1,175 @@
+"""Versioned archive of exported tables that only stores the rows that changed.
+
+Each category has a directory under data/snapshots with:
+
+- ``versions.json``: the versions in the order they were added, with their columns.
+- ``<n>.parquet``: the rows that were new or changed in the n-th version, sorted by ID.
+- ``<n>.order.npy``: the IDs of the n-th version's table, in table order.
+- ``index.parquet``: one (ID, version, row_hash) row for every stored row.
+
+A version's table is rebuilt by picking, for each of its IDs, the latest stored row at
+or before that version, and reading only those rows. The history of a player only
+reads the versions in which that player's row changed.
+
+Every file is written next to its final path and moved into place, and versions.json is
+written last, so a version only exists once all of its files do. Index rows left behind
+by an interrupted add are ignored and overwritten by the next one.
+"""
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from crawler.utils import DATA_DIR
+
+SNAPSHOT_DIR = DATA_DIR / 'snapshots'
+ROW_GROUP_SIZE = 1024
+
+_INDEX_COLUMNS = ['ID', 'version', 'row_hash']
+
+
+def _archive_dir(category_key):
+    return SNAPSHOT_DIR / category_key
+
+
+def _version_path(category_key, position):
+    return _archive_dir(category_key) / '{:04d}.parquet'.format(position)
+
+
+def _order_path(category_key, position):
+    return _archive_dir(category_key) / '{:04d}.order.npy'.format(position)
+
+
+def _write_atomic(path, write):
+    """Calls write(file) on a temporary file and moves it to path once complete."""
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def read_versions(category_key):
+    """Returns the list of {'version', 'created', 'n_rows', 'n_changed', 'columns'} dicts, oldest first."""
+    try:
+        with open(_archive_dir(category_key) / 'versions.json', 'r', encoding='utf_8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def _write_versions(versions, category_key):
+    _write_atomic(_archive_dir(category_key) / 'versions.json',
+                  lambda f: f.write(json.dumps(versions, indent=1).encode('utf_8')))
+
+
+def read_index(category_key):
+    try:
+        index = pd.read_parquet(_archive_dir(category_key) / 'index.parquet')
+    except FileNotFoundError:
+        return pd.DataFrame({'ID': pd.Series(dtype='uint32'),
+                             'version': pd.Series(dtype='uint16'),
+                             'row_hash': pd.Series(dtype='uint64')})
+    # rows of a version whose add didn't get as far as versions.json
+    return index[index['version'] < len(read_versions(category_key))].reset_index(drop=True)
+
+
+def row_hashes(data):
+    """A uint64 hash of every row. Values are normalised first, so the hash doesn't
+    depend on e.g. uint8 vs nullable UInt8 or on the categories of a categorical."""
+    normalised = {}
+    for col in data.columns:
+        values = data[col]
+        if pd.api.types.is_unsigned_integer_dtype(values) and values.dtype.itemsize == 8:
+            # bitmasks (see crawler.flags), whose high bits wouldn't survive float64
+            normalised[col] = values.astype('str')
+        elif pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+            normalised[col] = values.astype('float64')
+        else:
+            normalised[col] = values.astype('str')
+    return pd.util.hash_pandas_object(pd.DataFrame(normalised), index=False).to_numpy()
+
+
+def _position(versions, version):
+    if version is None:
+        if not versions:
+            raise KeyError('the archive is empty')
+        return len(versions) - 1
+    names = [entry['version'] for entry in versions]
+    if version not in names:
+        raise KeyError('unknown version {!r}'.format(version))
+    return names.index(version)
+
+
+def add_snapshot(data, category_key, version=None):
+    """Adds data as a new version of the archive for category_key and returns the number of
+    rows that had to be stored. version defaults to the current time, e.g. '2018-03-01T120000'.
+    data must have a unique ID column."""
+    if version is None:
+        version = time.strftime('%Y-%m-%dT%H%M%S')
+    versions = read_versions(category_key)
+    if any(entry['version'] == version for entry in versions):
+        raise ValueError('version {!r} is already in the {} archive'.format(version, category_key))
+    position = len(versions)
+    index = read_index(category_key)
+    latest = index.drop_duplicates('ID', keep='last')
+    hashes = pd.DataFrame({'ID': data['ID'].to_numpy(dtype='uint32'), 'row_hash': row_hashes(data)})
+    unchanged = hashes.merge(latest[['ID', 'row_hash']], on=['ID', 'row_hash'], how='left',
+                             indicator=True)['_merge'].to_numpy() == 'both'
+    changed_rows = data[~unchanged].sort_values('ID')
+    _archive_dir(category_key).mkdir(parents=True, exist_ok=True)
+    table = pa.Table.from_pandas(changed_rows, preserve_index=False)
+    _write_atomic(_version_path(category_key, position),
+                  lambda f: pq.write_table(table, f, compression='zstd', row_group_size=ROW_GROUP_SIZE))
+    _write_atomic(_order_path(category_key, position), lambda f: np.save(f, hashes['ID'].to_numpy()))
+    new_entries = hashes[~unchanged].assign(version=np.uint16(position))[_INDEX_COLUMNS]
+    index = (pd.concat([index, new_entries], ignore_index=True)
+             .sort_values(['ID', 'version'], kind='stable')
+             .reset_index(drop=True))
+    _write_atomic(_archive_dir(category_key) / 'index.parquet', lambda f: index.to_parquet(f, index=False))
+    versions.append({'version': version,
+                     'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'n_rows': len(data),
+                     'n_changed': len(changed_rows),
+                     'columns': [str(col) for col in data.columns]})
+    _write_versions(versions, category_key)
+    return len(changed_rows)
+
+
+def _read_rows(category_key, position, IDs):
+    table = pq.read_table(_version_path(category_key, position), filters=[('ID', 'in', list(IDs))])
+    return table.to_pandas()
+
+
+def read_snapshot(category_key, version=None):
+    """Rebuilds the table of a version (the latest by default), in its original row order."""
+    versions = read_versions(category_key)
+    position = _position(versions, version)
+    order = np.load(_order_path(category_key, position))
+    index = read_index(category_key)
+    latest = (index[(index['version'] <= position) & index['ID'].isin(order)]
+              .drop_duplicates('ID', keep='last'))
+    frames = [_read_rows(category_key, stored_position, IDs)
+              for stored_position, IDs in latest.groupby('version')['ID']]
+    data = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['ID'])
+    return (data
+            .set_index('ID')
+            .loc[order]
+            .reset_index()
+            [versions[position]['columns']])
+
+
+def player_history(ID, category_key='complete'):
+    """Every distinct row stored for the player, oldest first, with the version in which
+    it first appeared. Versions in which the row didn't change are not repeated."""
+    versions = read_versions(category_key)
+    index = read_index(category_key)
+    positions = index.loc[index['ID'] == ID, 'version']
+    frames = [_read_rows(category_key, position, [ID]).assign(version=versions[position]['version'])
+              for position in positions]
+    if not frames:
+        return pd.DataFrame(columns=['version'])
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,308 @@
+"""A local stand-in for sofifa, for offline crawls and downloader load tests.
+
+Serves every url pattern the crawler requests (/players?offset=, /player/<ID>, /leagues
+and /league/<ID>), either with synthetic pages from crawler.fixtures or with pages
+recorded from the real site by record_pages, and synthetic png images at any other path
+ending in .png, for crawler.assets (point crawler.assets.CDN_URL at the stand-in too).
+Synthetic pages of past editions (the v and e parameters of
+crawler.html_download.edition_url) come from a smaller Universe in that edition. Latency
+is drawn from a configurable distribution, and a share of the requests can be answered
+with 429 (with Retry-After) or a 5xx, have their body trickled out slowly, or have the
+connection reset halfway.
+Responses carry an ETag, so conditional requests get 304s like on the real site.
+
+GET /_stats returns the number of requests, the responses by status and percentiles of
+the time spent serving them, including injected delays.
+
+    python -m crawler.standin --players 10000 --port 8080 --latency lognormal 0.05 0.5 --rate-limit 0.01
+
+Point the crawler at it by setting crawler.utils.BASE_URL, e.g. to 'http://127.0.0.1:8080'.
+crawler.loadtest starts one and runs the download pipeline against it.
+"""
+import argparse
+import asyncio
+import collections
+import hashlib
+import json
+import multiprocessing
+import random
+import time
+import zlib
+import urllib.parse
+import urllib.request
+from pathlib import Path
+
+import numpy as np
+from aiohttp import web
+
+import crawler.downloader
+import crawler.fixtures
+from crawler.utils import read_constants
+
+SLOW_BODY_CHUNKS = 10
+LATENCY_PERCENTILES = [50, 90, 99]
+
+# name -> (function of a random.Random and the parameters, number of parameters)
+LATENCY_DISTRIBUTIONS = {'constant': (lambda rng, seconds: seconds, 1),
+                         'uniform': (lambda rng, low, high: rng.uniform(low, high), 2),
+                         'exponential': (lambda rng, mean: rng.expovariate(1 / mean), 1),
+                         'lognormal': (lambda rng, median, sigma: median * rng.lognormvariate(0, sigma), 2)}
+
+
+def _recorded_filename(path_qs):
+    return urllib.parse.quote(path_qs, safe='') + '.html'
+
+
+def record_pages(urls, directory):
+    """Downloads urls from the real site into directory, for StandIn(recorded_dir=directory)."""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    def on_page(url, html):
+        split = urllib.parse.urlsplit(url)
+        path_qs = split.path + ('?' + split.query if split.query else '')
+        (directory / _recorded_filename(path_qs)).write_text(html, encoding='utf_8')
+
+    return crawler.downloader.download(urls, on_page)
+
+
+class StandIn:
+    """Configuration and request handlers of a stand-in server.
+
+    Parameters
+    ----------
+    universe : crawler.fixtures.Universe, the synthetic site to serve. Ignored if recorded_dir is given.
+    recorded_dir : directory of pages saved by record_pages. Urls that weren't recorded get a 404.
+    latency : (distribution name, *parameters) from LATENCY_DISTRIBUTIONS, in seconds, or None.
+    rate_limit_rate, error_rate, slow_body_rate, reset_rate : share of the requests answered
+        with 429, answered with a 500, 502 or 503, whose body is sent in SLOW_BODY_CHUNKS pieces
+        over slow_body_seconds, or whose connection is reset after part of the body.
+    retry_after : Retry-After seconds sent with the 429s.
+    seed : seed of the random draws.
+    """
+
+    def __init__(self, universe=None, recorded_dir=None, latency=None, rate_limit_rate=0.0, error_rate=0.0,
+                 slow_body_rate=0.0, slow_body_seconds=1.0, reset_rate=0.0, retry_after=1, seed=0):
+        if universe is None and recorded_dir is None:
+            raise ValueError('either universe or recorded_dir is needed')
+        if latency is not None:
+            name, *parameters = latency
+            if name not in LATENCY_DISTRIBUTIONS or len(parameters) != LATENCY_DISTRIBUTIONS[name][1]:
+                raise ValueError('unknown latency distribution {!r}'.format(latency))
+        self.universe = universe
+        self.recorded_dir = None if recorded_dir is None else Path(recorded_dir)
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        self.slow_body_rate = slow_body_rate
+        self.slow_body_seconds = slow_body_seconds
+        self.reset_rate = reset_rate
+        self.retry_after = retry_after
+        self.seed = seed
+
+    def make_app(self):
+        """A new aiohttp application serving the site, with its own statistics."""
+        rng = random.Random(self.seed)
+        constants = read_constants()
+        statuses = collections.Counter()
+        seconds = []
+        in_flight = [0, 0]  # current, max
+
+        universes = {None: self.universe}
+
+        def edition_universe(query):
+            if 'v' not in query:
+                return self.universe
+            edition = query['v'] + ('.' + query['e'] if 'e' in query else '')
+            if edition not in universes:
+                # the editions are a little smaller than the current one, by different amounts
+                n_players = self.universe.n_players
+                universes[edition] = crawler.fixtures.Universe(
+                    n_players - zlib.crc32(edition.encode()) % max(1, n_players // 10), edition)
+            return universes[edition]
+
+        def synthetic_page(request):
+            path = request.path
+            universe = edition_universe(request.query)
+            if path == '/players':
+                return crawler.fixtures.overview_page(universe, int(request.query.get('offset', 0)))
+            if path == '/leagues':
+                return crawler.fixtures.league_overview_page(universe)
+            kind, _, ID = path.strip('/').partition('/')
+            if kind == 'player' and 0 <= int(ID) - crawler.fixtures.FIRST_PLAYER_ID < universe.n_players:
+                return crawler.fixtures.player_page(universe, int(ID), constants)
+            if kind == 'league' and 1 <= int(ID) <= universe.n_leagues:
+                return crawler.fixtures.league_page(universe, int(ID))
+            return None
+
+        def recorded_page(request):
+            try:
+                return (self.recorded_dir / _recorded_filename(request.path_qs)).read_text(encoding='utf_8')
+            except FileNotFoundError:
+                return None
+
+        if self.recorded_dir is None:
+            get_page = synthetic_page
+        else:
+            get_page = recorded_page
+
+        async def respond(request):
+            if self.latency is not None:
+                name, *parameters = self.latency
+                await asyncio.sleep(LATENCY_DISTRIBUTIONS[name][0](rng, *parameters))
+            draw = rng.random()
+            if draw < self.rate_limit_rate:
+                return web.Response(status=429, headers={'Retry-After': str(self.retry_after)})
+            draw -= self.rate_limit_rate
+            if draw < self.error_rate:
+                return web.Response(status=rng.choice([500, 502, 503]))
+            if request.path.endswith('.png'):
+                body, content_type = crawler.fixtures.image(request.path), 'image/png'
+            else:
+                html = get_page(request)
+                if html is None:
+                    return web.Response(status=404)
+                body, content_type = html.encode('utf_8'), 'text/html; charset=utf-8'
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            if request.headers.get('If-None-Match') == etag:
+                return web.Response(status=304, headers={'ETag': etag})
+            draw = rng.random()
+            if draw < self.reset_rate + self.slow_body_rate:
+                return await stream_body(request, body, etag, content_type, reset=draw < self.reset_rate)
+            return web.Response(body=body, headers={'ETag': etag, 'Content-Type': content_type})
+
+        async def stream_body(request, body, etag, content_type, reset):
+            response = web.StreamResponse(headers={'ETag': etag, 'Content-Type': content_type})
+            response.content_length = len(body)
+            await response.prepare(request)
+            chunk_size = -(-len(body) // SLOW_BODY_CHUNKS)
+            for start in range(0, len(body), chunk_size):
+                if reset and start >= len(body) // 2:
+                    request['reset'] = True
+                    request.transport.abort()
+                    return response
+                await response.write(body[start:start + chunk_size])
+                if not reset:
+                    await asyncio.sleep(self.slow_body_seconds / SLOW_BODY_CHUNKS)
+            await response.write_eof()
+            return response
+
+        async def handle_page(request):
+            start = time.perf_counter()
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+            try:
+                response = await respond(request)
+            finally:
+                in_flight[0] -= 1
+                seconds.append(time.perf_counter() - start)
+            statuses['reset' if request.get('reset') else str(response.status)] += 1
+            return response
+
+        async def handle_stats(request):
+            percentiles = np.percentile(seconds, LATENCY_PERCENTILES).tolist() if seconds else []
+            return web.json_response({'requests': len(seconds),
+                                      'statuses': dict(statuses),
+                                      'max_in_flight': in_flight[1],
+                                      'seconds': dict(zip(['p{}'.format(p) for p in LATENCY_PERCENTILES],
+                                                          percentiles),
+                                                      max=max(seconds, default=None))})
+
+        app = web.Application()
+        app.router.add_get('/_stats', handle_stats)
+        for path in ['/players', '/player/{ID}', '/leagues', '/league/{ID}', r'/{image:.+\.png}']:
+            app.router.add_get(path, handle_page)
+        return app
+
+
+def serve(standin, host='127.0.0.1', port=8080):
+    """Serves standin until interrupted."""
+    web.run_app(standin.make_app(), host=host, port=port, print=None, access_log=None)
+
+
+async def _serve_until_stopped(standin, host, port, ready):
+    runner = web.AppRunner(standin.make_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    ready.put(site._server.sockets[0].getsockname()[1])
+    while True:
+        await asyncio.sleep(3600)
+
+
+def _serve_in_process(standin, host, port, ready):
+    asyncio.run(_serve_until_stopped(standin, host, port, ready))
+
+
+class StandInProcess:
+    """Runs a StandIn in a separate process, so it competes as little as possible with the
+    crawler being measured. Use as a context manager; start returns the base url."""
+
+    def __init__(self, standin, host='127.0.0.1', port=0):
+        self.standin = standin
+        self.host = host
+        self.port = port
+        self.base_url = None
+        self._process = None
+
+    def start(self):
+        context = multiprocessing.get_context('spawn')
+        ready = context.Queue()
+        self._process = context.Process(target=_serve_in_process, args=(self.standin, self.host, self.port, ready),
+                                        daemon=True)
+        self._process.start()
+        self.base_url = 'http://{}:{}'.format(self.host, ready.get(timeout=60))
+        return self.base_url
+
+    def stats(self):
+        with urllib.request.urlopen(self.base_url + '/_stats') as response:
+            return json.loads(response.read())
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def add_arguments(parser):
+    """Adds the command line options of a StandIn to an argparse parser; see from_arguments."""
+    parser.add_argument('--players', type=int, default=1000, help='number of players of the synthetic site')
+    parser.add_argument('--recorded-dir', help='serve the pages saved by record_pages instead')
+    parser.add_argument('--latency', nargs='+', metavar=('DISTRIBUTION', 'PARAMETER'),
+                        help='one of {} and its parameters in seconds'.format(', '.join(LATENCY_DISTRIBUTIONS)))
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--errors', type=float, default=0.0, help='share of requests answered with a 5xx')
+    parser.add_argument('--slow', type=float, default=0.0, help='share of responses with a slow body')
+    parser.add_argument('--slow-seconds', type=float, default=1.0, help='time taken to send a slow body')
+    parser.add_argument('--resets', type=float, default=0.0, help='share of connections reset mid-body')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def from_arguments(args):
+    latency = None
+    if args.latency:
+        latency = (args.latency[0], *map(float, args.latency[1:]))
+    return StandIn(crawler.fixtures.Universe(args.players), args.recorded_dir, latency, args.rate_limit,
+                   args.errors, args.slow, args.slow_seconds, args.resets, seed=args.seed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    print('serving on http://{}:{}'.format(args.host, args.port))
+    serve(from_arguments(args), args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,7 @@
+import collections
 import json
 from pathlib import Path
 
-import numpy as np
-import pandas as pd
-
 DATA_DIR = Path(__file__).parents[1] / 'data'
 VERSION_KEYS = ['current', 'previous']
 CATEGORY_KEYS = ['overview', 'player', 'complete', 'league', 'league_overview']
@@ -11,6 +9,21 @@ CATEGORY_KEYS = ['overview', 'player', 'complete', 'league', 'league_overview']
 CONSTANTS_DIR = Path(__file__).parents[1] / 'data/resources/constants/'
 CURRENT_PATH = CONSTANTS_DIR / 'current.json'
 PREVIOUS_PATH = CONSTANTS_DIR / 'previous.json'
+EDITION_CONSTANTS_DIR = CONSTANTS_DIR / 'editions'
+
+# see crawler.extraction
+DEFAULT_ENGINE = 'lxml'
+
+# the site the crawler downloads from; point it at crawler.standin for offline runs and load tests
+BASE_URL = 'https://sofifa.com'
+
+# a past edition of the game on sofifa, e.g. Edition('16') for FIFA 16, optionally at one of
+# its roster updates (sofifa's e parameter); see crawler.editions
+Edition = collections.namedtuple('Edition', ['version', 'roster'], defaults=[None])
+
+
+def edition_name(edition):
+    return 'fifa{}'.format(edition.version) + ('' if edition.roster is None else '_{}'.format(edition.roster))
 
 
 def headline_attribute_from_line(line):
@@ -21,28 +34,32 @@ def headline_attribute_from_line(line):
 
 
 def parse_headline_attributes(headline_attributes_selector):
-    attribute_dict = {}
     # note xpath is 1-indexed
     headline_attribute_script = headline_attributes_selector.xpath('./head/script')
-    for line in headline_attribute_script.extract_first().split('\r\n'):
+    return headline_attributes_from_script(headline_attribute_script.extract_first())
+
+
+def headline_attributes_from_script(script_html):
+    attribute_dict = {}
+    # the page uses \r\n line endings, but newer versions of libxml2 turn them into \n
+    for line in script_html.splitlines():
         if 'point' in line:
             attr_subdict = headline_attribute_from_line(line)
             attribute_dict[attr_subdict['name']] = attr_subdict['value']
     return attribute_dict
 
 
-def read_constants():
-    with open(CURRENT_PATH, 'r') as f:
-        constants = json.load(f)
-    return constants
+def constants_path(edition=None):
+    """The constants of the current data, or of an Edition. Roster updates share their edition's."""
+    if edition is None:
+        return CURRENT_PATH
+    return EDITION_CONSTANTS_DIR / 'fifa{}.json'.format(edition.version)
 
 
-def convert_currency(curr_col):
-    without_euro_symbol = curr_col.str[1:]
-    unit_symbol = without_euro_symbol.str[-1]
-    numeric_part = np.where(unit_symbol == '0', 0, without_euro_symbol.str[:-1].pipe(pd.to_numeric))
-    multipliers = unit_symbol.replace({'M': 1e6, 'K': 1e3}).pipe(pd.to_numeric)
-    return numeric_part * multipliers
+def read_constants(edition=None):
+    with open(constants_path(edition), 'r') as f:
+        constants = json.load(f)
+    return constants
 
 
 def filepath_tree(data_subdir_name, extension):
@@ -56,7 +73,18 @@ def filepath_tree(data_subdir_name, extension):
     return filepaths
 
 
+def read_data(category_key, version_key='current'):
+    """Reads a previously exported table from data/final."""
+    # imported here so that modules that only need the paths (and the CLI) start quickly
+    import pandas as pd
+    feather_path = filepath_tree('final', '.feather')[version_key][category_key]
+    return pd.read_feather(str(feather_path))
+
+
+def standardise_col_name(col):
+    col = col.lower().replace(' ', '_').replace('-', '_')
+    return 'ID' if col == 'id' else col
+
+
 def standardise_col_names(df):
-    return (df
-            .rename(columns=lambda col: col.lower().replace(' ', '_').replace('-', '_'))
-            .rename(columns={'id': 'ID'}))
+    return df.rename(columns=standardise_col_name)
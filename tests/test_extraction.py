@@ -0,0 +1,64 @@
+"""The lxml engine has to parse every page exactly like the parsel reference engine."""
+import pytest
+
+import crawler.executor
+import crawler.extraction
+import crawler.fixtures
+from crawler.utils import read_constants
+
+N_PLAYERS = 300
+CATEGORIES = ['overview', 'player', 'league', 'league_overview']
+
+
+@pytest.fixture(scope='module')
+def constants():
+    constants = read_constants()
+    crawler.executor.init_worker(constants)
+    return constants
+
+
+@pytest.fixture(scope='module')
+def universe():
+    return crawler.fixtures.Universe(N_PLAYERS)
+
+
+def _pages(category_key, universe, constants):
+    """(url, html) of the synthetic pages of category_key."""
+    if category_key == 'overview':
+        return [(crawler.fixtures.overview_url(offset), crawler.fixtures.overview_page(universe, offset))
+                for offset in universe.overview_offsets()]
+    if category_key == 'player':
+        return [(crawler.fixtures.player_url(ID), crawler.fixtures.player_page(universe, ID, constants))
+                for ID in universe.player_IDs]
+    if category_key == 'league':
+        return [(crawler.fixtures.league_url(league_ID), crawler.fixtures.league_page(universe, league_ID))
+                for league_ID in universe.league_IDs]
+    return [(None, crawler.fixtures.league_overview_page(universe))]
+
+
+def _extract(category_key, engine, url, html):
+    return crawler.extraction.get_page_functions(category_key, engine).extract_page(url, html)
+
+
+@pytest.mark.parametrize('category_key', CATEGORIES)
+def test_engines_extract_the_same_records(category_key, universe, constants):
+    for url, html in _pages(category_key, universe, constants):
+        expected_fragment, expected = _extract(category_key, 'parsel', url, html)
+        fragment, parsed = _extract(category_key, 'lxml', url, html)
+        assert expected, url
+        assert crawler.extraction._values_equal(parsed, expected), url
+        assert crawler.extraction._values_equal(fragment, expected_fragment), url
+
+
+@pytest.mark.parametrize('category_key', CATEGORIES)
+def test_engines_parse_the_same_stored_fragments(category_key, universe, constants):
+    for url, html in _pages(category_key, universe, constants):
+        fragment = crawler.extraction.get_page_functions(category_key, 'parsel').filter_page(html)
+        assert crawler.extraction.compare_parsed(category_key, url, fragment) is None, url
+
+
+@pytest.mark.parametrize('category_key', ['overview', 'league', 'league_overview'])
+def test_lxml_extracts_nothing_from_a_page_without_its_table(category_key):
+    fragment, parsed = _extract(category_key, 'lxml', None, '<html><body><p>Not found</p></body></html>')
+    assert fragment is None
+    assert not parsed